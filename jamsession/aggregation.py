@@ -0,0 +1,202 @@
+"""
+Grouped sums, counts and time buckets over a data object's rows,
+computed by MongoDB's aggregation framework so only the small
+result set comes back.
+
+    DataObj.aggregate().bucket('Date', 'month').sum('Backlog').count()
+
+yields one dictionary per month like
+
+    {'Date': datetime(2010, 8, 1), 'Backlog__sum': 120, 'count': 31}
+
+Weeks start on Sunday. Since one can span two years, week buckets are
+grouped by day and the days folded into weeks here.
+"""
+import datetime
+from collections import OrderedDict
+
+from bson.son import SON
+
+#: The date parts each bucket size groups on, largest first.
+BUCKET_PARTS = {
+    'year': ('year', ),
+    'month': ('year', 'month'),
+    'week': ('year', 'dayOfYear'),
+    'day': ('year', 'month', 'dayOfMonth'),
+    'hour': ('year', 'month', 'dayOfMonth', 'hour'),
+}
+
+ACCUMULATORS = ('sum', 'avg', 'min', 'max')
+
+
+class AggregationError(Exception):
+    pass
+
+
+def bucket_start(size, parts):
+    """
+    The datetime a bucket of size starts at, given
+    the date parts MongoDB grouped it on.
+    """
+    if size == 'week':
+        day = (datetime.datetime(parts['year'], 1, 1)
+               + datetime.timedelta(days=parts['dayOfYear'] - 1))
+        return day - datetime.timedelta(days=(day.weekday() + 1) % 7)
+    return datetime.datetime(parts['year'],
+                             parts.get('month', 1),
+                             parts.get('dayOfMonth', 1),
+                             parts.get('hour', 0))
+
+
+class Aggregation(object):
+    """
+    Builds up and runs an aggregation pipeline over the
+    collection of document, a data object class.
+    """
+    def __init__(self, document):
+        self.document = document
+        self.spec = {}
+        self.group_columns = []
+        self.bucket_column = None
+        self.bucket_size = None
+        self.accumulators = []
+
+    def match(self, spec=None, **kwargs):
+        """Only aggregate rows matching a MongoDB query."""
+        self.spec.update(spec or {}, **kwargs)
+        return self
+
+    def group_by(self, *columns):
+        self.group_columns.extend(columns)
+        return self
+
+    def bucket(self, column, size='day'):
+        """Group on column, a datetime, truncated to size."""
+        if size not in BUCKET_PARTS:
+            raise AggregationError("Bucket size must be one of %s, got %s"
+                                   % (sorted(BUCKET_PARTS), size))
+        self.bucket_column = column
+        self.bucket_size = size
+        return self
+
+    def accumulate(self, operator, *columns):
+        if operator not in ACCUMULATORS:
+            raise AggregationError("Accumulators must be one of %s, got %s"
+                                   % (ACCUMULATORS, operator))
+        for column in columns:
+            self.accumulators.append(
+                ('%s__%s' % (column, operator), operator, '$' + column))
+        return self
+
+    def sum(self, *columns):
+        return self.accumulate('sum', *columns)
+
+    def avg(self, *columns):
+        return self.accumulate('avg', *columns)
+
+    def min(self, *columns):
+        return self.accumulate('min', *columns)
+
+    def max(self, *columns):
+        return self.accumulate('max', *columns)
+
+    def count(self, name='count'):
+        self.accumulators.append((name, 'sum', 1))
+        return self
+
+    def pipeline(self):
+        """
+        The aggregation pipeline, grouping on positional keys since
+        column names needn't be valid MongoDB field names.
+        """
+        spec = dict(self.spec)
+        group_id = SON()
+        for num, column in enumerate(self.group_columns):
+            group_id['g%s' % num] = '$' + column
+        if self.bucket_column:
+            spec.setdefault(self.bucket_column, {'$type': 9})
+            for part in BUCKET_PARTS[self.bucket_size]:
+                group_id[part] = {'$' + part: '$' + self.bucket_column}
+
+        group = SON([('_id', group_id)])
+        for num, (name, operator, value) in enumerate(self.accumulators):
+            if operator == 'avg' and self.bucket_size == 'week':
+                # Averages of days can't be folded into weeks,
+                # their sums and how many values there were can
+                group['a%s' % num] = {'$sum': value}
+                group['n%s' % num] = {'$sum': {'$cond': [
+                    {'$eq': [{'$ifNull': [value, None]}, None]}, 0, 1]}}
+            else:
+                group['a%s' % num] = {'$' + operator: value}
+
+        pipeline = []
+        if spec:
+            pipeline.append({'$match': spec})
+        pipeline.append({'$group': group})
+        pipeline.append({'$sort': SON([('_id', 1)])})
+        return pipeline
+
+    def to_row(self, result):
+        row = {}
+        group_id = result['_id']
+        for num, column in enumerate(self.group_columns):
+            row[column] = group_id['g%s' % num]
+        if self.bucket_column:
+            row[self.bucket_column] = bucket_start(self.bucket_size,
+                                                   group_id)
+        for num, (name, operator, value) in enumerate(self.accumulators):
+            row[name] = result['a%s' % num]
+            count = result.get('n%s' % num)
+            if count is not None:
+                if count:
+                    row[name] = float(result['a%s' % num]) / count
+                else:
+                    row[name] = None
+        return row
+
+    def fold_weeks(self, results):
+        """
+        Fold results grouped by day into one per week.
+        """
+        weeks = OrderedDict()
+        for result in results:
+            group_id = result['_id']
+            start = bucket_start('week', group_id)
+            key = tuple(group_id.get('g%s' % num)
+                        for num in range(len(self.group_columns)))
+            week = weeks.get(key + (start, ))
+            if week is None:
+                week = weeks[key + (start, )] = dict(result)
+                week['_id'] = dict(group_id, year=start.year,
+                                   dayOfYear=start.timetuple().tm_yday)
+                continue
+            for num, (name, operator, value) in enumerate(
+                    self.accumulators):
+                field = 'a%s' % num
+                if operator in ('min', 'max'):
+                    values = [v for v in (week[field], result[field])
+                              if v is not None]
+                    if values:
+                        week[field] = (min if operator == 'min'
+                                       else max)(values)
+                else:
+                    week[field] += result[field]
+                    if 'n%s' % num in result:
+                        week['n%s' % num] += result['n%s' % num]
+        return weeks.values()
+
+    def execute(self):
+        """
+        Run the pipeline and return a list of result rows.
+        """
+        collection = self.document.objects._collection
+        response = collection.database.command(SON([
+            ('aggregate', collection.name),
+            ('pipeline', self.pipeline()), ]))
+        results = response['result']
+        if self.bucket_size == 'week':
+            results = self.fold_weeks(results)
+        return [self.to_row(result) for result in results]
+
+    def __iter__(self):
+        return iter(self.execute())
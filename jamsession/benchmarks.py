@@ -0,0 +1,509 @@
+"""
+Timings for the jamsession hot paths: imports, row conversion, data
+object lookups, row reads and exports.
+
+They use a throwaway database on a local mongod, or an in-memory
+mongomock one, and synthetic CSVs built from fixtures/cumulativeflow.csv.
+Run them with:
+
+    python -m jamsession.benchmarks --rows 50000 --width 40 \
+        --types int,float,datetime --output results.json
+
+Results are written as JSON along with the commit they were run at, so
+a later run can be checked against them with --compare results.json.
+"""
+import os
+import csv
+import sys
+import time
+import json
+import random
+import platform
+import datetime
+import tempfile
+import subprocess
+from itertools import cycle, islice
+from optparse import OptionParser
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures', 'cumulativeflow.csv')
+BENCHMARK_DB = 'jamsession-benchmarks'
+
+#: Types given to the columns added past the fixture's in a wide CSV.
+TYPE_MIX = ('int', 'float', 'bool', 'datetime', 'string')
+
+WORDS = ('tardis', 'dalek', 'cyberman', 'sonic', 'gallifrey', 'torchwood')
+
+
+def read_fixture(template=FIXTURE_PATH):
+    reader = csv.reader(file(template, 'r'))
+    header = [name.strip() for name in reader.next()]
+    return header, list(reader)
+
+
+def synthetic_columns(width=None, type_mix=TYPE_MIX, template=FIXTURE_PATH):
+    """
+    (name, type) for each column of a synthetic CSV: the columns of
+    template, Date a datetime and the rest ints, cut down or padded out
+    to width with extra columns cycling through type_mix.
+    """
+    header, rows = read_fixture(template)
+    columns = [(name, name == 'Date' and 'datetime' or 'int')
+               for name in header]
+    if width is None:
+        return columns
+    types = cycle(type_mix or TYPE_MIX)
+    for num in range(len(columns), width):
+        typehint = types.next()
+        columns.append(('Extra %s %s' % (num, typehint), typehint))
+    return columns[:width]
+
+
+def synthetic_value(typehint, rng):
+    if typehint == 'int':
+        return str(rng.randint(0, 100))
+    if typehint == 'float':
+        return '%.2f' % rng.uniform(0, 100)
+    if typehint == 'bool':
+        return rng.choice(('true', 'false'))
+    if typehint == 'datetime':
+        day = datetime.date(2010, 8, 1) + \
+            datetime.timedelta(days=rng.randint(0, 365))
+        return '%s/%s/%s' % (day.month, day.day, day.year)
+    return rng.choice(WORDS)
+
+
+def make_csv(num_rows, template=FIXTURE_PATH, width=None,
+             type_mix=TYPE_MIX, seed=1963):
+    """
+    Write a CSV of num_rows rows by repeating the rows of template,
+    with its columns cut down or padded out to width as described by
+    synthetic_columns. Extra values are random, but the same for the
+    same seed. Returns the path to the new file.
+    """
+    header, rows = read_fixture(template)
+    columns = synthetic_columns(width, type_mix, template)
+    num_fixture = min(len(header), len(columns))
+    extra = [typehint for name, typehint in columns[num_fixture:]]
+    rng = random.Random(seed)
+
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    out = os.fdopen(fd, 'w')
+    writer = csv.writer(out)
+    writer.writerow([name for name, typehint in columns])
+    for row in islice(cycle(rows), num_rows):
+        writer.writerow(row[:num_fixture] +
+                        [synthetic_value(typehint, rng)
+                         for typehint in extra])
+    out.close()
+    return path
+
+
+def cumulative_flow_schema(width=None, type_mix=TYPE_MIX):
+    from jamsession.models import Schema
+    return Schema(name='Benchmark Cumulative Flow',
+                  schema=dict(synthetic_columns(width, type_mix)))
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def wipe_db():
+    from mongoengine.connection import _get_db
+    db = _get_db()
+    [db.drop_collection(name) for name in db.collection_names()
+     if 'system.' not in name]
+
+
+def bench_import_batching(num_rows=20000, width=None, type_mix=TYPE_MIX,
+                          batch_sizes=(None, 1000, 5000)):
+    """
+    Compare CSVImporter.load saving row by row (batch_size None)
+    against bulk inserts of various sizes, with the time spent in
+    each stage of the import.
+    """
+    from jamsession.models import CSVImporter
+    from jamsession.metrics import ImportMetrics
+    path = make_csv(num_rows, width=width, type_mix=type_mix)
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            metrics = ImportMetrics()
+            importer = CSVImporter(batch_size=batch_size, metrics=metrics)
+            elapsed, (datadef, count) = timed(
+                importer.load, path,
+                cumulative_flow_schema(width, type_mix))
+            results.append({
+                'benchmark': 'import_batching',
+                'path': 'batch_size=%s' % batch_size,
+                'rows': count,
+                'seconds': elapsed,
+                'rows_per_second': count / elapsed,
+                'stages': metrics.summary()['timers'], })
+            wipe_db()
+    finally:
+        os.remove(path)
+    return results
+
+
+def legacy_prepare_row(importer, row, schema):
+    """
+    CSVImporter.prepare_row as it was before rows were converted with
+    compiled converters, kept as a baseline.
+    """
+    cast_row = {}
+    for key in row.keys():
+        value = row[key]
+        if value in ('', u'', None):
+            cast_row[key] = None
+        else:
+            cast_row[key] = importer.converters[schema[key]](value)
+    return cast_row
+
+
+def bench_prepare_row(num_rows=20000, width=None, type_mix=TYPE_MIX):
+    """
+    Rows per second through the per-cell legacy path, prepare_row,
+    a compiled row converter and columnar casting.
+    """
+    from jamsession.models import CSVImporter
+    importer = CSVImporter()
+    schema = cumulative_flow_schema(width, type_mix).schema
+    path = make_csv(num_rows, width=width, type_mix=type_mix)
+    try:
+        reader = csv.reader(file(path, 'r'))
+        columns = reader.next()
+        rows = list(reader)
+    finally:
+        os.remove(path)
+    dict_rows = [dict(zip(columns, row)) for row in rows]
+    convert_row = importer.compile_row_converter(columns, schema)
+    casts = importer.compile_casts(columns, schema)
+
+    candidates = [
+        ('legacy', lambda: [legacy_prepare_row(importer, row, schema)
+                            for row in dict_rows]),
+        ('prepare_row', lambda: [importer.prepare_row(row, schema)
+                                 for row in dict_rows]),
+        ('compiled', lambda: [convert_row(row) for row in rows]),
+        ('columnar', lambda: list(importer.prepare_columns(
+            enumerate(rows), columns, casts, importer.get_row_errors()))), ]
+    results = []
+    for name, func in candidates:
+        elapsed, _ = timed(func)
+        results.append({
+            'benchmark': 'prepare_row',
+            'path': name,
+            'rows': num_rows,
+            'seconds': elapsed,
+            'rows_per_second': num_rows / elapsed, })
+    return results
+
+
+def bench_datetime(num_rows=20000, width=None, type_mix=TYPE_MIX):
+    """
+    Values per second parsing the fixture's Date column with dateutil
+    against a DatetimeCaster.
+    """
+    from dateutil.parser import parse
+    from jamsession.util import DatetimeCaster
+    reader = csv.reader(file(FIXTURE_PATH, 'r'))
+    reader.next()
+    values = list(islice(cycle(row[0] for row in reader), num_rows))
+
+    candidates = [
+        ('dateutil', lambda: [parse(value) for value in values]),
+        ('caster', lambda: map(DatetimeCaster(values[:100]), values)),
+        ('caster_uncached',
+         lambda: map(DatetimeCaster(values[:100], cache_size=0), values)), ]
+    results = []
+    for name, func in candidates:
+        elapsed, _ = timed(func)
+        results.append({
+            'benchmark': 'datetime',
+            'path': name,
+            'rows': num_rows,
+            'seconds': elapsed,
+            'rows_per_second': num_rows / elapsed, })
+    return results
+
+
+def load_rows(num_rows, width=None, type_mix=TYPE_MIX):
+    """
+    Import a synthetic CSV, returning (datadef, number of rows).
+    """
+    from jamsession.models import CSVImporter
+    path = make_csv(num_rows, width=width, type_mix=type_mix)
+    try:
+        return CSVImporter().load(path,
+                                  cumulative_flow_schema(width, type_mix))
+    finally:
+        os.remove(path)
+
+
+def bench_get_data_object(num_rows=20000, width=None, type_mix=TYPE_MIX):
+    """
+    Lookups per second of a Schema's data object class from the
+    cache, against building the class every time.
+    """
+    datadef = cumulative_flow_schema(width, type_mix)
+    datadef.save()
+
+    def uncached():
+        for num in xrange(num_rows):
+            datadef.forget_data_object()
+            datadef.get_data_object()
+
+    def cached():
+        for num in xrange(num_rows):
+            datadef.get_data_object()
+
+    results = []
+    for name, func in [('uncached', uncached), ('cached', cached)]:
+        elapsed, _ = timed(func)
+        results.append({
+            'benchmark': 'get_data_object',
+            'path': name,
+            'rows': num_rows,
+            'seconds': elapsed,
+            'rows_per_second': num_rows / elapsed, })
+    wipe_db()
+    return results
+
+
+def bench_export(num_rows=20000, width=None, type_mix=TYPE_MIX):
+    """
+    Rows per second through each streaming export format.
+    """
+    from jamsession.export import iter_csv, iter_json, iter_ndjson
+    datadef, count = load_rows(num_rows, width, type_mix)
+
+    results = []
+    for name, exporter in [('csv', iter_csv), ('json', iter_json),
+                           ('ndjson', iter_ndjson)]:
+        elapsed, size = timed(
+            lambda: sum(len(chunk) for chunk in exporter(datadef)))
+        results.append({
+            'benchmark': 'export',
+            'path': name,
+            'rows': count,
+            'seconds': elapsed,
+            'rows_per_second': count / elapsed,
+            'bytes_per_row': size / count, })
+    wipe_db()
+    return results
+
+
+def bench_json_export(num_rows=20000, width=None, type_mix=TYPE_MIX):
+    """
+    Rows per second exporting JSON from mongoengine documents
+    against raw dictionaries, see export.iter_json_rows.
+    """
+    from jamsession.export import iter_json_rows, json_encoder
+    datadef, count = load_rows(num_rows, width, type_mix)
+    DataObj = datadef.get_data_object()
+    columns = datadef.get_columns()
+
+    def from_documents():
+        for obj in DataObj.objects:
+            row = dict((column, getattr(obj, column)) for column in columns)
+            row['_id'] = obj.id
+            json_encoder.encode(row)
+
+    def from_raw():
+        for row in iter_json_rows(datadef):
+            pass
+
+    results = []
+    for name, func in [('documents', from_documents), ('raw', from_raw)]:
+        elapsed, _ = timed(func)
+        results.append({
+            'benchmark': 'json_export',
+            'path': name,
+            'rows': count,
+            'seconds': elapsed,
+            'rows_per_second': count / elapsed, })
+    wipe_db()
+    return results
+
+
+def bench_lazy_rows(num_rows=20000, width=None, type_mix=TYPE_MIX,
+                    columns=None):
+    """
+    Rows per second, and rough bytes per row, reading a few columns
+    as full Documents against projected LazyRows. By default the
+    columns read are the first, middle and last of the CSV.
+    """
+    if columns is None:
+        header = [name for name, typehint
+                  in synthetic_columns(width, type_mix)]
+        columns = []
+        for name in (header[0], header[len(header) // 2], header[-1]):
+            if name not in columns:
+                columns.append(name)
+    datadef, count = load_rows(num_rows, width, type_mix)
+    DataObj = datadef.get_data_object()
+
+    def documents():
+        size = 0
+        for obj in DataObj.objects:
+            [getattr(obj, column) for column in columns]
+            size += sys.getsizeof(obj) + sys.getsizeof(obj._data)
+        return size
+
+    def lazy_rows():
+        size = 0
+        for row in DataObj.rows(*columns):
+            [row[column] for column in columns]
+            size += (sys.getsizeof(row) + sys.getsizeof(row._raw) +
+                     sys.getsizeof(row._values))
+        return size
+
+    results = []
+    for name, func in [('documents', documents), ('lazy_rows', lazy_rows)]:
+        elapsed, size = timed(func)
+        results.append({
+            'benchmark': 'read_rows',
+            'path': name,
+            'rows': count,
+            'seconds': elapsed,
+            'rows_per_second': count / elapsed,
+            'bytes_per_row': size / count, })
+    wipe_db()
+    return results
+
+
+BENCHMARKS = [
+    ('import_batching', bench_import_batching),
+    ('prepare_row', bench_prepare_row),
+    ('datetime', bench_datetime),
+    ('get_data_object', bench_get_data_object),
+    ('read_rows', bench_lazy_rows),
+    ('export', bench_export),
+    ('json_export', bench_json_export),
+]
+
+
+def connect_backend(backend='mongod'):
+    """
+    Connect mongoengine to the benchmark database on a local mongod,
+    or with backend 'mongomock' an in-memory one. mongomock only
+    measures the Python side of each path.
+    """
+    if backend == 'mongomock':
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("mongomock isn't installed")
+        import pymongo
+        from mongoengine import connection
+        pymongo.Connection = mongomock.Connection
+        if hasattr(connection, 'Connection'):
+            connection.Connection = mongomock.Connection
+    elif backend != 'mongod':
+        raise SystemExit("Unknown backend %s" % backend)
+    from mongoengine import connect
+    connect(BENCHMARK_DB)
+
+
+def get_commit():
+    try:
+        return subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def run_suite(names=None, backend='mongod', **params):
+    """
+    Run the named benchmarks, or all of them, with params and return
+    the results along with when, where and at what commit they ran.
+    """
+    started = datetime.datetime.now()
+    results = []
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        wipe_db()
+        results.extend(func(**params))
+    return {
+        'commit': get_commit(),
+        'started': started.isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': backend,
+        'params': params,
+        'results': results,
+    }
+
+
+def result_key(result):
+    return '%s %s' % (result['benchmark'], result['path'])
+
+
+def compare(baseline, suite):
+    """
+    Lines comparing each result in suite to the same one in baseline.
+    """
+    previous = dict((result_key(result), result)
+                    for result in baseline['results'])
+    lines = []
+    for result in suite['results']:
+        key = result_key(result)
+        if key not in previous:
+            continue
+        ratio = result['rows_per_second'] / previous[key]['rows_per_second']
+        lines.append('%-40s %8.2fx' % (key, ratio))
+    return lines
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m jamsession.benchmarks [options]")
+    parser.add_option('--rows', type='int', default=20000,
+                      help="Rows in each synthetic CSV.")
+    parser.add_option('--width', type='int', default=None,
+                      help="Columns in each synthetic CSV, the fixture's "
+                           "if not given.")
+    parser.add_option('--types', default=','.join(TYPE_MIX),
+                      help="Comma separated types for the extra columns "
+                           "of a wide CSV.")
+    parser.add_option('--only', default=None,
+                      help="Comma separated benchmarks to run, out of %s."
+                           % ', '.join(name for name, func in BENCHMARKS))
+    parser.add_option('--backend', default='mongod',
+                      help="mongod or mongomock.")
+    parser.add_option('--output', default=None,
+                      help="Write the results as JSON to this file.")
+    parser.add_option('--compare', default=None,
+                      help="Compare against the JSON results of an "
+                           "earlier run.")
+    options, args = parser.parse_args(argv)
+
+    connect_backend(options.backend)
+    suite = run_suite(names=options.only and options.only.split(','),
+                      backend=options.backend,
+                      num_rows=options.rows,
+                      width=options.width,
+                      type_mix=tuple(options.types.split(',')))
+
+    for result in suite['results']:
+        print "%(benchmark)s %(path)s: %(rows)s rows " \
+              "in %(seconds).2fs (%(rows_per_second).0f rows/s)" % result
+    if options.output:
+        out = open(options.output, 'w')
+        json.dump(suite, out, indent=2, sort_keys=True)
+        out.close()
+    if options.compare:
+        print "\nRows per second against %s:" % options.compare
+        for line in compare(json.load(open(options.compare)), suite):
+            print line
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Cache the results of queries against data objects, which only change
+when rows are imported, saved or deleted.
+
+Results are kept in Django's cache, with the most recently used also
+kept in process. Every key includes a generation number for the
+collection queried, which imports and row saves and deletes increment
+with bump_generation, so cached results are never invalidated one by
+one: they stop being asked for and expire.
+
+    page = cached_rows(DataObj, {'Team': 'UX'}, ['Date', 'Backlog'])
+    page = cached_rows(DataObj, {'Team': 'UX'}, ['Date', 'Backlog'],
+                       after=page.next_key)
+
+Writes that go around the importer and the data object's save and
+delete, such as DataObj.objects.delete(), must call bump_generation.
+
+Outside a configured Django project nothing is cached, and
+bump_generation does nothing, so the importer can be used without one.
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from bson.son import SON
+
+from jamsession.paginator import KeysetPage, KeysetPaginator, estimated_count
+from jamsession.rows import LazyRow
+
+#: Most results kept in process, least recently used are dropped first.
+QUERY_CACHE_SIZE = 256
+
+#: Seconds results are kept in Django's cache.
+QUERY_CACHE_TIMEOUT = 300
+
+#: Seconds a collection's generation is kept in Django's cache.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+KEY_PREFIX = 'jamsession'
+
+_results = OrderedDict()
+_results_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Django's cache, or None if Django's settings aren't configured.
+    """
+    from django.conf import settings
+    if not (settings.configured or os.environ.get('DJANGO_SETTINGS_MODULE')):
+        return None
+    from django.core.cache import cache
+    return cache
+
+
+def get_generation_key(collection_name):
+    return '%s:generation:%s' % (KEY_PREFIX,
+                                 hashlib.md5(collection_name).hexdigest())
+
+
+def new_generation():
+    """
+    A starting generation, from the clock in milliseconds, so one that
+    was dropped from the cache is never started again at a number
+    results have already been stored under.
+    """
+    return int(time.time() * 1000)
+
+
+def get_generation(cache, collection_name):
+    key = get_generation_key(collection_name)
+    generation = cache.get(key)
+    if generation is None:
+        generation = new_generation()
+        if not cache.add(key, generation, GENERATION_TIMEOUT):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def bump_generation(collection_name):
+    """
+    Move collection_name on to a new generation, so nothing
+    cached from it before is used again.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+    key = get_generation_key(collection_name)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        generation = new_generation()
+        cache.set(key, generation, GENERATION_TIMEOUT)
+        return generation
+
+
+def normalize(value):
+    """
+    value, a query, with its dictionaries' keys sorted so equivalent
+    queries make the same key. SONs keep their order, which matters.
+    """
+    if isinstance(value, SON):
+        return ('SON', tuple((key, normalize(item))
+                             for key, item in value.items()))
+    if isinstance(value, dict):
+        return tuple(sorted((key, normalize(item))
+                            for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(item) for item in value)
+    return value
+
+
+def get_query_key(schema_id, collection_name, generation, query,
+                  projection=None, page=None):
+    if projection:
+        projection = sorted(projection)
+    contents = repr((schema_id, collection_name, generation,
+                     normalize(query), projection, normalize(page)))
+    return '%s:query:%s' % (KEY_PREFIX, hashlib.md5(contents).hexdigest())
+
+
+def remember(key, value):
+    with _results_lock:
+        _results.pop(key, None)
+        _results[key] = value
+        while len(_results) > QUERY_CACHE_SIZE:
+            _results.popitem(last=False)
+
+
+def forget_all():
+    """
+    Empty the in process cache.
+    """
+    with _results_lock:
+        _results.clear()
+
+
+def cached(schema_id, collection_name, query, compute, projection=None,
+           page=None, timeout=QUERY_CACHE_TIMEOUT):
+    """
+    The result of compute(), which runs query against collection_name
+    with projection and page, from the cache if it's there. Cached
+    results are shared, so they mustn't be changed.
+    """
+    cache = get_cache()
+    if cache is None:
+        return compute()
+    key = get_query_key(schema_id, collection_name,
+                        get_generation(cache, collection_name),
+                        query, projection, page)
+    with _results_lock:
+        if key in _results:
+            value = _results.pop(key)
+            _results[key] = value
+            return value
+
+    hit = cache.get(key)
+    if hit is not None:
+        value = hit[0]
+    else:
+        value = compute()
+        cache.set(key, (value, ), timeout)
+    remember(key, value)
+    return value
+
+
+def cached_rows(document, spec=None, columns=None, after=None, before=None,
+                per_page=50):
+    """
+    A KeysetPage of LazyRows of document, a data object class, matching
+    spec, see jamsession.paginator.KeysetPaginator. The raw rows are
+    cached by the keys of the page's edges, after and before.
+    """
+    collection = document.objects._collection
+    paginator = KeysetPaginator(document, per_page, spec, columns)
+
+    def compute():
+        return paginator.page_documents(after, before)
+    docs, has_next, has_previous = cached(
+        document._schema_id, collection.name, spec or {}, compute,
+        projection=columns, page=(after, before, per_page))
+    return KeysetPage([LazyRow(doc, document._fields) for doc in docs],
+                      has_next, has_previous)
+
+
+def cached_count(document, spec=None):
+    collection = document.objects._collection
+
+    def compute():
+        return collection.find(spec or {}).count()
+    return cached(document._schema_id, collection.name, spec or {}, compute,
+                  page='count')
+
+
+def cached_estimated_count(document):
+    """
+    The number of rows of document according to its collection's
+    metadata, see jamsession.paginator.estimated_count.
+    """
+    collection = document.objects._collection
+
+    def compute():
+        return estimated_count(collection)
+    return cached(document._schema_id, collection.name, {}, compute,
+                  page='estimated_count')
+
+
+def cached_aggregation(aggregation):
+    """
+    The result rows of a jamsession.aggregation.Aggregation.
+    """
+    document = aggregation.document
+    collection = document.objects._collection
+    return cached(document._schema_id, collection.name,
+                  aggregation.pipeline(), aggregation.execute,
+                  page='aggregate')
@@ -0,0 +1,249 @@
+"""
+Export the rows of a data object without loading them all into memory.
+
+Rows are read straight from a server-side cursor a batch at a time and
+written out incrementally, so memory use stays flat however many rows
+there are.
+
+Besides CSV and JSON, rows can be exported as Parquet, column by column
+with the types of the Schema, which needs pyarrow.
+"""
+import csv
+import datetime
+from cStringIO import StringIO
+
+from bson.objectid import ObjectId
+from django.utils import simplejson
+
+from jamsession.util import chunked
+
+#: Rows fetched from the database, and written out, at a time.
+EXPORT_BATCH_SIZE = 1000
+
+#: Rows per Parquet row group.
+PARQUET_ROW_GROUP_SIZE = 50000
+
+#: The Arrow type each Schema type is exported as.
+ARROW_TYPES = {
+    'string': 'string',
+    'url': 'string',
+    'email': 'string',
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'bool_',
+    'datetime': 'timestamp',
+}
+
+
+def iter_documents(datadef, columns=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Raw dictionaries for every row of datadef, optionally with only
+    the given columns, fetched batch_size at a time.
+
+    The cursor doesn't time out, but is killed on the server when it's
+    garbage collected, so an export that stops early still releases it.
+    """
+    collection = datadef.get_data_object().objects._collection
+    cursor = collection.find({}, columns, timeout=False)
+    cursor.batch_size(batch_size)
+    for doc in cursor:
+        yield doc
+
+
+def format_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, float):
+        # str keeps only 12 significant digits
+        return repr(value)
+    return str(value)
+
+
+def iter_csv(datadef, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield chunks of CSV text for datadef's rows, a header of its
+    columns and then batch_size rows at a time.
+    """
+    columns = datadef.get_columns()
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([format_csv_value(column) for column in columns])
+
+    for num, doc in enumerate(iter_documents(datadef, columns, batch_size)):
+        writer.writerow([format_csv_value(doc.get(column))
+                         for column in columns])
+        if (num + 1) % batch_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def write_csv(datadef, fileobj, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Write datadef's rows to fileobj as CSV, see iter_csv.
+    """
+    for chunk in iter_csv(datadef, batch_size):
+        fileobj.write(chunk)
+
+
+def json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError("%r is not JSON serializable" % (value, ))
+
+
+json_encoder = simplejson.JSONEncoder(default=json_default,
+                                      separators=(',', ':'))
+
+
+def iter_json_rows(datadef, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield each of datadef's rows encoded as a JSON object, with its
+    columns and its id as _id. Rows are serialized straight from the raw
+    dictionaries, never becoming Documents.
+    """
+    columns = datadef.get_columns()
+    encode = json_encoder.encode
+    for doc in iter_documents(datadef, columns, batch_size):
+        row = dict((column, doc.get(column)) for column in columns)
+        row['_id'] = doc['_id']
+        yield encode(row)
+
+
+def iter_ndjson(datadef, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield chunks of newline delimited JSON, one object per row,
+    batch_size rows at a time.
+    """
+    batch = []
+    for row in iter_json_rows(datadef, batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            batch.append('')
+            yield '\n'.join(batch)
+            batch = []
+    if batch:
+        batch.append('')
+        yield '\n'.join(batch)
+
+
+def iter_json(datadef, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield chunks of a JSON array of datadef's rows,
+    batch_size rows at a time.
+    """
+    yield '['
+    batch = []
+    separator = ''
+    for row in iter_json_rows(datadef, batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield separator + ','.join(batch)
+            separator = ','
+            batch = []
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']'
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet exports need pyarrow installed")
+    return pyarrow, pyarrow.parquet
+
+
+def get_arrow_type(pa, typehint):
+    name = ARROW_TYPES[typehint]
+    if name == 'timestamp':
+        return pa.timestamp('ms')
+    return getattr(pa, name)()
+
+
+def get_arrow_schema(pa, datadef):
+    """
+    An Arrow schema of _id, as a hex string, then datadef's columns.
+    """
+    fields = [pa.field('_id', pa.string())]
+    for column in datadef.get_columns():
+        fields.append(pa.field(column,
+                               get_arrow_type(pa, datadef.schema[column])))
+    return pa.schema(fields)
+
+
+class ChunkSink(object):
+    """
+    A write only file that hands over what's been written to it with
+    pop, for streaming formats that need to know their position.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def pop(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_parquet(datadef, batch_size=PARQUET_ROW_GROUP_SIZE):
+    """
+    Yield chunks of a Parquet file of datadef's rows, one row group of
+    batch_size rows at a time. Each column is typed from datadef.schema,
+    see ARROW_TYPES, and strings are dictionary encoded.
+
+    Raises ImportError straight away if pyarrow isn't installed. The
+    file can be read with pyarrow.parquet.read_table(path,
+    memory_map=True), or pandas.read_parquet.
+    """
+    pa, pq = import_pyarrow()
+    columns = datadef.get_columns()
+    schema = get_arrow_schema(pa, datadef)
+    types = [field.type for field in schema]
+
+    def generate():
+        sink = ChunkSink()
+        writer = pq.ParquetWriter(sink, schema, use_dictionary=True)
+        for batch in chunked(iter_documents(datadef, columns, batch_size),
+                             batch_size):
+            arrays = [pa.array([str(doc['_id']) for doc in batch],
+                               type=types[0])]
+            for column, arrow_type in zip(columns, types[1:]):
+                arrays.append(pa.array([doc.get(column) for doc in batch],
+                                       type=arrow_type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.pop()
+        writer.close()
+        yield sink.pop()
+    return generate()
+
+
+def write_parquet(datadef, fileobj, batch_size=PARQUET_ROW_GROUP_SIZE):
+    """
+    Write datadef's rows to fileobj as Parquet, see iter_parquet.
+    """
+    for chunk in iter_parquet(datadef, batch_size):
+        fileobj.write(chunk)
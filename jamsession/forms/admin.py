@@ -1,4 +1,5 @@
 from django import forms
+from mongoengine import ValidationError
 
 from jamsession.forms.fields import SchemaField
 from jamsession.models import Schema
@@ -33,6 +34,18 @@ class SchemaAdminForm(forms.Form):
         return data
 
     def save(self):
-        obj = self._meta.model(**self.cleaned_data)
-        obj.save()
+        """
+        Create the Schema. If its indexes can't be created it isn't
+        saved, and the ValidationError is added to the form's errors
+        and raised.
+        """
+        data = dict(self.cleaned_data)
+        data['indexes'] = getattr(data['schema'], 'indexes', [])
+        data['schema'] = dict(data['schema'])
+        obj = self._meta.model(**data)
+        try:
+            obj.save()
+        except ValidationError, e:
+            self._errors['schema'] = self.error_class([str(e)])
+            raise
         return obj
@@ -4,11 +4,31 @@ from django import forms
 
 from jamsession.util import FIELD_TYPE_TRANSLATIONS
 
+INDEX_TYPES = ('index', 'unique')
+
+
+class SchemaDefinition(dict):
+    """
+    Column names mapped to their types, with the
+    indexes declared alongside them.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SchemaDefinition, self).__init__(*args, **kwargs)
+        self.indexes = []
+
 
 class SchemaField(forms.CharField):
     """
     Custom field to accept a comma and line delimited
     text input of a schema definition
+
+    A column can be indexed by adding index or unique after its type:
+
+        Name,string,unique
+
+    and a compound index declared on a line of its own:
+
+        @index,Date,Team
     """
 
     def validate_key_value_pairs(self, key, value, schema):
@@ -27,16 +47,41 @@ class SchemaField(forms.CharField):
             raise forms.ValidationError(msg)
         return True
 
+    def validate_index(self, index_type, columns, schema):
+        if index_type not in INDEX_TYPES:
+            msg = "Index types must be one of %s, got %s" % \
+                (pprint.pformat(INDEX_TYPES), index_type)
+            raise forms.ValidationError(msg)
+        if not columns:
+            msg = "Must provide the columns to %s" % index_type
+            raise forms.ValidationError(msg)
+        for column in columns:
+            if column not in schema.keys():
+                msg = "Can't %s %s, no such column" % (index_type, column)
+                raise forms.ValidationError(msg)
+        return True
+
     def parse_schema_entries(self, text):
         lines = [line for line in text.split('\n')]
-        schema = {}
+        schema = SchemaDefinition()
+        compound_indexes = []
 
         for line in lines:
-            parts = line.split(',')
-            if len(parts) >= 2:
-                key, value = parts[0].strip(), parts[1].strip()
+            parts = [part.strip() for part in line.split(',')]
+            if parts[0].startswith('@'):
+                compound_indexes.append(
+                    (parts[0][1:], [part for part in parts[1:] if part]))
+            elif len(parts) >= 2:
+                key, value = parts[0], parts[1]
                 self.validate_key_value_pairs(key, value, schema)
                 schema[key] = value
+                if len(parts) >= 3 and parts[2]:
+                    compound_indexes.append((parts[2], [key]))
+
+        for index_type, columns in compound_indexes:
+            self.validate_index(index_type, columns, schema)
+            schema.indexes.append({'fields': columns,
+                                   'unique': index_type == 'unique'})
         return schema
 
     def to_python(self, value):
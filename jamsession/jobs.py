@@ -0,0 +1,246 @@
+"""
+Load CSV files in the background instead of inside a request.
+
+queue_import saves an ImportJob, and a worker started with the
+jamsession_import_worker command claims queued jobs and runs them on a
+pool of threads, no more than its concurrency at once. Jobs are loaded
+as resumable imports, see CSVImporter.load_resumable, reporting their
+progress on the ImportJob after every batch. A cancelled job stops at
+its next batch and the rows it wrote are removed. A job that fails for
+any reason other than bad data is queued again, and picks up from its
+last checkpoint, until it's used up its max_attempts.
+
+    queue_import('/path/to/file.csv', datadef)
+    ImportWorker(concurrency=2).run()
+"""
+import os
+import time
+import socket
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+
+from bson.son import SON
+from bson.objectid import ObjectId
+
+from jamsession.models import (
+    CSVImporter,
+    ImportCheckpoint,
+    ImportFailed,
+    ImportJob,
+    Schema,
+)
+
+logger = logging.getLogger("jamsession.jobs")
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+class ImportJobLost(Exception):
+    """
+    The job was queued again and claimed by another worker,
+    see requeue_stale_jobs, while this one was still running it.
+    """
+
+
+def update_job(job, spec=None, **fields):
+    """
+    Set fields on job, in the database and on job itself, without
+    overwriting anything else that may have changed since it was read.
+    Only updates it if it also matches spec, returning whether it did.
+    """
+    query = {'_id': ObjectId(str(job.id))}
+    query.update(spec or {})
+    result = ImportJob.objects._collection.update(
+        query, {'$set': fields}, safe=True)
+    if not result.get('n'):
+        return False
+    for name, value in fields.items():
+        setattr(job, name, value)
+    return True
+
+
+def queue_import(datafile, datadef=None, max_attempts=3):
+    """
+    Queue datafile to be loaded into datadef, or a new Schema.
+    """
+    job = ImportJob(datafile=os.path.abspath(datafile),
+                    schema_id=datadef and str(datadef.id) or None,
+                    max_attempts=max_attempts,
+                    total_bytes=os.path.getsize(datafile),
+                    created=datetime.datetime.now())
+    job.save()
+    return job
+
+
+def claim_import_job(worker):
+    """
+    Atomically mark the oldest queued job as running by worker and
+    return it, or None if there aren't any.
+    """
+    collection = ImportJob.objects._collection
+    now = datetime.datetime.now()
+    response = collection.database.command(SON([
+        ('findandmodify', collection.name),
+        ('query', {'status': 'queued', 'cancelled': False}),
+        ('sort', {'created': 1}),
+        ('update', {'$set': {'status': 'running',
+                             'worker': worker,
+                             'started': now,
+                             'updated': now,
+                             'resumed_rows': 0,
+                             'resumed_bytes': 0},
+                    '$inc': {'attempts': 1}}),
+        ('new', True), ]),
+        allowable_errors=['No matching object found'])
+    if not response.get('value'):
+        return None
+    return ImportJob._from_son(response['value'])
+
+
+def requeue_stale_jobs(timeout):
+    """
+    Queue again running jobs that haven't reported any progress for
+    timeout seconds, since the worker running them must have died.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+    result = ImportJob.objects._collection.update(
+        {'status': 'running', 'updated': {'$lt': cutoff}},
+        {'$set': {'status': 'queued', 'worker': None}},
+        multi=True, safe=True)
+    return result.get('n', 0)
+
+
+def cancel_import_job(job):
+    """
+    Cancel job. A queued job won't be run, a running one stops
+    at its next batch.
+    """
+    now = datetime.datetime.now()
+    if update_job(job, {'status': 'queued'}, cancelled=True,
+                  status='cancelled', finished=now):
+        return True
+    return update_job(job, {'status': 'running'}, cancelled=True)
+
+
+def retry_import_job(job):
+    """
+    Queue a failed or cancelled job again, with its attempts reset.
+    """
+    return update_job(job, {'status': {'$in': ['failed', 'cancelled']}},
+                      status='queued', cancelled=False, attempts=0,
+                      error=None, finished=None)
+
+
+def run_import_job(job, importer_class=CSVImporter, **options):
+    """
+    Load the file of job, a claimed ImportJob, with importer_class
+    created with options, recording how it went on the job.
+
+    If job is queued again and claimed by another worker meanwhile,
+    the load stops at its next batch and leaves job to that worker.
+    """
+    running = {'status': 'running', 'worker': job.worker}
+    datadef = None
+    if job.schema_id:
+        datadef = Schema.objects(id=job.schema_id).first()
+        if not datadef:
+            update_job(job, running, status='failed',
+                       error="Schema %s no longer exists" % job.schema_id,
+                       finished=datetime.datetime.now())
+            return job
+
+    def progress(checkpoint):
+        job.checkpoint_id = str(checkpoint.id)
+        fields = {'checkpoint_id': job.checkpoint_id,
+                  'rows_done': checkpoint.rows_done,
+                  'bytes_done': checkpoint.offset,
+                  'updated': datetime.datetime.now()}
+        if job.updated == job.started:
+            fields['resumed_rows'] = checkpoint.rows_done
+            fields['resumed_bytes'] = checkpoint.offset
+        if not update_job(job, dict(running, cancelled=False), **fields):
+            if ImportJob.objects(id=job.id, cancelled=True,
+                                 **running).count():
+                raise ImportCancelled()
+            raise ImportJobLost()
+
+    importer = importer_class(progress=progress, **options)
+    try:
+        datadef, num_created = importer.load(job.datafile, datadef,
+                                             resumable=True)
+    except ImportJobLost:
+        # The checkpoint is the new worker's now, leave it be
+        logger.warning("Import job %s was taken over by another worker"
+                       % job.id)
+    except ImportCancelled:
+        if update_job(job, running, status='cancelled',
+                      finished=datetime.datetime.now()):
+            checkpoint = ImportCheckpoint.objects(
+                id=job.checkpoint_id).first()
+            if checkpoint:
+                checkpoint.discard()
+    except ImportFailed, e:
+        update_job(job, running, status='failed', error=str(e),
+                   finished=datetime.datetime.now())
+    except Exception, e:
+        logger.exception("Import job %s failed" % job.id)
+        if job.attempts < job.max_attempts:
+            update_job(job, running, status='queued', worker=None,
+                       error=str(e))
+        else:
+            update_job(job, running, status='failed', error=str(e),
+                       finished=datetime.datetime.now())
+    else:
+        update_job(job, running, status='done', schema_id=str(datadef.id),
+                   rows_done=num_created, bytes_done=job.total_bytes,
+                   finished=datetime.datetime.now())
+    return job
+
+
+class ImportWorker(object):
+    """
+    Claims queued ImportJobs and runs them on a pool of concurrency
+    threads, checking for new jobs every poll_interval seconds.
+
+    Running jobs that haven't reported progress in stale_after seconds
+    are assumed to have lost their worker and are queued again.
+    """
+    def __init__(self, concurrency=2, poll_interval=5, stale_after=600,
+                 importer_class=CSVImporter, **options):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.importer_class = importer_class
+        self.options = options
+        self.name = '%s:%s' % (socket.gethostname(), os.getpid())
+
+    def run(self, once=False):
+        """
+        Run jobs until interrupted, or with once=True
+        until there are none left to run.
+        """
+        pool = ThreadPool(self.concurrency)
+        running = []
+        try:
+            while True:
+                requeue_stale_jobs(self.stale_after)
+                running = [result for result in running
+                           if not result.ready()]
+                while len(running) < self.concurrency:
+                    job = claim_import_job(self.name)
+                    if not job:
+                        break
+                    logger.info("Running import job %s of %s"
+                                % (job.id, job.datafile))
+                    running.append(pool.apply_async(
+                        run_import_job,
+                        (job, self.importer_class), self.options))
+                if once and not running:
+                    return
+                time.sleep(self.poll_interval)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from jamsession.jobs import ImportWorker
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', type='int', default=2,
+                    help="Most imports to run at once."),
+        make_option('--poll-interval', type='float', default=5,
+                    help="Seconds between checks for new jobs."),
+        make_option('--stale-after', type='int', default=600,
+                    help="Seconds a running job can go without reporting "
+                         "progress before it's queued again."),
+        make_option('--batch-size', type='int', default=5000,
+                    help="Rows written per batch, and per checkpoint."),
+        make_option('--columnar', action='store_true', default=False,
+                    help="Cast rows column by column, see "
+                         "CSVImporter.prepare_columns."),
+        make_option('--once', action='store_true', default=False,
+                    help="Exit once there are no jobs left to run."),
+    )
+    help = "Run queued CSV import jobs in the background."
+
+    def handle(self, *args, **options):
+        worker = ImportWorker(concurrency=options['concurrency'],
+                              poll_interval=options['poll_interval'],
+                              stale_after=options['stale_after'],
+                              batch_size=options['batch_size'],
+                              columnar=options['columnar'])
+        self.stdout.write("Import worker %s running %s jobs at a time\n"
+                          % (worker.name, worker.concurrency))
+        worker.run(once=options['once'])
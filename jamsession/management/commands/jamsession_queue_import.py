@@ -0,0 +1,23 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from jamsession.jobs import queue_import
+from jamsession.models import Schema
+
+
+class Command(BaseCommand):
+    args = '<csv file> [<schema name>]'
+    help = ("Queue a CSV file to be loaded by jamsession_import_worker, "
+            "into the named Schema or a new one.")
+
+    def handle(self, datafile=None, name=None, **options):
+        if not datafile or not os.path.exists(datafile):
+            raise CommandError("No such file %s" % datafile)
+        datadef = None
+        if name:
+            datadef = Schema.objects(name=name).first()
+            if not datadef:
+                raise CommandError("No Schema named %s" % name)
+        job = queue_import(datafile, datadef)
+        self.stdout.write("Queued import job %s\n" % job.id)
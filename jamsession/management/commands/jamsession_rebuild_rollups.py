@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from jamsession.models import Schema
+from jamsession.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    args = '<schema name> [<schema name> ...]'
+    help = ("Recompute the rollups of the named Schemas, or of every "
+            "Schema that declares any, from their rows.")
+
+    def handle(self, *names, **options):
+        if names:
+            schemas = []
+            for name in names:
+                schema = Schema.objects(name=name).first()
+                if not schema:
+                    raise CommandError("No Schema named %s" % name)
+                schemas.append(schema)
+        else:
+            schemas = [schema for schema in Schema.objects if schema.rollups]
+
+        for schema in schemas:
+            rebuild_rollups(schema.get_data_object())
+            self.stdout.write("Rebuilt %s rollups for %s\n"
+                              % (len(schema.rollups), schema.name))
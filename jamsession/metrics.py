@@ -0,0 +1,158 @@
+"""
+Timers and counters for the stages of an import, so a slow one can be
+pinned on reading, casting, validation or writing.
+
+    metrics = ImportMetrics()
+    CSVImporter(metrics=metrics).load(path)
+    print metrics.format_summary()
+
+CSVImporter uses NULL_METRICS unless it's given something else. Its
+timed and timed_iter hand back what they're given, so per-row and
+per-cell hooks cost nothing when metrics are off.
+"""
+import time
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullMetrics(object):
+    enabled = False
+
+    def timer(self, name, count=1):
+        """
+        A context manager timing its block as the
+        stage name, which handled count items.
+        """
+        return _null_timer
+
+    def timed(self, name, func):
+        """func, timed as the stage name every time it's called."""
+        return func
+
+    def timed_iter(self, name, iterable):
+        """iterable, with the time taken by each next() timed as name."""
+        return iterable
+
+    def incr(self, name, count=1):
+        pass
+
+    def add(self, name, seconds, count=1):
+        pass
+
+    def summary(self):
+        return {'timers': {}, 'counters': {}}
+
+    def format_summary(self):
+        return ''
+
+
+_null_timer = NullTimer()
+
+#: Metrics that record nothing, the default for CSVImporter.
+NULL_METRICS = NullMetrics()
+
+
+class Timer(object):
+    __slots__ = ('stat', 'count', 'start')
+
+    def __init__(self, stat, count):
+        self.stat = stat
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stat[0] += time.time() - self.start
+        self.stat[1] += self.count
+        return False
+
+
+class ImportMetrics(NullMetrics):
+    """
+    Total seconds and items handled for each timed stage, plus
+    counters. Nested stages are each timed in full, so prepare_row
+    includes the cast.<type> time of its cells.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+
+    def get_stat(self, name):
+        """The [seconds, count] list for the stage name."""
+        try:
+            return self.timers[name]
+        except KeyError:
+            return self.timers.setdefault(name, [0.0, 0])
+
+    def timer(self, name, count=1):
+        return Timer(self.get_stat(name), count)
+
+    def timed(self, name, func):
+        stat = self.get_stat(name)
+
+        def timed_func(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stat[0] += time.time() - start
+                stat[1] += 1
+        return timed_func
+
+    def timed_iter(self, name, iterable):
+        stat = self.get_stat(name)
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                stat[0] += time.time() - start
+                return
+            stat[0] += time.time() - start
+            stat[1] += 1
+            yield item
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def add(self, name, seconds, count=1):
+        stat = self.get_stat(name)
+        stat[0] += seconds
+        stat[1] += count
+
+    def summary(self):
+        """
+        A dictionary of timers, mapping each stage to its seconds,
+        count and count per second, and of counters.
+        """
+        timers = {}
+        for name, (seconds, count) in self.timers.items():
+            timers[name] = {'seconds': seconds,
+                            'count': count,
+                            'per_second': seconds and count / seconds or None}
+        return {'timers': timers, 'counters': dict(self.counters)}
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = []
+        for name, stat in sorted(summary['timers'].items(),
+                                 key=lambda item: -item[1]['seconds']):
+            line = '%-20s %9.3fs %10s' % (name, stat['seconds'],
+                                          stat['count'])
+            if stat['per_second']:
+                line += ' %12.0f/s' % stat['per_second']
+            lines.append(line)
+        for name, count in sorted(summary['counters'].items()):
+            lines.append('%-20s %21s' % (name, count))
+        return '\n'.join(lines)
@@ -0,0 +1,299 @@
+"""
+Alter a Schema's columns and bring its existing rows along, in place.
+
+Renamed and dropped columns are handled with multi-document updates run
+by the server. Only columns whose type changes are read back, a batch of
+rows at a time, and re-cast with the CSVImporter's converters. Progress
+is saved after every step in a SchemaMigrationState, so an interrupted
+migration resumes from its last batch when it's run again.
+
+The Schema's indexes and rollups follow their columns when they're
+renamed. Those on a dropped column, and rollups the new types no longer
+allow, are removed.
+
+    SchemaMigration(datadef, new_schema, renames={'Old': 'New'}).run()
+"""
+import datetime
+
+from pymongo import ASCENDING
+
+from jamsession.cache import bump_generation
+from jamsession.models import CSVImporter, SchemaMigrationState
+from jamsession.rollups import RollupError, rebuild_rollups, validate_rollups
+
+STAGES = ('rename', 'drop', 'recast', 'done')
+
+#: Most conversion errors kept on a SchemaMigrationState.
+MAX_ERRORS = 100
+
+
+class MigrationFailed(Exception):
+    pass
+
+
+def cast_number(value, typehint):
+    """
+    value, an int or float, as typehint, without going through a
+    string, so 45.0 becomes 45. Returns NotImplemented for types
+    that are cast from the value's text instead.
+    """
+    if typehint == 'int':
+        if value != int(value):
+            raise ValueError("%s isn't a whole number" % value)
+        return int(value)
+    if typehint == 'float':
+        return float(value)
+    if typehint == 'bool':
+        if value not in (0, 1):
+            raise ValueError("%s isn't a boolean" % value)
+        return bool(value)
+    return NotImplemented
+
+
+def diff_schemas(old_schema, new_schema, renames=None):
+    """
+    Compare two Schema.schema dictionaries.
+
+    renames maps old column names to new ones. Returns a dictionary of
+    added and dropped column lists, the renames, and retyped, a
+    dictionary of new column names to (old type, new type).
+    """
+    renames = dict(renames or {})
+    for old, new in renames.items():
+        if old not in old_schema:
+            raise MigrationFailed("Can't rename %s, no such column" % old)
+        if new not in new_schema:
+            raise MigrationFailed("Can't rename %s to %s, %s isn't in the "
+                                  "new schema" % (old, new, new))
+
+    carried = dict((renames.get(column, column), column)
+                   for column in old_schema)
+    retyped = {}
+    for new, old in carried.items():
+        if new in new_schema and old_schema[old] != new_schema[new]:
+            retyped[new] = (old_schema[old], new_schema[new])
+
+    return {
+        'added': sorted(column for column in new_schema
+                        if column not in carried),
+        'dropped': sorted(old for new, old in carried.items()
+                          if new not in new_schema),
+        'renamed': renames,
+        'retyped': retyped,
+    }
+
+
+class SchemaMigration(object):
+    def __init__(self, datadef, new_schema, renames=None, batch_size=1000,
+                 importer=None, progress=None):
+        """
+        progress, if given, is called with the SchemaMigrationState
+        every time it's saved.
+        """
+        self.datadef = datadef
+        self.new_schema = dict(new_schema)
+        self.renames = dict(renames or {})
+        self.batch_size = batch_size
+        self.importer = importer or CSVImporter()
+        self.progress = progress
+        self.diff = diff_schemas(datadef.schema, self.new_schema,
+                                 self.renames)
+
+    def get_state(self):
+        """
+        The unfinished state of this migration if it was
+        interrupted, otherwise a new one.
+        """
+        state = SchemaMigrationState.objects(
+            schema_id=str(self.datadef.id), stage__ne='done').first()
+        if state:
+            if (state.new_schema != self.new_schema or
+                    state.renames != self.renames):
+                raise MigrationFailed(
+                    "A different migration of %s hasn't finished"
+                    % self.datadef.name)
+            return state
+        now = datetime.datetime.now()
+        return SchemaMigrationState(schema_id=str(self.datadef.id),
+                                    old_schema=dict(self.datadef.schema),
+                                    new_schema=self.new_schema,
+                                    renames=self.renames,
+                                    stage=STAGES[0],
+                                    started=now)
+
+    def save_state(self, state, stage=None):
+        if stage:
+            state.stage = stage
+        state.updated = datetime.datetime.now()
+        state.save()
+        if self.progress:
+            self.progress(state)
+
+    def get_collection(self):
+        return self.datadef.get_data_object().objects._collection
+
+    def rename_columns(self, state):
+        if self.diff['renamed']:
+            self.get_collection().update(
+                {}, {'$rename': self.diff['renamed']},
+                multi=True, safe=True)
+
+    def drop_columns(self, state):
+        if self.diff['dropped']:
+            self.get_collection().update(
+                {}, {'$unset': dict((column, 1)
+                                    for column in self.diff['dropped'])},
+                multi=True, safe=True)
+
+    def get_caster(self, typehint):
+        if typehint == 'datetime':
+            return self.importer.get_datetime_caster([])
+        return self.importer.converters[typehint]
+
+    def recast_value(self, value, cast, typehint):
+        if isinstance(value, (int, long, float)):
+            number = cast_number(value, typehint)
+            if number is not NotImplemented:
+                return number
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif isinstance(value, float):
+            # unicode keeps only 12 significant digits
+            value = unicode(repr(value))
+        elif not isinstance(value, basestring):
+            value = unicode(value)
+        if value in ('', u''):
+            return None
+        return cast(value)
+
+    def recast_batch(self, collection, docs, casts, state):
+        """
+        Re-cast the retyped columns of docs, with one multi-document
+        update per distinct value in each column rather than per row.
+        """
+        for column, cast in casts.items():
+            updates = {}
+            for doc in docs:
+                if doc.get(column) is None:
+                    continue
+                value = doc[column]
+                key = (type(value), value)
+                if key not in updates:
+                    try:
+                        updates[key] = (self.recast_value(
+                            value, cast, self.new_schema[column]), [])
+                    except (TypeError, ValueError):
+                        updates[key] = (None, [])
+                        if len(state.errors) < MAX_ERRORS:
+                            state.errors.append(
+                                "Couldn't convert < %s > in %s to %s"
+                                % (value, column, self.new_schema[column]))
+                        state.failures += 1
+                updates[key][1].append(doc['_id'])
+
+            for (value_type, value), (new_value, ids) in updates.items():
+                collection.update(
+                    {'_id': {'$in': ids}, column: value},
+                    {'$set': {column: new_value}},
+                    multi=True, safe=True)
+
+    def recast_columns(self, state):
+        retyped = self.diff['retyped']
+        if not retyped:
+            return
+        casts = dict((column, self.get_caster(new_type))
+                     for column, (old_type, new_type) in retyped.items())
+        collection = self.get_collection()
+        fields = retyped.keys()
+        while True:
+            spec = {}
+            if state.last_id:
+                spec = {'_id': {'$gt': state.last_id}}
+            docs = list(collection.find(spec, fields)
+                        .sort('_id', ASCENDING).limit(self.batch_size))
+            if not docs:
+                return
+            self.recast_batch(collection, docs, casts, state)
+            state.last_id = docs[-1]['_id']
+            state.rows_done += len(docs)
+            self.save_state(state)
+
+    def migrate_columns(self, columns):
+        """
+        columns with renamed ones given their new names,
+        or None if any of them were dropped.
+        """
+        if any(column in self.diff['dropped'] for column in columns):
+            return None
+        return [self.diff['renamed'].get(column, column)
+                for column in columns]
+
+    def migrate_indexes(self):
+        """
+        The datadef's indexes with their columns renamed,
+        dropping those on a dropped column.
+        """
+        indexes = []
+        for index in self.datadef.indexes:
+            fields = self.migrate_columns(index['fields'])
+            if fields is not None:
+                index = dict(index)
+                index['fields'] = fields
+                indexes.append(index)
+        return indexes
+
+    def migrate_rollups(self):
+        """
+        The datadef's rollups with their columns renamed, dropping those
+        on a dropped column or that aren't valid with the new types.
+        """
+        rollups = []
+        for spec in self.datadef.rollups:
+            spec = dict(spec)
+            bucket_column, bucket_size = spec.get('bucket') or (None, None)
+            columns = self.migrate_columns(
+                list(spec.get('group_by', [])) + list(spec.get('sum', [])) +
+                [column for column in [bucket_column] if column])
+            if columns is None:
+                continue
+            for part in ('group_by', 'sum'):
+                if part in spec:
+                    spec[part] = columns[:len(spec[part])]
+                    columns = columns[len(spec[part]):]
+            if bucket_column:
+                spec['bucket'] = [columns[0], bucket_size]
+            try:
+                validate_rollups([spec], self.new_schema)
+            except RollupError:
+                continue
+            rollups.append(spec)
+        return rollups
+
+    def run(self):
+        """
+        Migrate the rows and then save the new schema, with its indexes
+        and rollups migrated too, returning the finished
+        SchemaMigrationState. Values that can't be converted to their
+        column's new type become None and are counted in its failures,
+        with a sample of them in its errors.
+        """
+        state = self.get_state()
+        steps = [('rename', self.rename_columns),
+                 ('drop', self.drop_columns),
+                 ('recast', self.recast_columns)]
+        for num, (stage, step) in enumerate(steps):
+            if STAGES.index(state.stage) > num:
+                continue
+            self.save_state(state, stage)
+            step(state)
+            bump_generation(self.get_collection().name)
+
+        self.datadef.indexes = self.migrate_indexes()
+        self.datadef.rollups = self.migrate_rollups()
+        self.datadef.schema = self.new_schema
+        self.datadef.save()
+        if self.datadef.rollups:
+            rebuild_rollups(self.datadef.get_data_object())
+        bump_generation(self.get_collection().name)
+        self.save_state(state, 'done')
+        return state
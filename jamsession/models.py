@@ -1,10 +1,49 @@
 import os
+import re
 import sys
+import struct
+import hashlib
+import datetime
 import logging
-import pprint
-from csv import DictReader
-from mongoengine import Document, StringField, DictField
-from jamsession.util import FIELD_TYPE_TRANSLATIONS
+import threading
+from collections import OrderedDict
+from itertools import chain, count, islice, izip
+from csv import DictReader, reader as csv_reader
+from multiprocessing import Pool
+from mongoengine import (
+    Document,
+    StringField,
+    DictField,
+    ListField,
+    IntField,
+    BooleanField,
+    DateTimeField,
+    ObjectIdField,
+    ValidationError,
+)
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+from bson import BSON
+from bson.errors import InvalidDocument, InvalidStringData
+from bson.objectid import ObjectId
+from jamsession.aggregation import Aggregation
+from jamsession.metrics import NULL_METRICS
+from jamsession.rollups import (
+    RollupError,
+    RollupTotals,
+    rebuild_rollups,
+    validate_rollups,
+)
+from jamsession.rows import iter_rows
+from jamsession.util import (
+    FIELD_TYPE_TRANSLATIONS,
+    DatetimeCaster,
+    LineReader,
+    infer_datetime_format,
+    chunked,
+    numbered_rows,
+    split_lines,
+)
 
 
 class ClassProperty(property):
@@ -38,13 +77,63 @@ class DocumentModel(Document):
     object_name = ClassProperty(object_name)
 
 
+#: Most data object classes kept by Schema.get_data_object.
+DATA_OBJECT_CACHE_SIZE = 256
+
+#: Bytes of a file hashed at a time, see CSVImporter.get_prefix_hash.
+PREFIX_HASH_BLOCK_SIZE = 1024 * 1024
+
+#: Field of the IncrementalImportState.source_id of
+#: rows written by CSVImporter.load_incremental.
+SOURCE_ID = '_source_id'
+
+#: Field of a hash of the values of rows written by
+#: CSVImporter.merge_rows, see CSVImporter.get_row_hash.
+ROW_HASH = '_row_hash'
+
+_data_objects = OrderedDict()
+_data_objects_lock = threading.Lock()
+
+#: Errors that mean rows couldn't be written, which fail an import.
+#: Values that can't be encoded as BSON, such as strings that aren't
+#: UTF-8 or ints beyond an int64, fail when they're inserted.
+WRITE_ERRORS = (ValidationError, OperationFailure, InvalidDocument,
+                InvalidStringData, OverflowError)
+
+#: The range of ints BSON can store, as an int64.
+MIN_INT64, MAX_INT64 = -2 ** 63, 2 ** 63 - 1
+
+#: Numbers with leading zeros, which infer_column_type leaves as strings.
+ZERO_PADDED = re.compile(r'^\s*[+-]?0\d')
+
+#: Marks the indexes on data collections that Schema.sync_indexes manages.
+INDEX_PREFIX = 'jamsession_'
+
+
 class Schema(DocumentModel):
     name = StringField(unique=True, required=True)
     schema = DictField(required=True)
+    # [{'fields': [column, ...], 'unique': bool}, ...]
+    indexes = ListField(DictField())
+    # See jamsession.rollups
+    rollups = ListField(DictField())
     meta = {
         'verbose_name': 'Schema'
     }
 
+    def validate(self):
+        super(Schema, self).validate()
+        try:
+            validate_rollups(self.rollups, self.schema)
+        except RollupError, e:
+            raise ValidationError(str(e))
+
+    def get_columns(self):
+        """
+        Column names in the order they're displayed and exported.
+        """
+        return sorted(self.schema.keys())
+
     def _get_data_object_fields(self):
         data_object_fields = {}
         for name, field_type in self.schema.items():
@@ -57,15 +146,153 @@ class Schema(DocumentModel):
         parts = [part.strip().capitalize() for part in self.name.split('.')]
         return ''.join(parts)
 
+    def _get_data_object_key(self):
+        contents = repr((self.name, sorted(self.schema.items()),
+                         self.rollups))
+        return (self.id, hashlib.md5(contents).hexdigest())
+
     def get_data_object(self):
+        """
+        The Document class for this schema's rows.
+
+        Classes are cached per process, by id and schema contents, so
+        repeated calls return the same class. The least recently used
+        are dropped once there are more than DATA_OBJECT_CACHE_SIZE.
+        """
+        key = self._get_data_object_key()
+        with _data_objects_lock:
+            data_object = _data_objects.pop(key, None)
+            if data_object is None:
+                data_object = self._build_data_object()
+            _data_objects[key] = data_object
+            while len(_data_objects) > DATA_OBJECT_CACHE_SIZE:
+                _data_objects.popitem(last=False)
+        return data_object
+
+    def forget_data_object(self):
+        """
+        Drop any cached data object classes for this schema.
+        """
+        with _data_objects_lock:
+            for key in _data_objects.keys():
+                if key[0] == self.id:
+                    del _data_objects[key]
+
+    def save(self, *args, **kwargs):
+        """
+        Save the schema and sync its indexes. If they can't be synced
+        the indexes it had before are saved again, or a new schema is
+        deleted, and the ValidationError is raised.
+        """
+        self.forget_data_object()
+        stored = self.id and Schema.objects(id=self.id).first()
+        result = super(Schema, self).save(*args, **kwargs)
+        try:
+            self.sync_indexes()
+        except ValidationError:
+            if stored:
+                self.indexes = stored.indexes
+                super(Schema, self).save(*args, **kwargs)
+            else:
+                self.delete()
+                self.id = None
+            raise
+        return result
+
+    def _get_index_name(self, index):
+        # Field names are unicode once loaded from the database
+        fields = [unicode(field) for field in index['fields']]
+        key = repr((fields, bool(index.get('unique'))))
+        return INDEX_PREFIX + hashlib.md5(key).hexdigest()[:16]
+
+    def sync_indexes(self):
+        """
+        Create the declared indexes on the data collection and then drop
+        any that were created here but are no longer declared.
+
+        Raises ValidationError if an index can't be created, such as a
+        unique one on a column with duplicate values, after dropping
+        those just created so the collection's indexes are unchanged.
+        """
+        collection = self.get_data_object().objects._collection
+        declared = dict((self._get_index_name(index), index)
+                        for index in self.indexes)
+        existing = collection.index_information()
+
+        created = []
+        for name, index in declared.items():
+            if name in existing:
+                continue
+            try:
+                collection.create_index(
+                    [(field, ASCENDING) for field in index['fields']],
+                    name=name,
+                    unique=bool(index.get('unique')))
+                error = collection.database.error()
+            except OperationFailure, e:
+                error = {'err': str(e)}
+            if error:
+                for created_name in created:
+                    collection.drop_index(created_name)
+                raise ValidationError(
+                    "Couldn't create index on %s: %s"
+                    % (', '.join(index['fields']), error['err']))
+            created.append(name)
+        for name in existing:
+            if name.startswith(INDEX_PREFIX) and name not in declared:
+                collection.drop_index(name)
+
+    def delete(self, *args, **kwargs):
+        self.forget_data_object()
+        return super(Schema, self).delete(*args, **kwargs)
+
+    def _build_data_object(self):
         self.validate()
         data_object_fields = self._get_data_object_fields()
+        collection_name = self._get_data_object_name()
+        # The class keeps these even if this Schema is changed later
+        name = self.name
+        columns = list(self.schema)
+        rollups = list(self.rollups)
 
         def data_object_repr(obj):
-            return u"<%s: %s>" % (obj.__class__, self.name)
+            return u"<%s: %s>" % (obj.__class__, name)
         data_object_fields['__repr__'] = data_object_repr
+
+        def data_object_aggregate(cls):
+            return Aggregation(cls)
+        data_object_fields['aggregate'] = classmethod(data_object_aggregate)
+
+        def data_object_rows(cls, *columns, **kwargs):
+            return iter_rows(cls, columns, **kwargs)
+        data_object_fields['rows'] = classmethod(data_object_rows)
+
+        def data_object_save(obj, *args, **kwargs):
+            from jamsession.cache import bump_generation
+            created = obj.id is None
+            result = DocumentModel.save(obj, *args, **kwargs)
+            if created and rollups:
+                RollupTotals(obj.__class__).add([obj.to_row()]).save()
+            bump_generation(collection_name)
+            return result
+        data_object_fields['save'] = data_object_save
+
+        def data_object_delete(obj, *args, **kwargs):
+            from jamsession.cache import bump_generation
+            DocumentModel.delete(obj, *args, **kwargs)
+            if rollups:
+                RollupTotals(obj.__class__).add([obj.to_row()],
+                                                sign=-1).save()
+            bump_generation(collection_name)
+        data_object_fields['delete'] = data_object_delete
+
+        def data_object_to_row(obj):
+            return dict((column, getattr(obj, column)) for column in columns)
+        data_object_fields['to_row'] = data_object_to_row
+        data_object_fields['_rollups'] = rollups
+        data_object_fields['_schema_id'] = str(self.id)
         data_object_fields['meta'] = {
-            'collection': self._get_data_object_name()}
+            'collection': collection_name}
 
         return type(
             self._get_data_object_name(),
@@ -73,18 +300,264 @@ class Schema(DocumentModel):
             data_object_fields,)
 
 
+class SchemaMigrationState(DocumentModel):
+    """
+    Progress of a jamsession.migration.SchemaMigration, kept so an
+    interrupted migration can pick up where it left off.
+    """
+    schema_id = StringField(required=True)
+    old_schema = DictField(required=True)
+    new_schema = DictField(required=True)
+    renames = DictField()
+    stage = StringField(required=True)
+    last_id = ObjectIdField()
+    rows_done = IntField(default=0)
+    failures = IntField(default=0)
+    errors = ListField(StringField())
+    started = DateTimeField()
+    updated = DateTimeField()
+    meta = {
+        'verbose_name': 'Schema migration'
+    }
+
+
+class ImportCheckpoint(DocumentModel):
+    """
+    Progress of a resumable CSVImporter.load: the byte offset and line
+    number just past the last batch of datafile written, kept so an
+    interrupted import can pick up where it left off.
+    """
+    schema_id = StringField(required=True)
+    datafile = StringField(required=True)
+    header_hash = StringField(required=True)
+    offset = IntField(required=True)
+    line_num = IntField(default=0)
+    rows_done = IntField(default=0)
+    started = DateTimeField()
+    updated = DateTimeField()
+    meta = {
+        'verbose_name': 'Import checkpoint'
+    }
+
+    #: Highest line number a row id can be made for.
+    MAX_LINE_NUM = 0xffffffff
+
+    def get_row_id(self, line_num):
+        """
+        The id of the row starting on line_num of datafile. Ids begin
+        with the time this checkpoint was created, then 4 bytes unique
+        to it, and end with the line number, so rows sort in file order
+        and a resumed import gives a row the same id again.
+        """
+        oid = str(self.id).decode('hex')
+        prefix = oid[:4] + hashlib.md5(oid).digest()[:4]
+        return ObjectId(prefix + struct.pack('>I', line_num))
+
+    def discard(self):
+        """
+        Remove every row written by this import, and the checkpoint.
+        """
+        datadef = Schema.objects(id=self.schema_id).first()
+        if datadef:
+            collection = datadef.get_data_object().objects._collection
+            collection.remove({'_id': {
+                '$gte': self.get_row_id(0),
+                '$lte': self.get_row_id(self.MAX_LINE_NUM)}}, safe=True)
+        self.delete()
+
+
+class IncrementalImportState(DocumentModel):
+    """
+    How much of datafile an incremental CSVImporter.load has written
+    into a schema: the rows_done rows of its first offset bytes, up to
+    line line_num, which hash to prefix_hash. The next incremental load
+    only reads past them if they haven't changed. The rows are tagged
+    with source_id in their SOURCE_ID field.
+    """
+    schema_id = StringField(required=True)
+    datafile = StringField(required=True)
+    header_hash = StringField(required=True)
+    prefix_hash = StringField(required=True)
+    source_id = StringField(required=True)
+    offset = IntField(required=True)
+    line_num = IntField(default=0)
+    rows_done = IntField(default=0)
+    updated = DateTimeField()
+    meta = {
+        'verbose_name': 'Incremental import'
+    }
+
+
+class ImportJob(DocumentModel):
+    """
+    A CSV file waiting to be, or being, loaded in the background by
+    jamsession_import_worker. See jamsession.jobs.
+    """
+    STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+    datafile = StringField(required=True)
+    schema_id = StringField()
+    status = StringField(required=True, default='queued')
+    cancelled = BooleanField(default=False)
+    attempts = IntField(default=0)
+    max_attempts = IntField(default=3)
+    worker = StringField()
+    error = StringField()
+    checkpoint_id = StringField()
+    rows_done = IntField(default=0)
+    bytes_done = IntField(default=0)
+    total_bytes = IntField(default=0)
+    #: Rows and bytes already done when the current attempt started.
+    resumed_rows = IntField(default=0)
+    resumed_bytes = IntField(default=0)
+    created = DateTimeField()
+    started = DateTimeField()
+    updated = DateTimeField()
+    finished = DateTimeField()
+    meta = {
+        'verbose_name': 'Import job'
+    }
+
+    @property
+    def percent_complete(self):
+        if self.status == 'done':
+            return 100.0
+        if not self.total_bytes:
+            return 0.0
+        return 100.0 * self.bytes_done / self.total_bytes
+
+    @property
+    def elapsed(self):
+        if not self.started:
+            return None
+        return (self.finished or self.updated or self.started) - self.started
+
+    def _seconds_elapsed(self):
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0
+        return elapsed.days * 86400 + elapsed.seconds + \
+            elapsed.microseconds / 1e6
+
+    @property
+    def rows_per_second(self):
+        seconds = self._seconds_elapsed()
+        if not seconds:
+            return None
+        return (self.rows_done - self.resumed_rows) / seconds
+
+    @property
+    def eta(self):
+        """
+        Estimated time left, as a timedelta, from how fast
+        the current attempt has been getting through the file.
+        """
+        if self.status != 'running':
+            return None
+        seconds = self._seconds_elapsed()
+        progress = self.bytes_done - self.resumed_bytes
+        if not seconds or progress <= 0:
+            return None
+        remaining = max(self.total_bytes - self.bytes_done, 0)
+        return datetime.timedelta(seconds=seconds * remaining / progress)
+
+
 class ImportFailed(Exception):
+    """
+    row_errors is a list of (line number, row, errors) for the first
+    rows that couldn't be converted, error_count the total number of
+    them, and column_errors maps column names to how many of their
+    values couldn't be converted.
+    """
     row_errors = []
+    error_count = 0
+    column_errors = {}
 
 
 class ImportConversionFailed(Exception):
     errors = []
+    columns = []
+
+
+class RowErrors(object):
+    """
+    The rows of an import that couldn't be converted. Every failure
+    is counted, in total and by column, but only the first sample_size
+    rows are kept. Once max_errors is reached the import gives up.
+    """
+    def __init__(self, sample_size=100, max_errors=None):
+        self.sample_size = sample_size
+        self.max_errors = max_errors
+        self.count = 0
+        self.sample = []
+        self.column_counts = {}
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def limit_reached(self):
+        return bool(self.max_errors) and self.count >= self.max_errors
+
+    def add(self, line_num, row, errors, columns=()):
+        self.count += 1
+        for column in columns:
+            self.column_counts[column] = \
+                self.column_counts.get(column, 0) + 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append((line_num, row, errors))
+
+    def merge(self, other, line_offset=0):
+        """
+        Add in the errors of another RowErrors, shifting
+        their line numbers by line_offset.
+        """
+        self.count += other.count
+        for column, count in other.column_counts.items():
+            self.column_counts[column] = \
+                self.column_counts.get(column, 0) + count
+        for line_num, row, errors in other.sample:
+            if len(self.sample) >= self.sample_size:
+                break
+            self.sample.append((line_offset + line_num, row, errors))
 
 
 class CSVImporter(object):
-    def __init__(self):
+    #: Number of leading rows used to infer things about each column,
+    #: such as its type or the format of its dates.
+    sample_size = 1000
+
+    TRUE_VALUES = ('true', 't', 'yes', 'y')
+    FALSE_VALUES = ('false', 'f', 'no', 'n')
+
+    def __init__(self, batch_size=5000, max_errors=None,
+                 error_sample_size=100, progress=None, metrics=None,
+                 columnar=False):
+        """
+        batch_size is the number of rows written per bulk insert.
+        Pass None to save each row with its own Obj.objects.create call.
+
+        An import stops early once max_errors rows have failed to
+        convert, and reports at most error_sample_size of them.
+
+        progress, if given, is called with the ImportCheckpoint of a
+        resumable import every time it's saved.
+
+        metrics, a jamsession.metrics.ImportMetrics, times each stage
+        of an import. Its summary is logged when a load finishes.
+
+        With columnar=True rows are cast a batch at a time, column by
+        column, see prepare_columns.
+        """
         super(CSVImporter, self).__init__()
         self.logger = logging.getLogger("jamsession.CSVImporter")
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.error_sample_size = error_sample_size
+        self.progress = progress
+        self.metrics = metrics or NULL_METRICS
+        self.columnar = columnar
+        self._row_converters = {}
 
     @property
     def converters(self):
@@ -94,9 +567,17 @@ class CSVImporter(object):
             'email': str,
             'int': int,
             'float': float,
-            'bool': bool,
+            'bool': self.cast_bool,
             'datetime': self.cast_datetime, }
 
+    def cast_bool(self, value):
+        lowered = value.strip().lower()
+        if lowered in self.TRUE_VALUES or lowered == '1':
+            return True
+        if lowered in self.FALSE_VALUES or lowered == '0':
+            return False
+        raise ValueError("%s isn't a boolean" % value)
+
     def cast_datetime(self, value):
         from dateutil.parser import parse
         return parse(value)
@@ -106,20 +587,149 @@ class CSVImporter(object):
             return None
         return self.converters[typehint](value)
 
+    def get_datetime_caster(self, samples):
+        """
+        Cast function for a datetime column, given sample values from it.
+        """
+        return DatetimeCaster(samples)
+
+    def compile_casts(self, columns, schema, samples=()):
+        """
+        (name, type, cast function) for each of columns. samples, a
+        list of raw rows, is used to tune the cast functions to the
+        data, e.g. to pick a date format.
+        """
+        converters = self.converters
+        casts = []
+        for position, column in enumerate(columns):
+            name = column.strip()
+            typehint = schema[name]
+            if typehint == 'datetime':
+                cast = self.get_datetime_caster(
+                    [row[position] for row in samples if len(row) > position])
+            else:
+                cast = converters[typehint]
+            casts.append((name, typehint, cast))
+        return casts
+
+    def compile_row_converter(self, columns, schema, samples=()):
+        """
+        Build a function that converts a list of raw values, in the
+        order of columns, into a dictionary of cast values.
+
+        Column names and cast functions are looked up once here rather
+        than for every cell, see compile_casts.
+        """
+        casts = [(name, typehint,
+                  self.metrics.timed('cast.%s' % typehint, cast))
+                 for name, typehint, cast
+                 in self.compile_casts(columns, schema, samples)]
+        num_columns = len(casts)
+
+        def convert_row(values):
+            if len(values) < num_columns:
+                values = values + [None] * (num_columns - len(values))
+            cast_row = {}
+            errors = []
+            error_columns = []
+            for (name, typehint, cast), value in izip(casts, values):
+                if value in ('', None):
+                    cast_row[name] = None
+                    continue
+                try:
+                    cast_row[name] = cast(value)
+                except (TypeError, ValueError):
+                    errors.append("Couldn't convert < %s > to %s"
+                                  % (value, typehint))
+                    error_columns.append(name)
+            if len(values) > num_columns:
+                errors.append("Expected %s columns, got %s"
+                              % (num_columns, len(values)))
+            if errors:
+                exc = ImportConversionFailed(
+                    "Couldn't convert row %s" % values)
+                exc.errors = errors
+                exc.columns = error_columns
+                raise exc
+            return cast_row
+        return convert_row
+
+    def get_row_converter(self, columns, schema):
+        """
+        Cached compile_row_converter, keyed on the columns and schema.
+        """
+        key = (tuple(columns), tuple(sorted(schema.items())))
+        if key not in self._row_converters:
+            self._row_converters[key] = \
+                self.compile_row_converter(columns, schema)
+        return self._row_converters[key]
+
     def prepare_row(self, row, schema):
-        cast_row = {}
-        errors = []
-        for key in row.keys():
+        columns = row.keys()
+        convert_row = self.get_row_converter(columns, schema)
+        return convert_row([row[column] for column in columns])
+
+    def infer_column_type(self, values):
+        """
+        The narrowest of int, float, bool, datetime or string
+        that every non-blank value in values fits.
+
+        Numbers with leading zeros, like codes, stay strings so the
+        zeros aren't lost, as do ints too big for a BSON int64.
+        """
+        values = [value for value in values if value not in ('', None)]
+        if not values:
+            return 'string'
+        if not any(ZERO_PADDED.match(value) for value in values):
             try:
-                cast_row[key] = self.cast_value(row[key], schema[key])
-            except TypeError:
-                errors.append("Couldn't convert < %s > to %s"
-                              % (row[key], schema[key]))
-        if errors:
-            exc = ImportConversionFailed("Couldn't convert row %s" % row)
-            exc.errors = errors
-            raise exc
-        return cast_row
+                if all(MIN_INT64 <= int(value) <= MAX_INT64
+                       for value in values):
+                    return 'int'
+                return 'string'
+            except ValueError:
+                pass
+            try:
+                for value in values:
+                    float(value)
+                return 'float'
+            except ValueError:
+                pass
+        bools = self.TRUE_VALUES + self.FALSE_VALUES
+        if all(value.strip().lower() in bools for value in values):
+            return 'bool'
+        if infer_datetime_format(values):
+            return 'datetime'
+        return 'string'
+
+    def infer_types(self, columns, samples):
+        """
+        A schema for columns with a type inferred from each
+        column's values in samples, a list of raw rows.
+        """
+        schema = {}
+        for position, column in enumerate(columns):
+            values = [row[position] for row in samples if len(row) > position]
+            schema[column.strip()] = self.infer_column_type(values)
+        return schema
+
+    def get_new_schema(self, datafile, columns, samples, infer_types=True):
+        if infer_types:
+            schema = self.infer_types(columns, samples)
+        else:
+            schema = dict((name.strip(), 'string') for name in columns)
+        datadef = Schema(name=os.path.basename(datafile), schema=schema)
+        self.logger.info("New schema %s for %s" % (schema, datafile))
+        return datadef
+
+    def infer_schema(self, datafile):
+        """
+        The Schema load would create for datafile, without saving it.
+        Only the first sample_size rows are read.
+        """
+        reader = csv_reader(open(datafile, 'rb'))
+        columns = reader.next()
+        samples = list(islice(reader, self.sample_size))
+        return self.get_new_schema(datafile, columns, samples)
 
     def check_columns(self, reader, datadef):
         # First do the columns even match?
@@ -138,51 +748,1049 @@ class CSVImporter(object):
                 msg = '\n'.join(msg)
                 raise ImportFailed(msg)
 
-    def load(self, datafile, datadef=None):
+    def prepare_rows(self, rows, columns, convert_row, row_errors,
+                     with_line_nums=False):
         """
-        Read a CSV file into a new (all-strings) schema.
-        Optionally accepts an existing DataSetDefinition.
+        Lazily cast each of rows, (line number, values) pairs with the
+        values in the order of columns, with convert_row. Rows that
+        can't be converted are skipped and recorded in row_errors, a
+        RowErrors, and once it's reached its limit no more are read.
+
+        With with_line_nums=True (line number, cast row) pairs are
+        yielded instead of just the cast rows.
+        """
+        convert_row = self.metrics.timed('prepare_row', convert_row)
+        for line_num, row in rows:
+            if not row:
+                continue
+            try:
+                if with_line_nums:
+                    yield line_num, convert_row(row)
+                else:
+                    yield convert_row(row)
+            except ImportConversionFailed, e:
+                self.metrics.incr('row_errors')
+                row_errors.add(line_num, dict(izip(columns, row)),
+                               e.errors, e.columns)
+                if row_errors.limit_reached:
+                    return
+
+    def cast_column(self, values, cast):
+        """
+        Cast a column of raw values, blanks becoming None, in a single
+        pass unless something in it can't be cast. Returns the cast
+        values and a dictionary of the index of each value that
+        couldn't be cast, which becomes None, to the value.
+        """
+        try:
+            if '' in values or None in values:
+                return [cast(value) if value else None
+                        for value in values], {}
+            return map(cast, values), {}
+        except (TypeError, ValueError):
+            pass
+        cast_values = []
+        failures = {}
+        for index, value in enumerate(values):
+            if value in ('', None):
+                cast_values.append(None)
+                continue
+            try:
+                cast_values.append(cast(value))
+            except (TypeError, ValueError):
+                cast_values.append(None)
+                failures[index] = value
+        return cast_values, failures
+
+    def prepare_columns(self, rows, columns, casts, row_errors,
+                        with_line_nums=False):
+        """
+        Like prepare_rows, but rows are read a batch at a time and
+        each column of the batch cast at once by cast_column, with
+        casts from compile_casts. A row's dictionary isn't built until
+        it's asked for. Rows come out, and errors are recorded, just as
+        they would be by prepare_rows.
+        """
+        names = [name for name, typehint, cast in casts]
+        num_columns = len(casts)
+        for batch in chunked(rows, self.batch_size or 1):
+            line_nums = []
+            originals = []
+            padded = []
+            errors = {}
+            for line_num, row in batch:
+                if not row:
+                    continue
+                if len(row) > num_columns:
+                    errors[len(padded)] = [
+                        (num_columns, "Expected %s columns, got %s"
+                         % (num_columns, len(row)), None)]
+                line_nums.append(line_num)
+                originals.append(row)
+                if len(row) < num_columns:
+                    row = row + [None] * (num_columns - len(row))
+                padded.append(row)
+            if not padded:
+                continue
+
+            with self.metrics.timer('prepare_columns', len(padded)):
+                cast_columns = []
+                for position, (values, (name, typehint, cast)) in \
+                        enumerate(izip(izip(*padded), casts)):
+                    with self.metrics.timer('cast.%s' % typehint,
+                                            len(values)):
+                        values, failures = self.cast_column(values, cast)
+                    for index, value in failures.items():
+                        errors.setdefault(index, []).append(
+                            (position, "Couldn't convert < %s > to %s"
+                             % (value, typehint), name))
+                    cast_columns.append(values)
+
+            for index, cast_row in enumerate(izip(*cast_columns)):
+                if index in errors:
+                    error_list = sorted(errors[index])
+                    self.metrics.incr('row_errors')
+                    row_errors.add(
+                        line_nums[index],
+                        dict(izip(columns, originals[index])),
+                        [message for position, message, name
+                         in error_list],
+                        [name for position, message, name
+                         in error_list if name])
+                    if row_errors.limit_reached:
+                        return
+                    continue
+                values = dict(izip(names, cast_row))
+                if with_line_nums:
+                    yield line_nums[index], values
+                else:
+                    yield values
+
+    def get_rows_caster(self, columns, schema, samples=()):
+        """
+        A function that lazily casts (line number, values) pairs with
+        prepare_columns if the importer is columnar, or else a row
+        converter and prepare_rows.
+        """
+        if self.columnar:
+            casts = self.compile_casts(columns, schema, samples)
+
+            def prepare(rows, row_errors, with_line_nums=False):
+                return self.prepare_columns(rows, columns, casts,
+                                            row_errors, with_line_nums)
+        else:
+            convert_row = self.compile_row_converter(columns, schema,
+                                                     samples)
+
+            def prepare(rows, row_errors, with_line_nums=False):
+                return self.prepare_rows(rows, columns, convert_row,
+                                         row_errors, with_line_nums)
+        return prepare
+
+    def cast_rows(self, rows, columns, schema, row_errors,
+                  with_line_nums=False):
+        """
+        Lazily cast rows with casts for schema tuned on the first
+        sample_size of them. See get_rows_caster.
+        """
+        head = list(islice(rows, self.sample_size))
+        prepare = self.get_rows_caster(
+            columns, schema, samples=[row for line_num, row in head])
+        return prepare(chain(head, rows), row_errors, with_line_nums)
+
+    def get_row_errors(self):
+        return RowErrors(sample_size=self.error_sample_size,
+                         max_errors=self.max_errors)
+
+    def raise_row_errors(self, row_errors):
+        if row_errors:
+            if row_errors.limit_reached:
+                msg = "Gave up importing file after %s rows had errors"
+            else:
+                msg = "Failed to import entire file, %s rows had errors"
+            exc = ImportFailed(msg % row_errors.count)
+            exc.row_errors = row_errors.sample
+            exc.error_count = row_errors.count
+            exc.column_errors = row_errors.column_counts
+            raise exc
+
+    def get_header_hash(self, datafile, header_offset):
+        datafile = open(datafile, 'rb')
+        try:
+            return hashlib.md5(datafile.read(header_offset)).hexdigest()
+        finally:
+            datafile.close()
+
+    def get_checkpoint(self, datafile, header_hash, datadef=None):
+        """
+        The ImportCheckpoint of an unfinished resumable import of
+        datafile, with the same header, into datadef if it's given.
+        """
+        query = {'datafile': os.path.abspath(datafile),
+                 'header_hash': header_hash}
+        if datadef:
+            query['schema_id'] = str(datadef.id)
+        return ImportCheckpoint.objects(**query).first()
+
+    def save_checkpoint(self, checkpoint):
+        checkpoint.updated = datetime.datetime.now()
+        checkpoint.save()
+        if self.progress:
+            self.progress(checkpoint)
+
+    def load(self, datafile, datadef=None, stream=False, processes=None,
+             validate_only=False, infer_types=True, resumable=False,
+             key_columns=None, incremental=False):
+        """
+        Read a CSV file into a new schema, with column types inferred
+        from the first sample_size rows (or all strings if infer_types
+        is False). Optionally accepts an existing DataSetDefinition.
 
         If the entire CSV can not be loaded, the operation will
         be aborted and an ImportFailed exception will be raised.
+
+        With stream=True rows are parsed, cast and written a batch
+        at a time, so memory use doesn't grow with the size of the file.
+        They go through a staging collection if the data object's is
+        empty, otherwise straight into it. See stream_rows.
+
+        With processes greater than 1 the file is split up and cast
+        by a pool of that many worker processes. See load_parallel.
+
+        With validate_only=True every row is cast and validated but
+        nothing, not even a new schema, is saved. The number of rows
+        that would have been written is returned.
+
+        With resumable=True rows are written straight into the data
+        object's collection a batch at a time, with a checkpoint after
+        each one. If a resumable import of the same file was interrupted
+        it carries on from its last checkpoint. See load_resumable.
+
+        With key_columns, a list of column names, rows are merged into
+        the data object's collection instead of added to it: rows whose
+        key is new are inserted, those whose values have changed replace
+        the existing row and the rest are skipped. stream, processes and
+        resumable are ignored. See merge_rows.
+
+        With incremental=True, for files that are only ever appended to,
+        only the rows added since datafile was last loaded into the same
+        schema incrementally are written. If anything before them has
+        changed, every row is loaded again in place of the collection's.
+        stream, processes and resumable are ignored, as is incremental
+        with key_columns. See load_incremental.
+
+        A new schema is deleted again if the load fails before any of its
+        rows were written, so it can be retried once the file is fixed.
+
+        Returns (datadef, number of rows written). If the importer has
+        metrics their summary is logged once the load is over, whether
+        or not it succeeded.
         """
-        reader = DictReader(file(datafile, 'r'))
+        created = []
+        try:
+            return self._load(datafile, datadef, stream, processes,
+                              validate_only, infer_types, resumable,
+                              key_columns, incremental, created)
+        except:
+            for new_datadef in created:
+                self.discard_new_schema(new_datadef)
+            raise
+        finally:
+            if self.metrics.enabled:
+                self.logger.info("Import of %s:\n%s"
+                                 % (datafile, self.metrics.format_summary()))
+
+    def discard_new_schema(self, datadef):
+        """
+        Delete datadef, a schema created by a failed load, unless
+        some of its rows were written before it failed.
+        """
+        if datadef.get_data_object().objects.count():
+            return
+        self.logger.info("Deleting new schema %s" % datadef.name)
+        datadef.delete()
+
+    def _load(self, datafile, datadef, stream, processes, validate_only,
+              infer_types, resumable, key_columns, incremental, created):
+        lines = LineReader(open(datafile, 'rb'))
+        reader = DictReader(lines)
+        columns = reader.fieldnames
+        header_offset, header_lines = lines.offset, lines.line_num
+        # Resumable, incremental and parallel loads read the file again,
+        # so the sample isn't timed as part of the read that's written
+        rows = numbered_rows(reader.reader)
+        head = list(self.metrics.timed_iter(
+            'sample', islice(rows, self.sample_size)))
+        rows = chain(head, self.metrics.timed_iter('read', rows))
+
+        incremental = incremental and not validate_only and not key_columns
+        resumable = (resumable and not validate_only and not key_columns
+                     and not incremental)
+        checkpoint = state = None
+        if resumable or incremental:
+            header_hash = self.get_header_hash(datafile, header_offset)
+        if incremental:
+            state = self.get_incremental_state(datafile, header_hash,
+                                               datadef)
+            if state and not datadef:
+                datadef = Schema.objects(id=state.schema_id).first()
+                if not datadef:
+                    state.delete()
+                    state = None
+        if resumable:
+            checkpoint = self.get_checkpoint(datafile, header_hash, datadef)
+            if checkpoint and not datadef:
+                datadef = Schema.objects(id=checkpoint.schema_id).first()
+                if not datadef:
+                    checkpoint.delete()
+                    checkpoint = None
 
         if not datadef:
-            schema = [(name.strip(), 'string') for name in reader.fieldnames]
-            datadef = Schema.objects.create(
-                name=os.path.basename(datafile),
-                schema=dict(schema))
-            datadef.save()
+            datadef = self.get_new_schema(
+                datafile, reader.fieldnames,
+                [row for line_num, row in head], infer_types)
+            if not validate_only:
+                datadef.save()
+                created.append(datadef)
+
+        with self.metrics.timer('check_columns'):
+            self.check_columns(reader, datadef)
+        for column in key_columns or ():
+            if column not in datadef.schema:
+                raise ImportFailed("Key column %s isn't in the schema"
+                                   % column)
+
+        Obj = datadef.get_data_object()
+
+        if incremental:
+            num_created = self.load_incremental(
+                datafile, header_hash, header_offset, header_lines, columns,
+                datadef, [row for line_num, row in head], state)
+            return (datadef, num_created)
+
+        if resumable:
+            num_created = self.load_resumable(
+                datafile, header_hash, header_offset, header_lines, columns,
+                datadef, [row for line_num, row in head], checkpoint)
+            return (datadef, num_created)
+
+        if processes > 1 and not validate_only and not key_columns:
+            num_created = self.load_parallel(
+                datafile, header_offset, header_lines, columns, datadef,
+                processes)
+            return (datadef, num_created)
+
+        row_errors = self.get_row_errors()
+        rows = self.cast_rows(rows, reader.fieldnames, datadef.schema,
+                              row_errors, with_line_nums=True)
+        if key_columns:
+            rows = self.check_row_keys(rows, key_columns, row_errors)
+
+        if validate_only:
+            return (datadef, self.validate_rows(Obj, rows, row_errors))
+        rows = (values for line_num, values in rows)
 
-        self.check_columns(reader, datadef)
+        if stream and not key_columns:
+            return (datadef, self.stream_rows(Obj, rows, row_errors))
 
+        values = list(rows)
+        self.raise_row_errors(row_errors)
+
+        if key_columns:
+            num_created = self.merge_rows(Obj, values, key_columns)
+        elif self.batch_size:
+            num_created = self.insert_rows(Obj, values)
+        else:
+            num_created = self.create_rows(Obj, values)
+
+        return (datadef, num_created)
+
+    def load_resumable(self, datafile, header_hash, start, start_line,
+                       columns, datadef, samples, checkpoint=None):
+        """
+        Write the rows of datafile from byte start (which is line
+        start_line) into datadef's collection a batch at a time, saving
+        an ImportCheckpoint after each batch.
+
+        Given the checkpoint of an interrupted import, reading starts
+        from it instead, once any rows written after it are removed.
+        Since every row's id comes from the checkpoint and its line
+        number, see ImportCheckpoint.get_row_id, that finds them all
+        and no row is written twice.
+
+        Rows that fail to convert are reported once the rest of the
+        file has been read, and nothing after them is written, so
+        the import can be resumed once they're fixed. Rollups are
+        rebuilt when every row is in. Returns the number of rows of
+        datafile written, including those of earlier runs.
+        """
         Obj = datadef.get_data_object()
-        logging.debug(type(Obj))
-        logging.debug(dir(Obj))
-        logging.debug(Obj._class_name)
-        row_errors = []
-        values = []
-        for row in reader:
+        collection = Obj.objects._collection
+        if checkpoint:
+            self.logger.info("Resuming import of %s from line %s"
+                             % (datafile, checkpoint.line_num))
+            collection.remove({'_id': {
+                '$gt': checkpoint.get_row_id(checkpoint.line_num),
+                '$lte': checkpoint.get_row_id(
+                    ImportCheckpoint.MAX_LINE_NUM)}}, safe=True)
+            self.save_checkpoint(checkpoint)
+        else:
+            checkpoint = ImportCheckpoint(
+                schema_id=str(datadef.id),
+                datafile=os.path.abspath(datafile),
+                header_hash=header_hash,
+                offset=start,
+                line_num=start_line,
+                started=datetime.datetime.now())
+            self.save_checkpoint(checkpoint)
+
+        prepare = self.get_rows_caster(columns, datadef.schema, samples)
+        row_errors = self.get_row_errors()
+        lines = LineReader(open(datafile, 'rb'), checkpoint.offset)
+        line_offset = checkpoint.line_num
+        rows = ((line_offset + line_num, row) for line_num, row
+                in self.metrics.timed_iter(
+                    'read', numbered_rows(csv_reader(lines))))
+        try:
+            for batch in chunked(rows, self.batch_size or 1):
+                batch = list(prepare(batch, row_errors, with_line_nums=True))
+                if row_errors.limit_reached:
+                    break
+                if row_errors:
+                    continue
+                docs = self.get_documents(
+                    Obj, [values for line_num, values in batch])
+                for (line_num, values), doc in izip(batch, docs):
+                    doc['_id'] = checkpoint.get_row_id(line_num)
+                if docs:
+                    with self.metrics.timer('insert', len(docs)):
+                        collection.insert(docs, safe=True)
+                checkpoint.offset = lines.offset
+                checkpoint.line_num = line_offset + lines.line_num
+                checkpoint.rows_done += len(docs)
+                self.save_checkpoint(checkpoint)
+        except WRITE_ERRORS, e:
+            raise ImportFailed("Failed to import entire file: %s" % e)
+        finally:
+            lines.fileobj.close()
+            self.invalidate(collection)
+        self.raise_row_errors(row_errors)
+
+        if Obj._rollups:
+            rebuild_rollups(Obj)
+        checkpoint.delete()
+        return checkpoint.rows_done
+
+    def get_incremental_state(self, datafile, header_hash, datadef=None):
+        """
+        The IncrementalImportState of datafile's last incremental load
+        into datadef or, if it isn't given, of one with the same header
+        into any schema.
+        """
+        query = {'datafile': os.path.abspath(datafile)}
+        if datadef:
+            query['schema_id'] = str(datadef.id)
+        else:
+            query['header_hash'] = header_hash
+        return IncrementalImportState.objects(**query).first()
+
+    def hash_prefix(self, datafile, end):
+        """
+        An md5 object that's hashed the first end bytes of datafile.
+        """
+        digest = hashlib.md5()
+        datafile = open(datafile, 'rb')
+        try:
+            remaining = end
+            while remaining > 0:
+                block = datafile.read(min(remaining, PREFIX_HASH_BLOCK_SIZE))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+        finally:
+            datafile.close()
+        return digest
+
+    def find_tail(self, datafile, state):
+        """
+        The byte offset of the first row of datafile added since the
+        load recorded by state, an IncrementalImportState, and an md5
+        object that's hashed every byte before it. The offset is None
+        if any of the rows that load read have changed since.
+        """
+        if os.path.getsize(datafile) < state.offset:
+            return None, None
+        digest = self.hash_prefix(datafile, state.offset)
+        if digest.hexdigest() != state.prefix_hash:
+            return None, None
+        datafile = open(datafile, 'rb')
+        try:
+            datafile.seek(state.offset - 1)
+            if datafile.read(1) == '\n':
+                return state.offset, digest
+            # The last row loaded had no line ending. It's still the
+            # same row if the next thing added to the file was one.
+            following = datafile.read(2)
+        finally:
+            datafile.close()
+        if following != '\r\n':
+            following = following[:1]
+        if following and following not in '\r\n':
+            return None, None
+        digest.update(following)
+        return state.offset + len(following), digest
+
+    def load_incremental(self, datafile, header_hash, start, start_line,
+                         columns, datadef, samples, state=None):
+        """
+        Write the rows of datafile, from byte start (which is line
+        start_line), that weren't written by the incremental load
+        recorded by state into datadef's collection, then record how
+        far this load got in an IncrementalImportState.
+
+        Rows are tagged with the state's source_id. If the header or
+        any of the rows loaded before have changed, every row of
+        datafile is written again under a new source_id, and once
+        they're in, those under the old one are removed. Rows from
+        other files are left alone.
+
+        Rows are written as in stream_rows, so nothing is if any fail
+        to convert. Returns the number of rows written.
+        """
+        Obj = datadef.get_data_object()
+        collection = Obj.objects._collection
+        old_source_id = digest = None
+        if state:
+            if state.header_hash == header_hash:
+                tail, digest = self.find_tail(datafile, state)
+            if digest is None:
+                self.logger.info("%s has changed since it was last loaded, "
+                                 "replacing its rows" % datafile)
+                old_source_id = state.source_id
+                state.source_id = str(ObjectId())
+                state.rows_done = 0
+            else:
+                start, start_line = tail, state.line_num
+        else:
+            state = IncrementalImportState(schema_id=str(datadef.id),
+                                           datafile=os.path.abspath(datafile),
+                                           source_id=str(ObjectId()))
+        if digest is None:
+            digest = self.hash_prefix(datafile, start)
+
+        def hashed(lines):
+            for line in lines:
+                digest.update(line)
+                yield line
+
+        prepare = self.get_rows_caster(columns, datadef.schema, samples)
+        row_errors = self.get_row_errors()
+        lines = LineReader(open(datafile, 'rb'), start)
+        rows = ((start_line + line_num, row) for line_num, row
+                in self.metrics.timed_iter(
+                    'read', numbered_rows(csv_reader(hashed(lines)))))
+        totals = RollupTotals(Obj)
+        removed = []
+
+        def write(staging):
+            num_created = self.write_batches(
+                Obj, prepare(rows, row_errors), staging, row_errors, totals,
+                {SOURCE_ID: state.source_id})
+            if old_source_id and not row_errors:
+                # Before the new rows are swapped in, so they can't
+                # clash with the old ones on a unique index
+                collection.remove({SOURCE_ID: old_source_id}, safe=True)
+                removed.append(old_source_id)
+            return num_created
+        try:
+            num_created = self.write_staged(collection, write, row_errors)
+        except:
+            if removed and state.id:
+                # The next load has to start from scratch
+                state.delete()
+            raise
+        finally:
+            lines.fileobj.close()
+        if removed and Obj._rollups:
+            rebuild_rollups(Obj)
+        else:
+            totals.save()
+
+        state.header_hash = header_hash
+        state.offset = lines.offset
+        state.prefix_hash = digest.hexdigest()
+        state.line_num = start_line + lines.line_num
+        state.rows_done += num_created
+        state.updated = datetime.datetime.now()
+        state.save()
+        return num_created
+
+    def load_parallel(self, datafile, start, start_line, columns, datadef,
+                      processes):
+        """
+        Split the rest of datafile, from byte start (which is line
+        start_line), into ranges of whole records and load each one into
+        a staging collection from a pool of worker processes with
+        load_chunk.
+
+        Row errors from every range are reported with their line
+        numbers in the whole file. The staging collection is swapped
+        in, or dropped, as in stream_rows. Workers don't share the
+        importer's metrics, only the stages run here are timed.
+        """
+        Obj = datadef.get_data_object()
+        collection = Obj.objects._collection
+        chunks = split_lines(datafile, start, processes * 4)
+        row_errors = self.get_row_errors()
+        totals = RollupTotals(Obj)
+        options = {'batch_size': self.batch_size,
+                   'max_errors': self.max_errors,
+                   'error_sample_size': self.error_sample_size,
+                   'columnar': self.columnar}
+
+        def write(staging):
+            tasks = [(self.__class__, options, datafile, start, end,
+                      columns, datadef.name, datadef.schema, datadef.rollups,
+                      staging.name)
+                     for start, end in chunks]
+            num_created = 0
+            line_offset = start_line
+            pool = Pool(processes, initializer=connect_import_worker)
             try:
-                values.append(self.prepare_row(row, datadef.schema))
-            except ImportConversionFailed, e:
-                row_errors.append((row, e.errors))
+                results = pool.imap(load_import_chunk, tasks)
+                for (chunk_created, chunk_lines, chunk_errors,
+                     chunk_totals) in results:
+                    num_created += chunk_created
+                    totals.merge(chunk_totals)
+                    row_errors.merge(chunk_errors, line_offset)
+                    line_offset += chunk_lines
+                    if row_errors.limit_reached:
+                        break
+            finally:
+                pool.terminate()
+                pool.join()
+            return num_created
 
-        if row_errors:
-            exc = ImportFailed(
-                "Failed to import entire file, %s rows had errors"
-                % len(row_errors))
-            exc.row_errors = row_errors
-            raise exc
+        num_created = self.write_staged(collection, write, row_errors)
+        totals.save()
+        return num_created
 
-#        new_objects = [Obj.objects.create(**v) for v in values if v]
+    def load_chunk(self, datafile, start, end, columns, datadef,
+                   staging_name):
+        """
+        Cast the rows between bytes start and end of datafile and write
+        them into the staging collection named staging_name.
 
+        Returns (rows written, lines read, row errors, rollup totals)
+        with line numbers counted from start.
+        """
+        lines = LineReader(open(datafile, 'rb'), start, end)
+        Obj = datadef.get_data_object()
+        staging = Obj.objects._collection.database[staging_name]
+        row_errors = self.get_row_errors()
+        totals = RollupTotals(Obj)
+        rows = self.cast_rows(
+            self.metrics.timed_iter('read', numbered_rows(csv_reader(lines))),
+            columns, datadef.schema, row_errors)
+        num_created = self.write_batches(Obj, rows, staging, row_errors,
+                                         totals)
+        return (num_created, lines.line_num, row_errors, totals.totals)
+
+    def create_rows(self, Obj, values):
+        """
+        Save each row with its own round trip to the database.
+        """
         new_objects = []
-        for v in values:
-            self.logger.debug("Creating row with values %s"
-                              % pprint.pformat(v))
-            new_objects.append(Obj.objects.create(**v))
-            self.logger.debug("SUCCESS!")
+        with self.metrics.timer('insert', len(values)):
+            for v in values:
+                new_objects.append(Obj.objects.create(**v))
+        return len(new_objects)
+
+    def get_documents(self, Obj, values, extra=None):
+        """
+        Validate values against Obj and return them as
+        dictionaries ready to be inserted, with extra's
+        fields, such as SOURCE_ID, added.
+        """
+        docs = []
+        with self.metrics.timer('validate', len(values)):
+            for v in values:
+                obj = Obj(**v)
+                obj.validate()
+                doc = obj.to_mongo()
+                if extra:
+                    doc.update(extra)
+                docs.append(doc)
+        return docs
+
+    def invalidate(self, collection):
+        """
+        Stop cached query results for collection being used,
+        see jamsession.cache.
+        """
+        from jamsession.cache import bump_generation
+        bump_generation(collection.name)
+
+    def remove_ids(self, collection, ids):
+        for chunk in chunked(ids, self.batch_size or 1):
+            collection.remove({'_id': {'$in': chunk}}, safe=True)
+
+    def insert_rows(self, Obj, values):
+        """
+        Save rows with one bulk insert per self.batch_size rows.
+
+        If any batch fails validation or can't be written, the rows
+        already inserted by this call are removed and ImportFailed
+        is raised. They're removed on any other error too.
+        """
+        collection = Obj.objects._collection
+        totals = RollupTotals(Obj)
+        inserted_ids = []
+        try:
+            for batch in chunked(values, self.batch_size):
+                docs = self.get_documents(Obj, batch)
+                with self.metrics.timer('insert', len(docs)):
+                    inserted_ids.extend(collection.insert(docs, safe=True))
+                totals.add(batch)
+        except WRITE_ERRORS, e:
+            self.remove_ids(collection, inserted_ids)
+            raise ImportFailed("Failed to import entire file: %s" % e)
+        except:
+            self.remove_ids(collection, inserted_ids)
+            raise
+        finally:
+            self.invalidate(collection)
+        totals.save()
+        return len(inserted_ids)
+
+    def get_row_hash(self, values):
+        """
+        A hash of a row's cast values, stored with rows written by
+        merge_rows to tell whether a row has changed.
+        """
+        return hashlib.md5(repr(sorted(values.items()))).hexdigest()
+
+    def get_row_key(self, values, key_columns):
+        """
+        The values of key_columns in a row, as they'll
+        come back from the database.
+        """
+        key = []
+        for column in key_columns:
+            value = values.get(column)
+            if isinstance(value, str):
+                value = value.decode('utf-8', 'replace')
+            elif isinstance(value, datetime.datetime):
+                # BSON dates only go down to milliseconds
+                value = value.replace(
+                    microsecond=value.microsecond // 1000 * 1000)
+            key.append(value)
+        return tuple(key)
+
+    def find_rows(self, collection, keys, key_columns):
+        """
+        Map each of keys, see get_row_key, that's already in collection
+        to the (id, row hash) of the row with it.
+        """
+        if len(key_columns) == 1:
+            spec = {key_columns[0]: {'$in': [key[0] for key in keys]}}
+        else:
+            spec = {'$or': [dict(zip(key_columns, key)) for key in keys]}
+        found = {}
+        for doc in collection.find(spec, list(key_columns) + [ROW_HASH]):
+            key = tuple(doc.get(column) for column in key_columns)
+            found[key] = (doc['_id'], doc.get(ROW_HASH))
+        return found
+
+    def check_row_keys(self, rows, key_columns, row_errors):
+        """
+        The rows, (line number, values) pairs, that have a value for
+        every one of key_columns. Those that don't couldn't be told
+        apart by merge_rows, so they're added to row_errors.
+        """
+        for line_num, values in rows:
+            blank = [column for column in key_columns
+                     if values.get(column) in ('', None)]
+            if blank:
+                self.metrics.incr('row_errors')
+                row_errors.add(line_num, values,
+                               ["Key column %s is blank" % column
+                                for column in blank], blank)
+                if row_errors.limit_reached:
+                    return
+                continue
+            yield line_num, values
+
+    def merge_rows(self, Obj, values, key_columns):
+        """
+        Merge rows into Obj's collection by the values of key_columns,
+        one self.batch_size at a time. A row with a new key is inserted,
+        one whose row hash differs from the row with its key replaces it
+        and the rest are skipped. Of rows in values with the same key,
+        the last wins.
+
+        Each batch takes one query to find its keys, one remove of the
+        rows that changed and one bulk insert of their replacements, with
+        the same ids, and the new rows. The replacements are encoded
+        before the remove, so one bson can't encode doesn't lose the row
+        it replaces, but if the server rejects the insert, say for a
+        unique index, the batch's changed rows are lost. Rows must have a
+        value for every key column, see check_row_keys.
+
+        Batches already merged stay merged if a later one fails. Rollups
+        are rebuilt once every batch is in. Returns the number of rows
+        inserted or updated, the rest are counted in the importer's
+        metrics as rows_unchanged.
+        """
+        collection = Obj.objects._collection
+        collection.ensure_index([(column, ASCENDING)
+                                 for column in key_columns])
+        num_inserted = num_updated = num_unchanged = 0
+        try:
+            for batch in chunked(values, self.batch_size or 1):
+                rows = OrderedDict()
+                for v in batch:
+                    rows[self.get_row_key(v, key_columns)] = v
+                with self.metrics.timer('find_keys', len(rows)):
+                    found = self.find_rows(collection, rows.keys(),
+                                           key_columns)
+
+                new_rows, changed_rows = [], []
+                for key, v in rows.items():
+                    row_hash = self.get_row_hash(v)
+                    if key not in found:
+                        new_rows.append((row_hash, v))
+                    elif found[key][1] != row_hash:
+                        changed_rows.append((found[key][0], row_hash, v))
+                    else:
+                        num_unchanged += 1
+
+                changed_docs = self.get_documents(
+                    Obj, [v for _, _, v in changed_rows])
+                for (row_id, row_hash, v), doc in izip(changed_rows,
+                                                       changed_docs):
+                    doc['_id'] = row_id
+                    doc[ROW_HASH] = row_hash
+                    BSON.encode(doc)
+                docs = self.get_documents(Obj, [v for _, v in new_rows])
+                for (row_hash, v), doc in izip(new_rows, docs):
+                    doc[ROW_HASH] = row_hash
+
+                if changed_docs:
+                    with self.metrics.timer('update', len(changed_docs)):
+                        collection.remove(
+                            {'_id': {'$in': [row_id for row_id, _, _
+                                             in changed_rows]}},
+                            safe=True)
+                if changed_docs or docs:
+                    with self.metrics.timer('insert', len(changed_docs)
+                                            + len(docs)):
+                        collection.insert(changed_docs + docs, safe=True)
+                num_updated += len(changed_docs)
+                num_inserted += len(docs)
+        except WRITE_ERRORS, e:
+            raise ImportFailed("Failed to import entire file: %s" % e)
+        finally:
+            self.invalidate(collection)
+            self.metrics.incr('rows_inserted', num_inserted)
+            self.metrics.incr('rows_updated', num_updated)
+            self.metrics.incr('rows_unchanged', num_unchanged)
+        self.logger.info("Merged into %s: %s inserted, %s updated, "
+                         "%s unchanged" % (collection.name, num_inserted,
+                                           num_updated, num_unchanged))
+
+        if Obj._rollups and (num_inserted or num_updated):
+            rebuild_rollups(Obj)
+        return num_inserted + num_updated
+
+    def get_validation_errors(self, Obj, values):
+        """
+        (column, message) for each of values, a cast row,
+        that the field of Obj for its column rejects.
+        """
+        errors = []
+        for name, field in Obj._fields.items():
+            value = values.get(name)
+            if value is None:
+                continue
+            try:
+                field.validate(value)
+            except (ValidationError, ValueError, AttributeError,
+                    AssertionError):
+                errors.append((name, "< %s > isn't a valid %s"
+                               % (value, field.__class__.__name__)))
+        return errors
+
+    def validate_rows(self, Obj, rows, row_errors):
+        """
+        Validate every row of rows, cast (line number, values) pairs,
+        without writing anything, returning the number that would have
+        been written. Rows that fail are added to row_errors, with the
+        columns that failed, so every one is reported.
+        """
+        num_valid = 0
+        for batch in chunked(rows, self.batch_size or 1):
+            with self.metrics.timer('validate', len(batch)):
+                for line_num, values in batch:
+                    errors = self.get_validation_errors(Obj, values)
+                    if not errors:
+                        num_valid += 1
+                        continue
+                    self.metrics.incr('row_errors')
+                    row_errors.add(line_num, values,
+                                   [message for column, message in errors],
+                                   [column for column, message in errors])
+            if row_errors.limit_reached:
+                break
+        self.raise_row_errors(row_errors)
+        return num_valid
+
+    def write_batches(self, Obj, rows, collection, row_errors, totals,
+                      extra=None, ids=None):
+        """
+        Insert rows, an iterator, into collection a batch at a time,
+        adding them to the RollupTotals totals. extra, a dictionary,
+        is added to every document, see get_documents. ids, if given,
+        is an iterator of the ids to give the documents.
+
+        Once there are row_errors rows are still consumed, so every
+        failure gets reported, but no more are written.
+        """
+        num_created = 0
+        for batch in chunked(rows, self.batch_size or 1):
+            if row_errors:
+                continue
+            docs = self.get_documents(Obj, batch, extra)
+            if ids is not None:
+                for doc in docs:
+                    doc['_id'] = ids.next()
+            with self.metrics.timer('insert', len(docs)):
+                collection.insert(docs, safe=True)
+            totals.add(batch)
+            num_created += len(batch)
+        return num_created
+
+    def append_rows(self, Obj, rows, row_errors, totals):
+        """
+        Write rows, an iterator, straight into Obj's collection a batch
+        at a time, see write_batches. Their ids all share a prefix made
+        for this call, so if the rows can't all be written those that
+        were are removed by their range of ids.
+        """
+        collection = Obj.objects._collection
+        oid = str(ObjectId()).decode('hex')
+        prefix = oid[:4] + hashlib.md5(oid).digest()[:4]
+        ids = (ObjectId(prefix + struct.pack('>I', num)) for num in count())
+        written = {'_id': {'$gte': ObjectId(prefix + '\x00' * 4),
+                           '$lte': ObjectId(prefix + '\xff' * 4)}}
+        try:
+            num_created = self.write_batches(Obj, rows, collection,
+                                             row_errors, totals, ids=ids)
+            self.raise_row_errors(row_errors)
+        except WRITE_ERRORS, e:
+            collection.remove(written, safe=True)
+            raise ImportFailed("Failed to import entire file: %s" % e)
+        except:
+            collection.remove(written, safe=True)
+            raise
+        finally:
+            self.invalidate(collection)
+        return num_created
+
+    def write_staged(self, collection, write, row_errors):
+        """
+        Call write with a new staging collection and swap it into place
+        if that writes anything without leaving row_errors. On any
+        failure the staging collection is dropped.
+        """
+        db = collection.database
+        staging = db['%s__staging_%s' % (collection.name, ObjectId())]
+        try:
+            num_created = write(staging)
+            self.raise_row_errors(row_errors)
+            if num_created:
+                self.swap_collection(staging, collection)
+        except WRITE_ERRORS, e:
+            db.drop_collection(staging.name)
+            raise ImportFailed("Failed to import entire file: %s" % e)
+        except:
+            db.drop_collection(staging.name)
+            raise
+        finally:
+            self.invalidate(collection)
+        return num_created
+
+    def stream_rows(self, Obj, rows, row_errors):
+        """
+        Write rows, an iterator, one batch at a time. Rollups are updated
+        once every row has been written.
+
+        Into an empty collection they're written to a staging collection
+        that's renamed over it once every row has been, see write_staged.
+        Otherwise they're appended straight to the collection, so each
+        row is only written once, and removed again if the import fails,
+        see append_rows. Until then readers can see the rows written so
+        far.
+        """
+        totals = RollupTotals(Obj)
+        collection = Obj.objects._collection
+        if collection.count():
+            num_created = self.append_rows(Obj, rows, row_errors, totals)
+        else:
+            def write(staging):
+                return self.write_batches(Obj, rows, staging, row_errors,
+                                          totals)
+            num_created = self.write_staged(collection, write, row_errors)
+        totals.save()
+        return num_created
+
+    def swap_collection(self, staging, collection):
+        """
+        Move everything in staging into collection.
+
+        An empty target is replaced by renaming staging over it, after
+        copying the target's indexes. Otherwise the staged documents
+        are copied over in batches, writing them a second time, and
+        removed again if that fails.
+        """
+        db = collection.database
+        if not collection.count():
+            for name, info in collection.index_information().items():
+                if name != '_id_':
+                    staging.create_index(info['key'], name=name,
+                                         unique=info.get('unique', False))
+            staging.rename(collection.name, dropTarget=True)
+            return
+
+        copied_ids = []
+        try:
+            for docs in chunked(staging.find(), self.batch_size or 1):
+                copied_ids.extend(collection.insert(docs, safe=True))
+        except OperationFailure:
+            self.remove_ids(collection, copied_ids)
+            raise
+        db.drop_collection(staging.name)
+
+
+def connect_import_worker():
+    """
+    Pool initializer for parallel imports, forked workers
+    mustn't share their parent's database connection.
+    """
+    from mongoengine.connection import _get_db
+    _get_db(reconnect=True)
+
 
-        return (datadef, len(new_objects))
+def load_import_chunk(task):
+    """
+    Run CSVImporter.load_chunk in a worker process,
+    see CSVImporter.load_parallel.
+    """
+    (importer_class, options, datafile, start, end,
+     columns, name, schema, rollups, staging_name) = task
+    importer = importer_class(**options)
+    return importer.load_chunk(datafile, start, end, columns,
+                               Schema(name=name, schema=schema,
+                                      rollups=rollups),
+                               staging_name)
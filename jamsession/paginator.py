@@ -0,0 +1,103 @@
+"""
+Keyset pagination for the rows of a data object.
+
+Pages are found by filtering on the _id at the edge of the
+previous page rather than by skipping rows, so a deep page
+costs the same as the first one.
+"""
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+
+def estimated_count(collection):
+    """
+    Number of documents in collection according to its
+    metadata, without scanning it.
+    """
+    try:
+        stats = collection.database.command('collstats', collection.name)
+    except OperationFailure:
+        return 0
+    return int(stats.get('count', 0))
+
+
+def parse_key(key):
+    """
+    Turn a page key from a URL back into an ObjectId,
+    raises ValueError if it isn't one.
+    """
+    try:
+        return ObjectId(key)
+    except (InvalidId, TypeError):
+        raise ValueError("Invalid page key %r" % (key, ))
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def next_key(self):
+        """Pass as after to get the following page."""
+        if self.has_next and self.object_list:
+            return str(self.object_list[-1].id)
+
+    @property
+    def previous_key(self):
+        """Pass as before to get the preceding page."""
+        if self.has_previous and self.object_list:
+            return str(self.object_list[0].id)
+
+
+class KeysetPaginator(object):
+    """
+    Pages through every row of document, a data object class, or
+    those matching the MongoDB query spec, in _id order. Only
+    columns are fetched, if given.
+    """
+    def __init__(self, document, per_page=50, spec=None, columns=None):
+        self.document = document
+        self.per_page = per_page
+        self.spec = spec or {}
+        self.columns = columns
+
+    def page_documents(self, after=None, before=None):
+        """
+        The raw documents of the page that page returns, and
+        whether there are pages after and before it.
+        """
+        spec = dict(self.spec)
+        direction = 1
+        if after:
+            spec['_id'] = {'$gt': parse_key(after)}
+        elif before:
+            spec['_id'] = {'$lt': parse_key(before)}
+            direction = -1
+
+        collection = self.document.objects._collection
+        fields = list(self.columns) if self.columns else None
+        cursor = collection.find(spec, fields).sort('_id', direction)
+        docs = list(cursor.limit(self.per_page + 1))
+        has_more = len(docs) > self.per_page
+        docs = docs[:self.per_page]
+        if direction == -1:
+            docs.reverse()
+
+        if before:
+            return docs, True, has_more
+        return docs, has_more, bool(after)
+
+    def page(self, after=None, before=None):
+        """
+        The rows following the key after, or preceding the key before,
+        or the first page if neither is given.
+        """
+        docs, has_next, has_previous = self.page_documents(after, before)
+        return KeysetPage([self.document._from_son(doc) for doc in docs],
+                          has_next, has_previous)
@@ -0,0 +1,236 @@
+"""
+Materialized rollups: counts and sums of a data object's rows, grouped
+by columns and/or a time bucket, kept in a sidecar collection so charts
+read a handful of documents instead of scanning every row.
+
+A Schema declares its rollups as a list of dictionaries:
+
+    {'name': 'daily',
+     'bucket': ['Date', 'day'],
+     'group_by': ['Team'],
+     'sum': ['Backlog', 'Done']}
+
+Imports and new rows update them incrementally. Rows that are edited
+in place aren't tracked, rebuild_rollups recomputes everything.
+"""
+import datetime
+from collections import OrderedDict
+
+from bson.son import SON
+from pymongo import ASCENDING
+
+from jamsession.aggregation import Aggregation, BUCKET_PARTS
+
+
+#: Schema types a rollup can sum.
+NUMERIC_TYPES = ('int', 'float')
+
+
+class RollupError(Exception):
+    pass
+
+
+def validate_rollups(specs, schema):
+    """
+    Check that the columns of each rollup spec are in schema, a dict
+    of column types, that its bucket is on a datetime and its sums
+    are of numbers.
+    """
+    for spec in specs:
+        rollup = Rollup(spec)
+        for column in rollup.group_by + rollup.sum:
+            if column not in schema:
+                raise RollupError("Rollup %s uses %s, no such column"
+                                  % (rollup.name, column))
+        for column in rollup.sum:
+            if schema[column] not in NUMERIC_TYPES:
+                raise RollupError("Rollup %s can't sum %s, a %s column"
+                                  % (rollup.name, column, schema[column]))
+        if rollup.bucket_column:
+            if schema.get(rollup.bucket_column) != 'datetime':
+                raise RollupError("Rollup %s can only bucket on a "
+                                  "datetime column, not %s"
+                                  % (rollup.name, rollup.bucket_column))
+            if rollup.bucket_size not in BUCKET_PARTS:
+                raise RollupError("Rollup %s bucket size must be one of "
+                                  "%s, got %s" % (rollup.name,
+                                                  sorted(BUCKET_PARTS),
+                                                  rollup.bucket_size))
+
+
+def get_rollup_collection(document):
+    collection = document.objects._collection
+    return collection.database['%s__rollups' % collection.name]
+
+
+def truncate_datetime(value, size):
+    """
+    The start of the size bucket value falls in, matching the buckets
+    MongoDB's date operators produce. Weeks start on Sunday.
+    """
+    if size == 'week':
+        value = value - datetime.timedelta(days=(value.weekday() + 1) % 7)
+        size = 'day'
+    parts = BUCKET_PARTS[size]
+    return datetime.datetime(value.year,
+                             'month' in parts and value.month or 1,
+                             'dayOfMonth' in parts and value.day or 1,
+                             'hour' in parts and value.hour or 0)
+
+
+class Rollup(object):
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.group_by = list(spec.get('group_by', []))
+        self.sum = list(spec.get('sum', []))
+        self.bucket_column, self.bucket_size = \
+            spec.get('bucket') or (None, None)
+
+    def get_key(self, row):
+        """
+        The group row falls in as a tuple,
+        or None if it has no date to bucket on.
+        """
+        key = [row.get(column) for column in self.group_by]
+        if self.bucket_column:
+            value = row.get(self.bucket_column)
+            if value is None:
+                return None
+            key.append(truncate_datetime(value, self.bucket_size))
+        return tuple(key)
+
+    def key_document(self, key):
+        doc = SON()
+        for num, value in enumerate(key[:len(self.group_by)]):
+            doc['g%s' % num] = value
+        if self.bucket_column:
+            doc['bucket'] = key[-1]
+        return doc
+
+    def to_row(self, doc):
+        """
+        A stored rollup document in the same shape as an Aggregation
+        result, columns mapped to group values and column__sum totals.
+        """
+        row = {'count': doc.get('count', 0)}
+        key = doc['key']
+        for num, column in enumerate(self.group_by):
+            row[column] = key.get('g%s' % num)
+        if self.bucket_column:
+            row[self.bucket_column] = key['bucket']
+        sums = doc.get('sums', {})
+        for num, column in enumerate(self.sum):
+            row['%s__sum' % column] = sums.get('s%s' % num, 0)
+        return row
+
+
+class RollupTotals(object):
+    """
+    Counts and sums for each of a data object's rollups, folded
+    together in memory and then written with one upsert per group.
+    """
+    def __init__(self, document):
+        self.document = document
+        self.rollups = [Rollup(spec) for spec in document._rollups]
+        self.totals = dict((rollup.name, {}) for rollup in self.rollups)
+
+    def __nonzero__(self):
+        return any(self.totals.values())
+
+    def add(self, rows, sign=1):
+        """
+        Fold rows, dictionaries of cast values, into the totals.
+        A sign of -1 takes them back out.
+        """
+        for rollup in self.rollups:
+            totals = self.totals[rollup.name]
+            for row in rows:
+                key = rollup.get_key(row)
+                if key is None:
+                    continue
+                total = totals.setdefault(key, [0] + [0] * len(rollup.sum))
+                total[0] += sign
+                for num, column in enumerate(rollup.sum):
+                    total[num + 1] += sign * (row.get(column) or 0)
+        return self
+
+    def merge(self, totals):
+        """
+        Fold in the totals attribute of another RollupTotals.
+        """
+        for name, groups in totals.items():
+            mine = self.totals[name]
+            for key, total in groups.items():
+                if key in mine:
+                    mine[key] = [a + b for a, b in zip(mine[key], total)]
+                else:
+                    mine[key] = list(total)
+        return self
+
+    def save(self):
+        """
+        Add the totals to the stored rollups and start again from zero.
+        """
+        if not self:
+            return
+        collection = get_rollup_collection(self.document)
+        collection.ensure_index([('rollup', ASCENDING), ('key', ASCENDING)],
+                                unique=True)
+        for rollup in self.rollups:
+            for key, total in self.totals[rollup.name].items():
+                increments = {'count': total[0]}
+                for num, value in enumerate(total[1:]):
+                    increments['sums.s%s' % num] = value
+                collection.update(
+                    {'rollup': rollup.name, 'key': rollup.key_document(key)},
+                    {'$inc': increments},
+                    upsert=True, safe=True)
+            self.totals[rollup.name] = {}
+
+
+def get_rollup(document, name):
+    """
+    Rows of the stored rollup called name, in key order.
+    """
+    rollup = [Rollup(spec) for spec in document._rollups
+              if spec['name'] == name]
+    if not rollup:
+        raise KeyError("No rollup named %s" % name)
+    rollup = rollup[0]
+    cursor = get_rollup_collection(document).find({'rollup': name})
+    return [rollup.to_row(doc) for doc in cursor.sort('key', ASCENDING)]
+
+
+def rebuild_rollups(document):
+    """
+    Recompute every rollup of document from its rows with
+    the aggregation framework, replacing what was stored.
+    """
+    collection = get_rollup_collection(document)
+    collection.database.drop_collection(collection.name)
+    collection.ensure_index([('rollup', ASCENDING), ('key', ASCENDING)],
+                            unique=True)
+
+    for rollup in (Rollup(spec) for spec in document._rollups):
+        aggregation = Aggregation(document).group_by(*rollup.group_by)
+        if rollup.bucket_column:
+            aggregation.bucket(rollup.bucket_column, rollup.bucket_size)
+        aggregation.sum(*rollup.sum).count()
+
+        # Rows whose keys only differ before truncation share a group
+        docs = OrderedDict()
+        for row in aggregation:
+            key = rollup.get_key(row)
+            doc = docs.get(key)
+            if doc is None:
+                doc = docs[key] = {'rollup': rollup.name,
+                                   'key': rollup.key_document(key),
+                                   'count': 0,
+                                   'sums': SON()}
+            doc['count'] += row['count']
+            for num, column in enumerate(rollup.sum):
+                name = 's%s' % num
+                doc['sums'][name] = (doc['sums'].get(name, 0)
+                                     + (row['%s__sum' % column] or 0))
+        if docs:
+            collection.insert(docs.values(), safe=True)
@@ -0,0 +1,80 @@
+"""
+Lightweight, read-only access to a data object's rows.
+
+Only the requested columns are fetched, and each value is converted
+to its Python type the first time it's asked for, rather than every
+field of every row being converted up front as Documents are.
+
+    for row in DataObj.rows('Date', 'Backlog'):
+        row['Date'], row.Backlog
+"""
+#: Rows fetched from the database at a time.
+ROWS_BATCH_SIZE = 1000
+
+
+class LazyRow(object):
+    __slots__ = ('_raw', '_fields', '_values')
+
+    def __init__(self, raw, fields):
+        self._raw = raw
+        self._fields = fields
+        self._values = None
+
+    @property
+    def id(self):
+        return self._raw.get('_id')
+
+    def __getitem__(self, name):
+        values = self._values
+        if values is None:
+            values = self._values = {}
+        try:
+            return values[name]
+        except KeyError:
+            pass
+        if name not in self._fields:
+            raise KeyError(name)
+        value = self._raw.get(name)
+        if value is not None:
+            value = self._fields[name].to_python(value)
+        values[name] = value
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self._raw if key in self._fields]
+
+    def __repr__(self):
+        return '<LazyRow: %s>' % self.id
+
+
+def iter_rows(document, columns=None, spec=None, sort=None, limit=None,
+              batch_size=ROWS_BATCH_SIZE):
+    """
+    LazyRows for the rows of document, a data object class, matching
+    the MongoDB query spec. Only columns are fetched, if given.
+    sort is a list of (column, direction) pairs.
+    """
+    fields = document._fields
+    collection = document.objects._collection
+    cursor = collection.find(spec or {}, list(columns) if columns else None)
+    if sort:
+        cursor.sort(sort)
+    if limit:
+        cursor.limit(limit)
+    cursor.batch_size(batch_size)
+    for raw in cursor:
+        yield LazyRow(raw, fields)
@@ -152,6 +152,119 @@ class SchemaTest(JamTestCase):
 
         self.assertRaises(ValidationError, sample_def.validate)
 
+    def test_data_object_is_cached(self):
+        """
+        get_data_object should keep returning the same class
+        until the schema changes.
+        """
+        sample_def = self._make_one(name='Companions',
+                                    schema={'name': 'string'})
+        Companions = sample_def.get_data_object()
+        self.assert_(Companions is sample_def.get_data_object())
+
+        sample_def.schema['age'] = 'int'
+        Changed = sample_def.get_data_object()
+        self.assert_(Changed is not Companions)
+        self.assert_('age' in Changed._fields)
+
+    def test_data_object_cache_cleared_on_save(self):
+        from jamsession.models import _data_objects
+        sample_def = self._make_one(name='Companions',
+                                    schema={'name': 'string'})
+        sample_def.save()
+        sample_def.get_data_object()
+        cached = [key for key in _data_objects if key[0] == sample_def.id]
+        self.assertEqual(1, len(cached))
+
+        sample_def.save()
+        cached = [key for key in _data_objects if key[0] == sample_def.id]
+        self.assertEqual(0, len(cached))
+
+    def test_sync_indexes(self):
+        """
+        Saving a schema should create its declared indexes
+        and drop the ones that are no longer declared.
+        """
+        sample_def = self._make_one(
+            name='Companions',
+            schema={'name': 'string', 'age': 'int'},
+            indexes=[{'fields': ['name'], 'unique': True},
+                     {'fields': ['age', 'name'], 'unique': False}])
+        sample_def.save()
+
+        collection = sample_def.get_data_object().objects._collection
+        indexes = [info for name, info
+                   in collection.index_information().items()
+                   if name.startswith('jamsession_')]
+        self.assertEqual(2, len(indexes))
+        unique = [info for info in indexes if info.get('unique')][0]
+        self.assertEqual([('name', 1)], list(unique['key']))
+
+        sample_def.indexes = []
+        sample_def.save()
+        names = [name for name in collection.index_information()
+                 if name.startswith('jamsession_')]
+        self.assertEqual([], names)
+
+    def test_sync_indexes_failure(self):
+        """
+        An index that can't be created should be a ValidationError.
+        """
+        from mongoengine import ValidationError
+        sample_def = self._make_one(name='Companions',
+                                    schema={'name': 'string'})
+        sample_def.save()
+        Companions = sample_def.get_data_object()
+        for name in ['Amy', 'Amy']:
+            Companions.objects.create(name=name)
+
+        sample_def.indexes = [{'fields': ['name'], 'unique': False}]
+        sample_def.save()
+        collection = Companions.objects._collection
+        names = sorted(collection.index_information())
+
+        sample_def.indexes = [{'fields': ['name'], 'unique': True}]
+        self.assertRaises(ValidationError, sample_def.save)
+        self.assertEqual(names, sorted(collection.index_information()))
+        from jamsession.models import Schema
+        stored = Schema.objects.get(id=sample_def.id)
+        self.assertEqual([{'fields': ['name'], 'unique': False}],
+                         stored.indexes)
+
+    def test_index_names_are_stable(self):
+        """
+        Index names shouldn't change when a schema declared with str
+        column names is loaded back with unicode ones.
+        """
+        sample_def = self._make_one(name='Companions',
+                                    schema={'name': 'string'})
+        self.assertEqual(
+            sample_def._get_index_name({'fields': ['name']}),
+            sample_def._get_index_name({'fields': [u'name'],
+                                        'unique': False}))
+
+    def test_data_object_keeps_its_columns(self):
+        """
+        Objects of a data object class should still save after its
+        schema's columns change.
+        """
+        sample_def = self._make_one(name='Companions',
+                                    schema={'name': 'string', 'age': 'int'})
+        Companions = sample_def.get_data_object()
+        sample_def.schema = {'name': 'string', 'homeworld': 'string'}
+        rory = Companions(name=u'Rory', age=2000)
+        rory.save()
+        self.assertEqual({'name': u'Rory', 'age': 2000}, rory.to_row())
+
+    def test_data_object_cache_is_bounded(self):
+        from mock import patch
+        from jamsession.models import _data_objects
+        with patch('jamsession.models.DATA_OBJECT_CACHE_SIZE', 2):
+            for name in ('Rose', 'Martha', 'Donna'):
+                self._make_one(name=name,
+                               schema={'name': 'string'}).get_data_object()
+            self.assert_(len(_data_objects) <= 2)
+
 
 class CSVImportTests(JamTestCase):
     def setUp(self):
@@ -168,6 +281,14 @@ class CSVImportTests(JamTestCase):
     def _get_csv(self, filename):
         return os.path.join(self.csv_fixture_path, filename)
 
+    def _write_csv(self, contents):
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, contents)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
     def _get_cumulative_flow_def(self):
         from jamsession.models import Schema
         return Schema(
@@ -198,9 +319,8 @@ class CSVImportTests(JamTestCase):
     def test_csv_fresh_import(self):
         """
         Schemas should be able to load data
-        from a CSV into a on-the-fly schema.
-
-        For now, that means all values come in as strings.
+        from a CSV into a on-the-fly schema,
+        with the column types inferred.
         """
         importer = self._make_one()
         datadef, num_created = importer.load(
@@ -210,6 +330,76 @@ class CSVImportTests(JamTestCase):
         self.assertEqual(21, len(datadef.schema.keys()))
         self.assert_(DataObj.objects.count() == 91)
         self.assertEqual(91, num_created)
+        self.assertEqual('datetime', datadef.schema['Date'])
+        self.assertEqual(['int'], list(set(
+            typehint for column, typehint in datadef.schema.items()
+            if column != 'Date')))
+
+    def test_csv_fresh_import_as_strings(self):
+        importer = self._make_one()
+        datadef, num_created = importer.load(
+            self._get_csv('cumulativeflow.csv'), infer_types=False)
+
+        self.assertEqual(['string'], list(set(datadef.schema.values())))
+        self.assertEqual(91, num_created)
+
+    def test_infer_schema(self):
+        """
+        infer_schema should pick the narrowest type for each
+        column without saving anything.
+        """
+        from jamsession.models import Schema
+        path = self._write_csv("Name,Age,Height,Companion,Joined,Notes\n"
+                               "Rose,19,1.65,yes,2005-03-26,\n"
+                               "Rory,,1.8,No,2010-04-03,\n"
+                               "K-9,3,,n,1977-10-01,\n")
+        importer = self._make_one()
+        datadef = importer.infer_schema(path)
+
+        self.assertEqual({'Name': 'string',
+                          'Age': 'int',
+                          'Height': 'float',
+                          'Companion': 'bool',
+                          'Joined': 'datetime',
+                          'Notes': 'string'},
+                         datadef.schema)
+        self.assertEqual(0, Schema.objects.count())
+
+    def test_infer_numbers(self):
+        """
+        Codes with leading zeros and ints too big for BSON
+        should be left as strings.
+        """
+        importer = self._make_one()
+        self.assertEqual('string',
+                         importer.infer_column_type(['007', '12']))
+        self.assertEqual('string', importer.infer_column_type(
+            ['1', '99999999999999999999']))
+        self.assertEqual('int', importer.infer_column_type(['0', '-12']))
+        self.assertEqual('float', importer.infer_column_type(['0.5', '2']))
+
+    def test_inferred_type_broken_after_sample(self):
+        """
+        A row past the sample that doesn't fit the inferred types should
+        fail the import without leaving the new schema behind, so it can
+        be retried.
+        """
+        from jamsession.models import Schema, ImportFailed
+        path = self._write_csv("Name,Age\n"
+                               "Rose,19\n"
+                               "Amy,21\n"
+                               "Rory,N/A\n")
+        for attempt in range(2):
+            importer = self._make_one()
+            importer.sample_size = 2
+            self.assertRaises(ImportFailed, importer.load, path)
+            self.assertEqual(0, Schema.objects.count())
+
+    def test_cast_bool(self):
+        importer = self._make_one()
+        self.assertEqual([True, True, False, False],
+                         map(importer.cast_bool, ['Yes', '1', 'false', '0']))
+        self.assertRaises(ValueError, importer.cast_bool, 'maybe')
 
     def test_csv_exisiting_import(self):
         """
@@ -234,6 +424,1308 @@ class CSVImportTests(JamTestCase):
         self.assertEqual(91, num_created)
         self.assertEqual(91, DataObj.objects.count())
 
+    def test_csv_bulk_import_batches(self):
+        """
+        Rows should be written in bulk, batch_size at a time,
+        with a final partial batch.
+        """
+        importer = self._make_one(batch_size=10)
+        cum_def, num_created = importer.load(
+            self._get_csv('cumulativeflow.csv'),
+            self._get_cumulative_flow_def())
+
+        DataObj = cum_def.get_data_object()
+        self.assertEqual(91, num_created)
+        self.assertEqual(91, DataObj.objects.count())
+
+    def test_csv_row_by_row_import(self):
+        """
+        A batch_size of None should save one row at a time.
+        """
+        importer = self._make_one(batch_size=None)
+        cum_def, num_created = importer.load(
+            self._get_csv('cumulativeflow.csv'),
+            self._get_cumulative_flow_def())
+
+        DataObj = cum_def.get_data_object()
+        self.assertEqual(91, num_created)
+        self.assertEqual(91, DataObj.objects.count())
+
+    def test_csv_bulk_import_is_all_or_nothing(self):
+        """
+        If a later batch can't be written the batches before
+        it should be removed again.
+        """
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Companions',
+                         schema={'Name': 'string', 'Email': 'email'})
+        path = self._write_csv("Name,Email\n"
+                               "Rose,rose@tardis.co.uk\n"
+                               "Martha,martha@tardis.co.uk\n"
+                               "Donna,not an email\n")
+
+        importer = self._make_one(batch_size=1)
+        self.assertRaises(ImportFailed, importer.load, path, datadef)
+        self.assertEqual(0, datadef.get_data_object().objects.count())
+
+    def test_batched_import_rolls_back_unencodable_rows(self):
+        """
+        A value that can't be encoded as BSON, like Latin-1 text,
+        should remove the batches already written too.
+        """
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Companions', schema={'Name': 'string'})
+        path = self._write_csv("Name\n"
+                               "Rose\n"
+                               "Martha\n"
+                               "Ren\xe9e\n")
+
+        importer = self._make_one(batch_size=2)
+        self.assertRaises(ImportFailed, importer.load, path, datadef)
+        self.assertEqual(0, datadef.get_data_object().objects.count())
+
+    def test_compiled_row_converter(self):
+        """
+        A compiled converter should cast a list of values
+        positionally, stripping padded column names.
+        """
+        importer = self._make_one()
+        convert_row = importer.compile_row_converter(
+            [' Name', 'Age ', 'Height'],
+            {'Name': 'string', 'Age': 'int', 'Height': 'float'})
+
+        self.assertEqual({'Name': 'Rory', 'Age': 23, 'Height': None},
+                         convert_row(['Rory', '23', '']))
+
+    def test_unconvertable_values_are_row_errors(self):
+        """
+        Values the cast function rejects should be reported
+        as row errors rather than escaping from load.
+        """
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Ages', schema={'Name': 'string', 'Age': 'int'})
+        path = self._write_csv("Name,Age\nRiver,unknown\nAmy,21\n")
+
+        importer = self._make_one()
+        try:
+            importer.load(path, datadef)
+        except ImportFailed, e:
+            self.assertEqual(1, len(e.row_errors))
+            line_num, row, errors = e.row_errors[0]
+            self.assertEqual(2, line_num)
+            self.assertEqual('unknown', row['Age'])
+        else:
+            self.fail("ImportFailed not raised")
+
+    def test_csv_validate_only(self):
+        """
+        A dry run should report how many rows would be
+        imported without saving anything.
+        """
+        from jamsession.models import Schema
+        importer = self._make_one()
+        datadef, num_valid = importer.load(
+            self._get_csv('cumulativeflow.csv'), validate_only=True)
+
+        self.assertEqual(91, num_valid)
+        self.assertEqual(None, datadef.id)
+        self.assertEqual(0, Schema.objects.count())
+        self.assertEqual(0, datadef.get_data_object().objects.count())
+
+    def _get_bad_ages_csv(self, num_bad):
+        rows = ["Name,Age,Height"]
+        rows += ["Clone %s,unknown,tall" % i for i in range(num_bad)]
+        rows += ["Rory,21,1.8"]
+        return self._write_csv('\n'.join(rows) + '\n')
+
+    def test_csv_validate_only_errors(self):
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Ages', schema={'Name': 'string',
+                                              'Age': 'int',
+                                              'Height': 'float'})
+        path = self._get_bad_ages_csv(10)
+
+        importer = self._make_one(error_sample_size=3)
+        try:
+            importer.load(path, datadef, validate_only=True)
+        except ImportFailed, e:
+            self.assertEqual(10, e.error_count)
+            self.assertEqual([2, 3, 4], [line for line, row, errors
+                                         in e.row_errors])
+            self.assertEqual({'Age': 10, 'Height': 10}, e.column_errors)
+        else:
+            self.fail("ImportFailed not raised")
+
+    def test_csv_validate_only_invalid_values(self):
+        """
+        A dry run should report every row with a value its field
+        rejects, not stop at the first.
+        """
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='People', schema={'Name': 'string',
+                                                'Email': 'email'})
+        path = self._write_csv("Name,Email\n"
+                               "Rory,rory@example.com\n"
+                               "Amy,not an email\n"
+                               "Clara,clara@example.com\n"
+                               "River,spoilers\n")
+
+        importer = self._make_one()
+        try:
+            importer.load(path, datadef, validate_only=True)
+        except ImportFailed, e:
+            self.assertEqual(2, e.error_count)
+            self.assertEqual([3, 5], [line for line, row, errors
+                                      in e.row_errors])
+            self.assertEqual({'Email': 2}, e.column_errors)
+        else:
+            self.fail("ImportFailed not raised")
+
+    def test_csv_max_errors(self):
+        """
+        An import should give up once it's seen max_errors bad rows.
+        """
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Ages', schema={'Name': 'string',
+                                              'Age': 'int',
+                                              'Height': 'float'})
+        path = self._get_bad_ages_csv(50)
+
+        for options in [{}, {'stream': True}]:
+            importer = self._make_one(max_errors=5)
+            try:
+                importer.load(path, datadef, **options)
+            except ImportFailed, e:
+                self.assertEqual(5, e.error_count)
+                self.assertEqual(5, len(e.row_errors))
+            else:
+                self.fail("ImportFailed not raised")
+        self.assertEqual(0, datadef.get_data_object().objects.count())
+
+    def test_csv_columnar_import(self):
+        """
+        Columnar imports should write the same rows as row by row ones.
+        """
+        datadef = self._get_cumulative_flow_def()
+        DataObj = datadef.get_data_object()
+        imported = []
+        for columnar in (False, True):
+            importer = self._make_one(batch_size=10, columnar=columnar)
+            cum_def, num_created = importer.load(
+                self._get_csv('cumulativeflow.csv'), datadef)
+            self.assertEqual(91, num_created)
+            imported.append(sorted(
+                sorted(obj.to_row().items()) for obj in DataObj.objects))
+            DataObj.objects.delete()
+        self.assertEqual(imported[0], imported[1])
+
+    def test_csv_columnar_import_errors(self):
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Ages', schema={'Name': 'string',
+                                              'Age': 'int',
+                                              'Height': 'float'})
+        path = self._write_csv("Name,Age,Height\n"
+                               "Rose,19,1.65\n"
+                               "Clone,unknown,tall\n"
+                               "\n"
+                               "Rory,21,1.8,extra\n"
+                               "Amy,,1.7\n")
+        failures = []
+        for columnar in (False, True):
+            importer = self._make_one(batch_size=2, columnar=columnar)
+            try:
+                importer.load(path, datadef)
+            except ImportFailed, e:
+                failures.append((e.row_errors, e.column_errors))
+            else:
+                self.fail("ImportFailed not raised")
+        self.assertEqual(failures[0], failures[1])
+        self.assertEqual([3, 5], [line_num for line_num, row, errors
+                                  in failures[1][0]])
+        self.assertEqual({'Age': 1, 'Height': 1}, failures[1][1])
+
+    def test_csv_parallel_import(self):
+        importer = self._make_one(batch_size=10)
+        cum_def, num_created = importer.load(
+            self._get_csv('cumulativeflow.csv'),
+            self._get_cumulative_flow_def(),
+            processes=2)
+
+        DataObj = cum_def.get_data_object()
+        self.assertEqual(91, num_created)
+        self.assertEqual(91, DataObj.objects.count())
+
+    def test_csv_parallel_import_row_errors(self):
+        """
+        Row errors found by worker processes should be reported
+        with their line number in the whole file.
+        """
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Ages', schema={'Name': 'string', 'Age': 'int'})
+        rows = ["Name,Age"] + ["Clone %s,%s" % (i, i) for i in range(200)]
+        rows[150] = "Clone 149,unknown"
+        path = self._write_csv('\n'.join(rows) + '\n')
+
+        importer = self._make_one(batch_size=10)
+        try:
+            importer.load(path, datadef, processes=3)
+        except ImportFailed, e:
+            self.assertEqual([151], [line for line, row, errors
+                                     in e.row_errors])
+        else:
+            self.fail("ImportFailed not raised")
+        self.assertEqual(0, datadef.get_data_object().objects.count())
+
+    def test_csv_parallel_import_quoted_newlines(self):
+        """
+        Records with quoted newlines shouldn't be split between workers.
+        """
+        from jamsession.models import Schema
+        from jamsession.util import split_lines
+        datadef = Schema(name='Notes', schema={'Name': 'string',
+                                               'Notes': 'string'})
+        rows = ['Clone %s,"line one\nline %s, two"' % (i, i)
+                for i in range(200)]
+        path = self._write_csv('Name,Notes\n' + '\n'.join(rows) + '\n')
+
+        for start, end in split_lines(path, len('Name,Notes\n'), 7):
+            datafile = open(path, 'rb')
+            datafile.seek(start)
+            self.assert_(datafile.read(6) == 'Clone ', start)
+            datafile.close()
+
+        importer = self._make_one(batch_size=10)
+        datadef, num_created = importer.load(path, datadef, processes=3)
+        self.assertEqual(200, num_created)
+        clone = datadef.get_data_object().objects.get(Name='Clone 57')
+        self.assertEqual('line one\nline 57, two', clone.Notes)
+
+    def _get_collection_names(self):
+        from mongoengine.connection import _get_db
+        return _get_db().collection_names()
+
+    def test_csv_streaming_import(self):
+        """
+        Streaming imports should write in batches, through a staging
+        collection or appending to any rows already there.
+        """
+        importer = self._make_one(batch_size=10)
+        datadef = self._get_cumulative_flow_def()
+        for expected_total in (91, 182):
+            cum_def, num_created = importer.load(
+                self._get_csv('cumulativeflow.csv'), datadef, stream=True)
+            DataObj = cum_def.get_data_object()
+            self.assertEqual(91, num_created)
+            self.assertEqual(expected_total, DataObj.objects.count())
+
+        staging = [name for name in self._get_collection_names()
+                   if '__staging_' in name]
+        self.assertEqual([], staging)
+
+    def test_csv_streaming_import_drops_staging_on_failure(self):
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Companions',
+                         schema={'Name': 'string', 'Email': 'email'})
+        path = self._write_csv("Name,Email\n"
+                               "Rose,rose@tardis.co.uk\n"
+                               "Donna,not an email\n")
+
+        importer = self._make_one(batch_size=1)
+        self.assertRaises(ImportFailed, importer.load, path, datadef,
+                          stream=True)
+        self.assertEqual(0, datadef.get_data_object().objects.count())
+        staging = [name for name in self._get_collection_names()
+                   if '__staging_' in name]
+        self.assertEqual([], staging)
+
+    def test_csv_streaming_append_removed_on_failure(self):
+        """
+        Rows streamed into a collection that already has some should
+        be removed again if the import fails.
+        """
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Companions',
+                         schema={'Name': 'string', 'Email': 'email'})
+        DataObj = datadef.get_data_object()
+        DataObj.objects.create(Name=u'Amy', Email=u'amy@tardis.co.uk')
+        path = self._write_csv("Name,Email\n"
+                               "Rose,rose@tardis.co.uk\n"
+                               "Martha,martha@tardis.co.uk\n"
+                               "Donna,not an email\n")
+
+        importer = self._make_one(batch_size=1)
+        self.assertRaises(ImportFailed, importer.load, path, datadef,
+                          stream=True)
+        self.assertEqual([u'Amy'], [obj.Name for obj in DataObj.objects])
+
+    def test_csv_resumable_import(self):
+        from jamsession.models import ImportCheckpoint
+        importer = self._make_one(batch_size=10)
+        datadef, num_created = importer.load(
+            self._get_csv('cumulativeflow.csv'), resumable=True)
+        self.assertEqual(91, num_created)
+        self.assertEqual(91, datadef.get_data_object().objects.count())
+        self.assertEqual(0, ImportCheckpoint.objects.count())
+
+    def test_csv_resumed_import(self):
+        """
+        An interrupted resumable import should carry on from its
+        last checkpoint without writing any row twice.
+        """
+        from jamsession.models import ImportCheckpoint
+        datadef = self._get_cumulative_flow_def()
+        datadef.save()
+        DataObj = datadef.get_data_object()
+
+        class Interrupted(Exception):
+            pass
+
+        importer = self._make_one(batch_size=10)
+        save_checkpoint = importer.save_checkpoint
+
+        def interrupt(checkpoint):
+            if checkpoint.rows_done > 20:
+                raise Interrupted()
+            save_checkpoint(checkpoint)
+        importer.save_checkpoint = interrupt
+
+        path = self._get_csv('cumulativeflow.csv')
+        self.assertRaises(Interrupted, importer.load, path, datadef,
+                          resumable=True)
+        self.assertEqual(30, DataObj.objects.count())
+        self.assertEqual(20, ImportCheckpoint.objects.get().rows_done)
+
+        datadef, num_created = self._make_one(batch_size=10).load(
+            path, resumable=True)
+        self.assertEqual(91, num_created)
+        self.assertEqual(91, DataObj.objects.count())
+        dates = [row.Date for row in DataObj.objects.order_by('id')]
+        self.assertEqual(sorted(dates), dates)
+        self.assertEqual(0, ImportCheckpoint.objects.count())
+
+    def test_csv_import_metrics(self):
+        """
+        An importer's metrics should time every stage of a load,
+        even one that fails.
+        """
+        from jamsession.metrics import ImportMetrics
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Companions', schema={'Name': 'string',
+                                                    'Age': 'int',
+                                                    'Joined': 'datetime'})
+        datadef.save()
+        path = self._write_csv("Name,Age,Joined\n"
+                               "Rose,19,2005-03-26\n"
+                               "Rory,20,2010-04-03\n"
+                               "K-9,three,1977-10-01\n")
+        metrics = ImportMetrics()
+        importer = self._make_one(batch_size=1, metrics=metrics)
+        self.assertRaises(ImportFailed, importer.load, path, datadef,
+                          resumable=True)
+
+        timers = metrics.summary()['timers']
+        for stage in ('sample', 'read', 'check_columns', 'prepare_row',
+                      'cast.int', 'cast.datetime', 'validate', 'insert'):
+            self.assert_(stage in timers, stage)
+        self.assertEqual(3, timers['sample']['count'])
+        self.assertEqual(3, timers['read']['count'])
+        self.assertEqual(3, timers['cast.datetime']['count'])
+        self.assertEqual(2, timers['insert']['count'])
+        self.assertEqual({'row_errors': 1}, metrics.summary()['counters'])
+        self.assert_('prepare_row' in metrics.format_summary())
+
+    def test_metrics_off_by_default(self):
+        from jamsession.metrics import NULL_METRICS
+        importer = self._make_one()
+        self.assert_(importer.metrics is NULL_METRICS)
+        self.assert_(NULL_METRICS.timed('cast.int', int) is int)
+        importer.load(self._get_csv('cumulativeflow.csv'))
+        self.assertEqual({'timers': {}, 'counters': {}},
+                         NULL_METRICS.summary())
+
+    def test_merge_import(self):
+        """
+        Importing with key columns should insert new rows, update
+        changed ones and leave the rest alone.
+        """
+        from jamsession.metrics import ImportMetrics
+        from jamsession.models import Schema
+        datadef = Schema(name='Companions', schema={'Name': 'string',
+                                                    'Doctor': 'int',
+                                                    'Age': 'int'})
+        datadef.save()
+        Companions = datadef.get_data_object()
+        path = self._write_csv("Name,Doctor,Age\n"
+                               "Rose,9,19\n"
+                               "Rose,10,20\n"
+                               "Rory,11,20\n")
+        importer = self._make_one(batch_size=2)
+        datadef, num_written = importer.load(path, datadef,
+                                             key_columns=['Name', 'Doctor'])
+        self.assertEqual(3, num_written)
+        rory_id = Companions.objects.get(Name='Rory').id
+
+        path = self._write_csv("Name,Doctor,Age\n"
+                               "Rose,9,19\n"
+                               "Rory,11,21\n"
+                               "Rose,10,20\n"
+                               "Amy,11,21\n")
+        metrics = ImportMetrics()
+        importer = self._make_one(batch_size=2, metrics=metrics)
+        datadef, num_written = importer.load(path, datadef,
+                                             key_columns=['Name', 'Doctor'])
+        self.assertEqual(2, num_written)
+        self.assertEqual({'rows_inserted': 1, 'rows_updated': 1,
+                          'rows_unchanged': 2}, metrics.counters)
+        self.assertEqual(4, Companions.objects.count())
+        rory = Companions.objects.get(Name='Rory')
+        self.assertEqual((rory_id, 21), (rory.id, rory.Age))
+
+    def test_incremental_import(self):
+        """
+        An incremental load should only write rows added to the file
+        since the last one.
+        """
+        from jamsession.models import IncrementalImportState
+        path = self._write_csv("Name,Age\n"
+                               "Rose,19\n"
+                               "Rory,20")
+        importer = self._make_one(batch_size=1)
+        datadef, num_created = importer.load(path, incremental=True)
+        self.assertEqual(2, num_created)
+        Obj = datadef.get_data_object()
+
+        with open(path, 'ab') as datafile:
+            datafile.write("\nAmy,21\n")
+        found_def, num_created = importer.load(path, incremental=True)
+        self.assertEqual((datadef.id, 1), (found_def.id, num_created))
+        self.assertEqual(0, importer.load(path, datadef,
+                                          incremental=True)[1])
+        self.assertEqual(['Amy', 'Rory', 'Rose'],
+                         sorted(obj.Name for obj in Obj.objects))
+        state = IncrementalImportState.objects.get(schema_id=str(datadef.id))
+        self.assertEqual((3, 4), (state.rows_done, state.line_num))
+
+    def test_incremental_import_changed(self):
+        """
+        Every row should be loaded again, in place of the old ones,
+        if any that were loaded before have changed.
+        """
+        path = self._write_csv("Name,Age\n"
+                               "Rose,19\n"
+                               "Rory,20\n")
+        importer = self._make_one()
+        datadef, num_created = importer.load(path, incremental=True)
+        Obj = datadef.get_data_object()
+
+        with open(path, 'wb') as datafile:
+            datafile.write("Name,Age\n"
+                           "Rose,20\n"
+                           "Rory,20\n"
+                           "Amy,21\n")
+        self.assertEqual(3, importer.load(path, datadef,
+                                          incremental=True)[1])
+        self.assertEqual([('Amy', 21), ('Rory', 20), ('Rose', 20)],
+                         sorted((obj.Name, obj.Age) for obj in Obj.objects))
+
+    def test_incremental_import_sources(self):
+        """
+        Replacing the rows of one changed file shouldn't touch
+        those loaded into the same schema from another.
+        """
+        rose = self._write_csv("Name,Age\n"
+                               "Rose,19\n")
+        amy = self._write_csv("Name,Age\n"
+                              "Amy,21\n")
+        importer = self._make_one()
+        datadef, num_created = importer.load(rose, incremental=True)
+        importer.load(amy, datadef, incremental=True)
+
+        with open(rose, 'wb') as datafile:
+            datafile.write("Name,Age\n"
+                           "Rose,20\n")
+        self.assertEqual(1, importer.load(rose, datadef,
+                                          incremental=True)[1])
+        with open(amy, 'ab') as datafile:
+            datafile.write("Rory,20\n")
+        self.assertEqual(1, importer.load(amy, datadef,
+                                          incremental=True)[1])
+        self.assertEqual([('Amy', 21), ('Rory', 20), ('Rose', 20)],
+                         sorted((obj.Name, obj.Age) for obj in
+                                datadef.get_data_object().objects))
+
+    def test_merge_import_blank_keys(self):
+        from jamsession.models import Schema, ImportFailed
+        datadef = Schema(name='Companions', schema={'Name': 'string',
+                                                    'Age': 'int'})
+        datadef.save()
+        path = self._write_csv("Name,Age\n"
+                               "Rose,19\n"
+                               ",20\n"
+                               ",21\n")
+        try:
+            self._make_one().load(path, datadef, key_columns=['Name'])
+            self.fail("ImportFailed not raised")
+        except ImportFailed, e:
+            self.assertEqual(2, e.error_count)
+            self.assertEqual([3, 4], [error[0] for error in e.row_errors])
+            self.assertEqual({'Name': 2}, e.column_errors)
+        self.assertEqual(0, datadef.get_data_object().objects.count())
+
+    def test_merge_import_unknown_key(self):
+        from jamsession.models import ImportFailed
+        self.assertRaises(ImportFailed, self._make_one().load,
+                          self._get_csv('cumulativeflow.csv'),
+                          key_columns=['Day'])
+
+
+class DatetimeCasterTests(JamTestCase):
+    def _get_target_class(self):
+        from jamsession.util import DatetimeCaster
+        return DatetimeCaster
+
+    def test_format_inferred_from_samples(self):
+        caster = self._make_one(['8/1/2010', '8/2/2010', '12/31/2010'])
+        self.assertEqual('%m/%d/%Y', caster.format)
+        self.assertEqual(datetime.datetime(2010, 8, 1), caster('8/1/2010'))
+
+    def test_format_inferred_despite_outliers(self):
+        """
+        An odd sample shouldn't stop the format most of them
+        match being used.
+        """
+        caster = self._make_one(['8/1/2010', 'N/A', '2010-08-03',
+                                 '12/31/2010'])
+        self.assertEqual('%m/%d/%Y', caster.format)
+        self.assertEqual(datetime.datetime(2010, 8, 3),
+                         caster('2010-08-03'))
+
+    def test_format_inferred_from_first_value(self):
+        caster = self._make_one()
+        self.assertEqual(datetime.datetime(2010, 8, 1), caster('2010-08-01'))
+        self.assertEqual('%Y-%m-%d', caster.format)
+
+    def test_falls_back_to_dateutil(self):
+        """
+        Values that don't match the inferred format should still parse.
+        """
+        caster = self._make_one(['8/1/2010'])
+        self.assertEqual(datetime.datetime(2010, 8, 1),
+                         caster('August 1st, 2010'))
+
+    def test_parsed_values_are_cached(self):
+        caster = self._make_one(['8/1/2010'], cache_size=1)
+        first = caster('8/1/2010')
+        caster('8/2/2010')
+        self.assert_(first is caster('8/1/2010'))
+        self.assertEqual(['8/1/2010'], caster.cache.keys())
+
+
+class KeysetPaginatorTests(JamTestCase):
+    def _get_target_class(self):
+        from jamsession.paginator import KeysetPaginator
+        return KeysetPaginator
+
+    def _make_companions(self, names):
+        from jamsession.models import Schema
+        datadef = Schema(name='Companions', schema={'name': 'string'})
+        Companions = datadef.get_data_object()
+        for name in names:
+            Companions.objects.create(name=name)
+        return Companions
+
+    def test_pages_forward_and_back(self):
+        Companions = self._make_companions(
+            ['Rose', 'Martha', 'Donna', 'Amy', 'Rory'])
+        paginator = self._make_one(Companions, per_page=2)
+
+        first = paginator.page()
+        self.assertEqual(['Rose', 'Martha'],
+                         [c.name for c in first.object_list])
+        self.assert_(first.has_next)
+        self.assertFalse(first.has_previous)
+
+        second = paginator.page(after=first.next_key)
+        self.assertEqual(['Donna', 'Amy'],
+                         [c.name for c in second.object_list])
+
+        last = paginator.page(after=second.next_key)
+        self.assertEqual(['Rory'], [c.name for c in last.object_list])
+        self.assertFalse(last.has_next)
+        self.assert_(last.has_previous)
+
+        back = paginator.page(before=last.previous_key)
+        self.assertEqual(['Donna', 'Amy'],
+                         [c.name for c in back.object_list])
+        self.assert_(back.has_next)
+        self.assert_(back.has_previous)
+
+    def test_bad_keys(self):
+        Companions = self._make_companions(['Rose'])
+        paginator = self._make_one(Companions)
+        self.assertRaises(ValueError, paginator.page, after='tardis')
+
+
+class ExportTests(JamTestCase):
+    def setUp(self):
+        super(ExportTests, self).setUp()
+        from jamsession.models import Schema
+        self.datadef = Schema(name='Companions',
+                              schema={'name': 'string',
+                                      'age': 'int',
+                                      'joined': 'datetime'})
+        Companions = self.datadef.get_data_object()
+        Companions.objects.create(
+            name=u'Rory', age=2000,
+            joined=datetime.datetime(2010, 4, 24))
+        Companions.objects.create(name=u'Amy', age=None, joined=None)
+
+    def test_iter_documents(self):
+        from jamsession.export import iter_documents
+        docs = list(iter_documents(self.datadef, ['name'], batch_size=1))
+        self.assertEqual(['Amy', 'Rory'], sorted(doc['name'] for doc in docs))
+
+        docs = iter_documents(self.datadef, batch_size=1)
+        docs.next()
+        docs.close()
+
+    def test_csv_float_precision(self):
+        from jamsession.export import format_csv_value
+        self.assertEqual('1234567.891011', format_csv_value(1234567.891011))
+        self.assertEqual(0.1, float(format_csv_value(0.1)))
+
+    def test_csv_export(self):
+        import csv
+        from jamsession.export import iter_csv
+        chunks = list(iter_csv(self.datadef, batch_size=1))
+        self.assert_(len(chunks) > 1)
+
+        rows = list(csv.reader(''.join(chunks).splitlines()))
+        self.assertEqual(['age', 'joined', 'name'], rows[0])
+        self.assertEqual(sorted([['2000', '2010-04-24T00:00:00', 'Rory'],
+                                 ['', '', 'Amy']]),
+                         sorted(rows[1:]))
+
+    def test_json_export(self):
+        from django.utils import simplejson
+        from jamsession.export import iter_json
+        rows = simplejson.loads(''.join(iter_json(self.datadef,
+                                                  batch_size=1)))
+        rory = [row for row in rows if row['name'] == 'Rory'][0]
+        self.assertEqual(2, len(rows))
+        self.assertEqual(2000, rory['age'])
+        self.assertEqual('2010-04-24T00:00:00', rory['joined'])
+        self.assertEqual(24, len(rory['_id']))
+
+    def test_ndjson_export(self):
+        from django.utils import simplejson
+        from jamsession.export import iter_ndjson
+        lines = ''.join(iter_ndjson(self.datadef, batch_size=1)).splitlines()
+        names = sorted(simplejson.loads(line)['name'] for line in lines)
+        self.assertEqual(['Amy', 'Rory'], names)
+
+    def test_empty_json_export(self):
+        from django.utils import simplejson
+        from jamsession.export import iter_json
+        self.datadef.get_data_object().objects.delete()
+        self.assertEqual([], simplejson.loads(''.join(
+            iter_json(self.datadef))))
+
+    def test_parquet_export(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest("pyarrow isn't installed")
+        from jamsession.export import iter_parquet
+        data = ''.join(iter_parquet(self.datadef, batch_size=1))
+        parquet = pq.ParquetFile(pyarrow.BufferReader(data))
+        self.assertEqual(2, parquet.num_row_groups)
+
+        table = parquet.read()
+        self.assertEqual(['_id', 'age', 'joined', 'name'],
+                         table.schema.names)
+        self.assertEqual(pyarrow.int64(), table.schema.field('age').type)
+        rows = dict((row['name'], row) for row in table.to_pylist())
+        self.assertEqual(2000, rows['Rory']['age'])
+        self.assertEqual(None, rows['Amy']['age'])
+        self.assertEqual(datetime.datetime(2010, 4, 24),
+                         rows['Rory']['joined'])
+
+
+class AggregationTests(JamTestCase):
+    def setUp(self):
+        super(AggregationTests, self).setUp()
+        from jamsession.models import Schema
+        self.datadef = Schema(name='Episodes',
+                              schema={'doctor': 'int',
+                                      'minutes': 'int',
+                                      'aired': 'datetime'})
+        self.Episodes = self.datadef.get_data_object()
+        for doctor, minutes, aired in [
+                (10, 45, datetime.datetime(2010, 3, 1, 19)),
+                (10, 60, datetime.datetime(2010, 3, 1, 20)),
+                (11, 45, datetime.datetime(2010, 4, 3, 18)),
+                (11, 50, datetime.datetime(2010, 4, 10, 18)),
+                (11, 45, None), ]:
+            self.Episodes.objects.create(doctor=doctor, minutes=minutes,
+                                         aired=aired)
+
+    def test_group_by(self):
+        rows = self.Episodes.aggregate().group_by('doctor') \
+            .sum('minutes').max('minutes').count().execute()
+        self.assertEqual(
+            [{'doctor': 10, 'minutes__sum': 105,
+              'minutes__max': 60, 'count': 2},
+             {'doctor': 11, 'minutes__sum': 140,
+              'minutes__max': 50, 'count': 3}],
+            rows)
+
+    def test_time_buckets(self):
+        """
+        Bucketing should group on the truncated date and
+        leave out rows with no date.
+        """
+        rows = list(self.Episodes.aggregate().bucket('aired', 'month')
+                    .avg('minutes'))
+        self.assertEqual(
+            [{'aired': datetime.datetime(2010, 3, 1), 'minutes__avg': 52.5},
+             {'aired': datetime.datetime(2010, 4, 1), 'minutes__avg': 47.5}],
+            rows)
+
+    def test_week_buckets_across_years(self):
+        """
+        A week spanning New Year should be one bucket.
+        """
+        for minutes, aired in [(60, datetime.datetime(2009, 12, 29)),
+                               (30, datetime.datetime(2010, 1, 1)),
+                               (55, datetime.datetime(2010, 1, 3))]:
+            self.Episodes.objects.create(doctor=11, minutes=minutes,
+                                         aired=aired)
+        rows = self.Episodes.aggregate().match(doctor=11) \
+            .bucket('aired', 'week').sum('minutes').avg('minutes') \
+            .count().execute()
+        self.assertEqual(
+            [{'aired': datetime.datetime(2009, 12, 27), 'count': 2,
+              'minutes__sum': 90, 'minutes__avg': 45.0},
+             {'aired': datetime.datetime(2010, 1, 3), 'count': 1,
+              'minutes__sum': 55, 'minutes__avg': 55.0},
+             {'aired': datetime.datetime(2010, 3, 28), 'count': 1,
+              'minutes__sum': 45, 'minutes__avg': 45.0},
+             {'aired': datetime.datetime(2010, 4, 4), 'count': 1,
+              'minutes__sum': 50, 'minutes__avg': 50.0}],
+            rows)
+
+    def test_match(self):
+        rows = self.Episodes.aggregate().match(doctor=11) \
+            .bucket('aired', 'day').count().execute()
+        self.assertEqual([datetime.datetime(2010, 4, 3),
+                          datetime.datetime(2010, 4, 10)],
+                         [row['aired'] for row in rows])
+
+    def test_bad_specs(self):
+        from jamsession.aggregation import AggregationError
+        aggregation = self.Episodes.aggregate()
+        self.assertRaises(AggregationError, aggregation.bucket,
+                          'aired', 'fortnight')
+        self.assertRaises(AggregationError, aggregation.accumulate,
+                          'median', 'minutes')
+
+
+class RollupTests(JamTestCase):
+    def setUp(self):
+        super(RollupTests, self).setUp()
+        from jamsession.models import Schema
+        self.datadef = Schema(
+            name='Episodes',
+            schema={'doctor': 'int', 'minutes': 'int', 'aired': 'datetime'},
+            rollups=[{'name': 'monthly',
+                      'bucket': ['aired', 'month'],
+                      'sum': ['minutes']},
+                     {'name': 'by_doctor',
+                      'group_by': ['doctor'],
+                      'sum': ['minutes']}])
+        self.expected_monthly = [
+            {'aired': datetime.datetime(2010, 3, 1),
+             'minutes__sum': 105, 'count': 2},
+            {'aired': datetime.datetime(2010, 4, 1),
+             'minutes__sum': 45, 'count': 1}, ]
+
+    def _get_csv(self):
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, "doctor,minutes,aired\n"
+                     "10,45,2010-03-01\n"
+                     "10,60,2010-03-08\n"
+                     "11,45,2010-04-03\n"
+                     "11,50,\n")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def _get_rollup(self, name):
+        from jamsession.rollups import get_rollup
+        return get_rollup(self.datadef.get_data_object(), name)
+
+    def test_rollups_updated_by_imports(self):
+        from jamsession.models import CSVImporter
+        for options in [{}, {'stream': True}]:
+            CSVImporter(batch_size=2).load(self._get_csv(), self.datadef,
+                                           **options)
+        doubled = [dict(row, minutes__sum=row['minutes__sum'] * 2,
+                        count=row['count'] * 2)
+                   for row in self.expected_monthly]
+        self.assertEqual(doubled, self._get_rollup('monthly'))
+        self.assertEqual([{'doctor': 10, 'minutes__sum': 210, 'count': 4},
+                          {'doctor': 11, 'minutes__sum': 190, 'count': 4}],
+                         self._get_rollup('by_doctor'))
+
+    def test_rollups_updated_by_new_rows(self):
+        Episodes = self.datadef.get_data_object()
+        Episodes.objects.create(
+            doctor=11, minutes=45, aired=datetime.datetime(2010, 4, 3))
+        episode = Episodes.objects.create(
+            doctor=11, minutes=50, aired=datetime.datetime(2010, 4, 10))
+        self.assertEqual([{'aired': datetime.datetime(2010, 4, 1),
+                           'minutes__sum': 95, 'count': 2}],
+                         self._get_rollup('monthly'))
+
+        episode.delete()
+        self.assertEqual([{'aired': datetime.datetime(2010, 4, 1),
+                           'minutes__sum': 45, 'count': 1}],
+                         self._get_rollup('monthly'))
+
+    def test_rebuild_rollups(self):
+        from jamsession.models import CSVImporter
+        from jamsession.rollups import rebuild_rollups
+        CSVImporter().load(self._get_csv(), self.datadef)
+        Episodes = self.datadef.get_data_object()
+        Episodes.objects(doctor=11).delete()
+
+        rebuild_rollups(Episodes)
+        self.assertEqual(self.expected_monthly[:1],
+                         self._get_rollup('monthly'))
+
+    def test_rebuild_week_rollup_across_years(self):
+        from jamsession.rollups import rebuild_rollups
+        self.datadef.rollups = [{'name': 'weekly',
+                                 'bucket': ['aired', 'week'],
+                                 'sum': ['minutes']}]
+        Episodes = self.datadef.get_data_object()
+        for minutes, aired in [(60, datetime.datetime(2009, 12, 29)),
+                               (30, datetime.datetime(2010, 1, 1))]:
+            Episodes.objects.create(doctor=11, minutes=minutes, aired=aired)
+        expected = [{'aired': datetime.datetime(2009, 12, 27),
+                     'minutes__sum': 90, 'count': 2}]
+        self.assertEqual(expected, self._get_rollup('weekly'))
+
+        rebuild_rollups(Episodes)
+        self.assertEqual(expected, self._get_rollup('weekly'))
+
+    def test_sums_must_be_numeric(self):
+        from mongoengine import ValidationError
+        for spec in [{'name': 'bad', 'sum': ['aired']},
+                     {'name': 'bad', 'sum': ['seconds']},
+                     {'name': 'bad', 'bucket': ['doctor', 'day']}]:
+            self.datadef.rollups = [spec]
+            self.assertRaises(ValidationError, self.datadef.save)
+
+    def test_truncate_datetime(self):
+        from jamsession.rollups import truncate_datetime
+        aired = datetime.datetime(2011, 1, 1, 19, 30)
+        self.assertEqual(datetime.datetime(2011, 1, 1, 19),
+                         truncate_datetime(aired, 'hour'))
+        self.assertEqual(datetime.datetime(2011, 1, 1),
+                         truncate_datetime(aired, 'year'))
+        self.assertEqual(datetime.datetime(2010, 12, 26),
+                         truncate_datetime(aired, 'week'))
+
+
+class SchemaMigrationTests(JamTestCase):
+    def setUp(self):
+        super(SchemaMigrationTests, self).setUp()
+        from jamsession.models import Schema
+        self.datadef = Schema(name='Companions',
+                              schema={'name': 'string',
+                                      'age': 'string',
+                                      'planet': 'string',
+                                      'ship': 'string'})
+        self.datadef.save()
+        Companions = self.datadef.get_data_object()
+        for name, age, planet in [('Rose', '19', 'Earth'),
+                                  ('Amy', '21', 'Earth'),
+                                  ('Rory', 'old', 'Earth'),
+                                  ('K-9', None, 'Earth')]:
+            Companions.objects.create(name=name, age=age, planet=planet,
+                                      ship='TARDIS')
+        self.new_schema = {'name': 'string',
+                           'age': 'int',
+                           'homeworld': 'string',
+                           'joined': 'datetime'}
+
+    def _make_one(self, **kwargs):
+        from jamsession.migration import SchemaMigration
+        return SchemaMigration(self.datadef, self.new_schema,
+                               renames={'planet': 'homeworld'}, **kwargs)
+
+    def test_diff(self):
+        from jamsession.migration import diff_schemas
+        diff = diff_schemas(self.datadef.schema, self.new_schema,
+                            {'planet': 'homeworld'})
+        self.assertEqual({'added': ['joined'],
+                          'dropped': ['ship'],
+                          'renamed': {'planet': 'homeworld'},
+                          'retyped': {'age': ('string', 'int')}},
+                         diff)
+
+    def test_bad_renames(self):
+        from jamsession.migration import diff_schemas, MigrationFailed
+        self.assertRaises(MigrationFailed, diff_schemas,
+                          self.datadef.schema, self.new_schema,
+                          {'species': 'homeworld'})
+        self.assertRaises(MigrationFailed, diff_schemas,
+                          self.datadef.schema, self.new_schema,
+                          {'planet': 'galaxy'})
+
+    def test_migrate(self):
+        states = []
+        state = self._make_one(batch_size=2, progress=states.append).run()
+        self.assertEqual('done', state.stage)
+        self.assertEqual(4, state.rows_done)
+        self.assertEqual(1, state.failures)
+        self.assertEqual(1, len(state.errors))
+        self.assert_(len(states) > 3)
+
+        from jamsession.models import Schema
+        datadef = Schema.objects.get(id=self.datadef.id)
+        self.assertEqual(self.new_schema, datadef.schema)
+
+        Companions = datadef.get_data_object()
+        ages = dict((c.name, c.age) for c in Companions.objects)
+        self.assertEqual({'Rose': 19, 'Amy': 21, 'Rory': None, 'K-9': None},
+                         ages)
+        raw = Companions.objects._collection.find_one({'name': 'Amy'})
+        self.assertEqual('Earth', raw['homeworld'])
+        self.assert_('planet' not in raw)
+        self.assert_('ship' not in raw)
+
+    def test_resume(self):
+        """
+        An interrupted migration should carry on from its last batch.
+        """
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(state):
+            if state.rows_done:
+                raise Interrupted()
+
+        self.assertRaises(Interrupted,
+                          self._make_one(batch_size=2,
+                                         progress=interrupt).run)
+
+        state = self._make_one(batch_size=2).run()
+        self.assertEqual('done', state.stage)
+        self.assertEqual(4, state.rows_done)
+
+    def test_migrate_indexes_and_rollups(self):
+        """
+        Indexes and rollups should follow renamed columns and go
+        with dropped ones.
+        """
+        self.datadef.indexes = [{'fields': ['planet', 'name']},
+                                {'fields': ['ship'], 'unique': False}]
+        self.datadef.rollups = [{'name': 'planets', 'group_by': ['planet']},
+                                {'name': 'ships', 'group_by': ['ship']}]
+        self.datadef.save()
+        self._make_one().run()
+
+        from jamsession.models import Schema
+        from jamsession.rollups import get_rollup
+        datadef = Schema.objects.get(id=self.datadef.id)
+        self.assertEqual([{'fields': ['homeworld', 'name']}],
+                         datadef.indexes)
+        self.assertEqual([{'name': 'planets', 'group_by': ['homeworld']}],
+                         datadef.rollups)
+        rows = get_rollup(datadef.get_data_object(), 'planets')
+        self.assertEqual([('Earth', 4)],
+                         [(row['homeworld'], row['count']) for row in rows])
+
+    def test_recast_numbers(self):
+        """
+        Numbers should be converted directly, not from their text.
+        """
+        from jamsession.migration import SchemaMigration
+        from jamsession.models import Schema
+        datadef = Schema(name='Scores', schema={'score': 'float'})
+        datadef.save()
+        Scores = datadef.get_data_object()
+        for score in [45.0, 2.5, 1.0]:
+            Scores.objects.create(score=score)
+
+        state = SchemaMigration(datadef, {'score': 'int'}).run()
+        self.assertEqual(1, state.failures)
+        raw = Scores.objects._collection.find()
+        self.assertEqual([None, 1, 45], sorted(doc['score'] for doc in raw))
+
+    def test_recast_float_to_string(self):
+        """
+        Floats should keep every digit when they become strings.
+        """
+        from jamsession.migration import SchemaMigration
+        from jamsession.models import Schema
+        datadef = Schema(name='Scores', schema={'score': 'float'})
+        datadef.save()
+        Scores = datadef.get_data_object()
+        Scores.objects.create(score=1.0 / 3)
+
+        SchemaMigration(datadef, {'score': 'string'}).run()
+        raw = Scores.objects._collection.find_one()
+        self.assertEqual(repr(1.0 / 3), raw['score'])
+
+
+class LazyRowTests(JamTestCase):
+    def setUp(self):
+        super(LazyRowTests, self).setUp()
+        from jamsession.models import Schema
+        self.datadef = Schema(name='Companions',
+                              schema={'name': 'string',
+                                      'age': 'int',
+                                      'joined': 'datetime'})
+        self.Companions = self.datadef.get_data_object()
+        self.Companions.objects.create(
+            name=u'Rory', age=2000, joined=datetime.datetime(2010, 4, 24))
+        self.Companions.objects.create(name=u'Amy', age=21)
+
+    def test_projection(self):
+        rows = list(self.Companions.rows('name', 'age', sort=[('age', 1)]))
+        self.assertEqual(['Amy', 'Rory'], [row['name'] for row in rows])
+        self.assertEqual([21, 2000], [row.age for row in rows])
+        self.assertEqual(None, rows[0]['joined'])
+        self.assertEqual(sorted(['name', 'age']), sorted(rows[0].keys()))
+
+    def test_values_converted_once(self):
+        row = list(self.Companions.rows(spec={'name': 'Rory'}))[0]
+        self.assertEqual(None, row._values)
+        joined = row['joined']
+        self.assertEqual(datetime.datetime(2010, 4, 24), joined)
+        self.assertEqual(['joined'], row._values.keys())
+        self.assert_(row.joined is joined)
+
+    def test_unknown_columns(self):
+        row = list(self.Companions.rows())[0]
+        self.assertRaises(KeyError, lambda: row['planet'])
+        self.assertRaises(AttributeError, lambda: row.planet)
+        self.assertEqual('Earth', row.get('planet', 'Earth'))
+        self.assertRaises(AttributeError, setattr, row, 'planet', 'Earth')
+
+
+class QueryCacheTests(JamTestCase):
+    def setUp(self):
+        super(QueryCacheTests, self).setUp()
+        from django.core.cache import cache
+        from jamsession.cache import forget_all
+        from jamsession.models import Schema
+        cache.clear()
+        forget_all()
+        self.datadef = Schema(name='Companions',
+                              schema={'name': 'string', 'age': 'int'})
+        self.datadef.save()
+        self.Companions = self.datadef.get_data_object()
+        self.Companions.objects.create(name=u'Rory', age=2000)
+
+    def _names(self, **spec):
+        from jamsession.cache import cached_rows
+        page = cached_rows(self.Companions, spec, ['name'])
+        return sorted(row['name'] for row in page.object_list)
+
+    def test_cached_rows(self):
+        self.assertEqual([u'Rory'], self._names())
+        self.Companions.objects._collection.insert(
+            {'name': u'Amy', 'age': 21})
+        self.assertEqual([u'Rory'], self._names())
+        self.assertEqual([u'Amy'], self._names(age=21))
+
+    def test_cached_pages(self):
+        from jamsession.cache import cached_rows
+        self.Companions.objects.create(name=u'Amy', age=21)
+        first = cached_rows(self.Companions, per_page=1)
+        self.assertEqual([u'Rory'], [row.name for row in first.object_list])
+        second = cached_rows(self.Companions, after=first.next_key,
+                             per_page=1)
+        self.assertEqual([u'Amy'], [row.name for row in second.object_list])
+        self.assertEqual((False, True),
+                         (second.has_next, second.has_previous))
+
+    def test_save_invalidates(self):
+        from jamsession.cache import cached_count
+        self.assertEqual([u'Rory'], self._names())
+        self.assertEqual(1, cached_count(self.Companions))
+        amy = self.Companions.objects.create(name=u'Amy', age=21)
+        self.assertEqual([u'Amy', u'Rory'], self._names())
+        self.assertEqual(2, cached_count(self.Companions))
+        amy.delete()
+        self.assertEqual([u'Rory'], self._names())
+
+    def test_import_invalidates(self):
+        import tempfile
+        from jamsession.models import CSVImporter
+        self.assertEqual([u'Rory'], self._names())
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, "name,age\nAmy,21\n")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        CSVImporter().load(path, self.datadef)
+        self.assertEqual([u'Amy', u'Rory'], self._names())
+
+    def test_cached(self):
+        from jamsession.cache import cached
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+        query = {'age': {'$gt': 20}, 'name': 'Rory'}
+        same_query = dict(reversed(query.items()))
+        self.assertEqual(1, cached('x', 'Companions', query, compute))
+        self.assertEqual(1, cached('x', 'Companions', same_query, compute))
+        self.assertEqual(2, cached('y', 'Companions', query, compute))
+
+
+class ImportJobTests(JamTestCase):
+    def setUp(self):
+        super(ImportJobTests, self).setUp()
+        self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'fixtures', 'cumulativeflow.csv')
+
+    def _queue(self, **kwargs):
+        from jamsession.jobs import queue_import
+        return queue_import(self.path, **kwargs)
+
+    def _get_job(self, job):
+        from jamsession.models import ImportJob
+        return ImportJob.objects.get(id=job.id)
+
+    def test_run_job(self):
+        from jamsession.jobs import claim_import_job, run_import_job
+        from jamsession.models import Schema
+        self._queue()
+        job = claim_import_job('test')
+        self.assertEqual('running', job.status)
+        self.assertEqual(1, job.attempts)
+        self.assertEqual(None, claim_import_job('test'))
+
+        run_import_job(job, batch_size=10)
+        job = self._get_job(job)
+        self.assertEqual('done', job.status)
+        self.assertEqual(91, job.rows_done)
+        self.assertEqual(100.0, job.percent_complete)
+        datadef = Schema.objects.get(id=job.schema_id)
+        self.assertEqual(91, datadef.get_data_object().objects.count())
+
+    def test_cancel_queued_job(self):
+        from jamsession.jobs import (claim_import_job, cancel_import_job,
+                                     retry_import_job)
+        job = self._queue()
+        self.assert_(cancel_import_job(job))
+        self.assertEqual('cancelled', self._get_job(job).status)
+        self.assertEqual(None, claim_import_job('test'))
+
+        self.assert_(retry_import_job(job))
+        self.assertEqual('queued', self._get_job(job).status)
+        self.assertEqual(job.id, claim_import_job('test').id)
+
+    def test_cancel_running_job(self):
+        """
+        A running job should stop, and the rows it wrote be removed.
+        """
+        from jamsession.jobs import (claim_import_job, cancel_import_job,
+                                     run_import_job)
+        from jamsession.models import Schema, ImportCheckpoint
+        datadef = Schema(name='Cumulative Flow',
+                         schema={'Date': 'datetime', 'Backlog': 'int'})
+        datadef.save()
+        self._queue(datadef=datadef)
+        job = claim_import_job('test')
+        self.assert_(cancel_import_job(job))
+
+        run_import_job(job, batch_size=10)
+        self.assertEqual('cancelled', self._get_job(job).status)
+        self.assertEqual(0, datadef.get_data_object().objects.count())
+        self.assertEqual(0, ImportCheckpoint.objects.count())
+
+    def test_job_taken_over(self):
+        """
+        A worker whose job was claimed by another should stop without
+        recording anything on it or touching its checkpoint.
+        """
+        from jamsession.jobs import (claim_import_job, run_import_job,
+                                     update_job)
+        from jamsession.models import ImportCheckpoint
+        self._queue()
+        job = claim_import_job('slow')
+        update_job(self._get_job(job), worker='fast')
+
+        run_import_job(job, batch_size=10)
+        job = self._get_job(job)
+        self.assertEqual(('running', 'fast'), (job.status, job.worker))
+        self.assertEqual(1, ImportCheckpoint.objects.count())
+
+    def test_failed_job_retried(self):
+        from jamsession.jobs import claim_import_job, run_import_job
+        job = self._queue(max_attempts=2)
+        job.datafile = '/no/such/file.csv'
+        job.save()
+
+        for status in ('queued', 'failed'):
+            run_import_job(claim_import_job('test'))
+            job = self._get_job(job)
+            self.assertEqual(status, job.status)
+            self.assert_(job.error)
+        self.assertEqual(2, job.attempts)
+
+    def test_worker(self):
+        from jamsession.jobs import ImportWorker
+        jobs = [self._queue(), self._queue()]
+        ImportWorker(concurrency=2, poll_interval=0.01,
+                     batch_size=10).run(once=True)
+        self.assertEqual(['done', 'done'],
+                         [self._get_job(job).status for job in jobs])
+
+
+class BenchmarkTests(JamTestCase):
+    def test_make_csv(self):
+        import csv
+        from jamsession.benchmarks import make_csv, cumulative_flow_schema
+        path = make_csv(5, width=24, type_mix=('float', 'bool'))
+        self.addCleanup(os.remove, path)
+        rows = list(csv.reader(open(path)))
+        self.assertEqual(6, len(rows))
+        self.assertEqual(['Extra 21 float', 'Extra 22 bool',
+                          'Extra 23 float'], rows[0][21:])
+        schema = cumulative_flow_schema(24, ('float', 'bool')).schema
+        self.assertEqual('bool', schema['Extra 22 bool'])
+        self.assertEqual(24, len(schema))
+
+    def test_run_suite(self):
+        from jamsession.benchmarks import run_suite
+        suite = run_suite(names=['prepare_row', 'get_data_object'],
+                          num_rows=10)
+        self.assertEqual(['get_data_object', 'prepare_row'],
+                         sorted(set(result['benchmark']
+                                    for result in suite['results'])))
+        self.assertEqual(10, suite['params']['num_rows'])
+
+    def test_lazy_rows_narrow(self):
+        """
+        The columns read by default should exist however narrow
+        the CSV is.
+        """
+        from jamsession.benchmarks import bench_lazy_rows
+        results = bench_lazy_rows(num_rows=10, width=2)
+        self.assertEqual(['documents', 'lazy_rows'],
+                         [result['path'] for result in results])
+
 
 class SchemaFormTests(JamTestCase):
     """Tests for the form to create Schemas"""
@@ -314,6 +1806,55 @@ Name,string"""
             f = Form(data)
             self.assert_('schema' not in f.errors.keys())
 
+    def test_schema_indexes(self):
+        Form = self._get_target_klass()
+        data = {'name': 'Indexed',
+                'schema': """Name,string,unique
+Date,datetime,index
+Team,string
+@index,Date,Team"""}
+        f = Form(data)
+        self.assert_(f.is_valid(), f.errors)
+        self.assertEqual([{'fields': ['Name'], 'unique': True},
+                          {'fields': ['Date'], 'unique': False},
+                          {'fields': ['Date', 'Team'], 'unique': False}],
+                         f.cleaned_data['schema'].indexes)
+
+        obj = f.save()
+        self.assertEqual(3, len(obj.indexes))
+
+    def test_schema_indexes_should_be_created(self):
+        """
+        A Schema whose indexes can't be created shouldn't be saved.
+        """
+        from mongoengine import ValidationError
+        from jamsession.models import Schema
+        Clones = Schema(name='Clones', schema={'Name': 'string'})
+        Clones.save()
+        DataObj = Clones.get_data_object()
+        for name in ['Amy', 'Amy']:
+            DataObj.objects.create(Name=name)
+        Clones.delete()
+
+        Form = self._get_target_klass()
+        f = Form({'name': 'Clones', 'schema': 'Name,string,unique'})
+        self.assert_(f.is_valid(), f.errors)
+        self.assertRaises(ValidationError, f.save)
+        self.assert_('schema' in f.errors.keys())
+        self.assertEqual(0, Schema.objects(name='Clones').count())
+
+    def test_schema_indexes_should_be_valid(self):
+        Form = self._get_target_klass()
+        invalid_datas = [
+            {'schema': 'Name,string,primary'},
+            {'schema': 'Name,string\n@index,Age'},
+            {'schema': 'Name,string\n@unique'},
+        ]
+        for data in invalid_datas:
+            f = Form(data)
+            msg = "Data %s should've created an error but it didn't" % (data, )
+            self.assert_('schema' in f.errors.keys(), msg)
+
     def test_name_should_be_unique(self):
         Form = self._get_target_klass()
         data = {'name': 'Amy Pond',
@@ -402,3 +1943,100 @@ class DataDefAdminFuncTests(JamFuncTestCase):
         data = {'_save': "Save"}
         expected_url = lambda i: self._get_changelist_url()
         self._test_save_handling(data, expected_url)
+
+
+class DataObjectChangelistFuncTests(JamFuncTestCase):
+    def setUp(self):
+        super(DataObjectChangelistFuncTests, self).setUp()
+        self.login()
+        from jamsession.models import Schema
+        self.datadef = Schema(name='Companions',
+                              schema={'name': 'string', 'age': 'int'})
+        self.datadef.save()
+        self.datadef.get_data_object().objects.create(name='Rory', age=2000)
+
+    def _get_target_url(self):
+        return reverse('jamsession:admin-data-object-changelist',
+                       kwargs={'object_id': self.datadef.id})
+
+    def test_rows_are_listed(self):
+        response = self.client.get(self.target_url)
+        self.assertContains(response, 'Rory')
+        self.assertContains(response, '2000')
+
+    def test_bad_page_key(self):
+        response = self.client.get(self.target_url, {'after': 'tardis'})
+        self.assertEqual(404, response.status_code)
+
+    def test_rows_are_cached(self):
+        """
+        Rows should be served from the cache until an import
+        changes them.
+        """
+        from django.core.cache import cache
+        from jamsession.cache import forget_all
+        from jamsession.models import CSVImporter
+        cache.clear()
+        forget_all()
+        self.assertContains(self.client.get(self.target_url), 'Rory')
+
+        DataObj = self.datadef.get_data_object()
+        DataObj.objects._collection.insert({'name': u'Amy', 'age': 21})
+        self.assertNotContains(self.client.get(self.target_url), 'Amy')
+
+        import tempfile
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, "name,age\nClara,26\n")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        CSVImporter().load(path, self.datadef)
+        response = self.client.get(self.target_url)
+        self.assertContains(response, 'Amy')
+        self.assertContains(response, 'Clara')
+
+    def _get_export_url(self, format):
+        return reverse('jamsession:admin-data-object-export',
+                       kwargs={'object_id': self.datadef.id,
+                               'format': format})
+
+    def test_csv_export(self):
+        response = self.client.get(self._get_export_url('csv'))
+        self.assertEqual('text/csv', response['Content-Type'])
+        self.assertContains(response, 'Rory')
+
+    def test_unknown_export_format(self):
+        response = self.client.get(self._get_export_url('xls'))
+        self.assertEqual(404, response.status_code)
+
+
+class ImportJobsFuncTests(JamFuncTestCase):
+    def setUp(self):
+        super(ImportJobsFuncTests, self).setUp()
+        self.login()
+        from jamsession.jobs import queue_import
+        self.job = queue_import(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            'fixtures', 'cumulativeflow.csv'))
+
+    def _get_target_url(self):
+        return reverse('jamsession:admin-import-jobs')
+
+    def _get_action_url(self, action):
+        return reverse('jamsession:admin-import-job-action',
+                       kwargs={'job_id': self.job.id, 'action': action})
+
+    def test_jobs_are_listed(self):
+        response = self.client.get(self.target_url)
+        self.assertContains(response, 'cumulativeflow.csv')
+        self.assertContains(response, 'queued')
+
+    def test_cancel(self):
+        from jamsession.models import ImportJob
+        response = self.client.post(self._get_action_url('cancel'))
+        self.assertRedirects(response, self.target_url)
+        self.assertEqual('cancelled',
+                         ImportJob.objects.get(id=self.job.id).status)
+
+    def test_unknown_action(self):
+        response = self.client.post(self._get_action_url('explode'))
+        self.assertEqual(404, response.status_code)
@@ -2,7 +2,11 @@ from django.conf.urls.defaults import *
 
 from jamsession.views.admin import (DashboardView,
                                     AdminCreateView,
+                                    DataObjectChangelistView,
+                                    ImportJobsView,
                                     edit_object,
+                                    import_job_action,
+                                    export_rows,
                                     changelist
                                     )
 
@@ -10,5 +14,9 @@ urlpatterns = patterns('',
     url(r'^admin/$', DashboardView.as_view(), name="admin-dashboard"),
     url(r'^admin/(?P<object_type>\w+)/add/$', AdminCreateView.as_view(), name='admin-create-object'),
     url(r'^admin/(?P<object_type>\w+)/edit/(?P<object_id>(.*?))/$', edit_object, name='admin-edit-object'),
+    url(r'^admin/schema/(?P<object_id>[0-9a-f]{24})/rows/$', DataObjectChangelistView.as_view(), name='admin-data-object-changelist'),
+    url(r'^admin/schema/(?P<object_id>[0-9a-f]{24})/export/(?P<format>\w+)/$', export_rows, name='admin-data-object-export'),
+    url(r'^admin/imports/$', ImportJobsView.as_view(), name='admin-import-jobs'),
+    url(r'^admin/imports/(?P<job_id>[0-9a-f]{24})/(?P<action>\w+)/$', import_job_action, name='admin-import-job-action'),
     url(r'^admin/(?P<object_type>\w+)/$', changelist, name='admin-changelist-object'),
 )
@@ -1,3 +1,8 @@
+import os
+import csv
+from datetime import datetime
+from itertools import islice
+
 from mongoengine import (
     StringField,
     URLField,
@@ -18,3 +23,236 @@ FIELD_TYPE_TRANSLATIONS = {
     'bool': BooleanField,
     'datetime': DateTimeField
 }
+
+
+def chunked(iterable, size):
+    """
+    Yield successive lists of at most ``size`` items from ``iterable``
+    without materializing the whole thing.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class LineReader(object):
+    """
+    Iterates over the lines of a file opened in binary mode, keeping
+    track of the byte offset of the next unread line. Handing one to a
+    csv reader lets imports know exactly where each record ends.
+
+    Reading starts at byte start and stops at the first line beginning
+    at or after byte end.
+    """
+    def __init__(self, fileobj, start=0, end=None):
+        self.fileobj = fileobj
+        if start:
+            fileobj.seek(start)
+        self.offset = start
+        self.end = end
+        self.line_num = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.end is not None and self.offset >= self.end:
+            raise StopIteration
+        line = self.fileobj.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        self.line_num += 1
+        return line
+
+
+#: Bytes read at a time when looking through a file for quotes.
+SCAN_BLOCK_SIZE = 1024 * 1024
+
+
+def contains_quotes(path, start=0):
+    """
+    Whether there's a double quote in path after byte start.
+    """
+    datafile = open(path, 'rb')
+    try:
+        datafile.seek(start)
+        while True:
+            block = datafile.read(SCAN_BLOCK_SIZE)
+            if not block:
+                return False
+            if '"' in block:
+                return True
+    finally:
+        datafile.close()
+
+
+def split_records(path, start, num_chunks, step, size):
+    """
+    Boundaries for split_lines found by reading every record of path
+    from start with a csv reader, so none falls inside a quoted field.
+    """
+    boundaries = [start]
+    lines = LineReader(open(path, 'rb'), start)
+    try:
+        for record in csv.reader(lines):
+            if len(boundaries) == num_chunks:
+                break
+            position = lines.offset
+            if position >= boundaries[-1] + step and position < size:
+                boundaries.append(position)
+    finally:
+        lines.fileobj.close()
+    return boundaries
+
+
+def split_at_lines(path, start, num_chunks, step, size):
+    """
+    Boundaries for split_lines found by seeking to each one and
+    reading on to the start of the next line.
+    """
+    boundaries = [start]
+    datafile = open(path, 'rb')
+    try:
+        for i in range(1, num_chunks):
+            datafile.seek(start + step * i - 1)
+            datafile.readline()
+            position = datafile.tell()
+            if position >= size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    finally:
+        datafile.close()
+    return boundaries
+
+
+def split_lines(path, start, num_chunks):
+    """
+    Split the bytes of path from start to the end of the file into
+    at most num_chunks (start, end) ranges, each beginning on a new
+    record.
+
+    A quoted field can hold newlines, so a file with quotes in it is
+    split by parsing it up to the last boundary, see split_records.
+    Others are split with split_at_lines, which doesn't read them.
+    """
+    size = os.path.getsize(path)
+    step = max((size - start) // num_chunks, 1)
+    if contains_quotes(path, start):
+        boundaries = split_records(path, start, num_chunks, step, size)
+    else:
+        boundaries = split_at_lines(path, start, num_chunks, step, size)
+    boundaries.append(size)
+    return [(begin, end) for begin, end
+            in zip(boundaries[:-1], boundaries[1:]) if begin < end]
+
+
+def numbered_rows(reader):
+    """
+    Yield (line number, row) for each record of a csv reader,
+    numbering each record by the line it starts on.
+    """
+    line_num = reader.line_num
+    for row in reader:
+        yield line_num + 1, row
+        line_num = reader.line_num
+
+
+DATETIME_FORMATS = (
+    '%m/%d/%Y',
+    '%m/%d/%y',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %I:%M %p',
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%d %b %Y',
+    '%b %d %Y',
+    '%Y%m%d',
+)
+
+
+def infer_datetime_format(samples, formats=DATETIME_FORMATS):
+    """
+    Return the first of formats that every non-blank sample
+    can be parsed with, or None.
+    """
+    samples = [sample.strip() for sample in samples
+               if sample and sample.strip()]
+    if not samples:
+        return None
+    for fmt in formats:
+        try:
+            for sample in samples:
+                datetime.strptime(sample, fmt)
+        except ValueError:
+            continue
+        return fmt
+    return None
+
+
+def best_datetime_format(samples, formats=DATETIME_FORMATS):
+    """
+    The first of formats that the most non-blank samples can be
+    parsed with, or None if none of them can be.
+    """
+    samples = [sample.strip() for sample in samples
+               if sample and sample.strip()]
+    best, best_count = None, 0
+    for fmt in formats:
+        matched = 0
+        for sample in samples:
+            try:
+                datetime.strptime(sample, fmt)
+            except ValueError:
+                continue
+            matched += 1
+        if matched > best_count:
+            best, best_count = fmt, matched
+    return best
+
+
+class DatetimeCaster(object):
+    """
+    Parses a column of datetimes with the strptime format most samples
+    of the column match, falling back to dateutil for values that
+    don't match it. Parsed values are cached, up to cache_size distinct
+    values, since date columns tend to repeat.
+
+    Without samples the format is inferred from the first value seen.
+    """
+    def __init__(self, samples=(), cache_size=10000):
+        self.format = best_datetime_format(samples)
+        self.inferred = bool(samples)
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def parse(self, value):
+        if not self.inferred:
+            self.format = infer_datetime_format([value])
+            self.inferred = True
+        if self.format:
+            try:
+                return datetime.strptime(value.strip(), self.format)
+            except ValueError:
+                pass
+        from dateutil.parser import parse
+        return parse(value)
+
+    def __call__(self, value):
+        try:
+            return self.cache[value]
+        except KeyError:
+            pass
+        parsed = self.parse(value)
+        if len(self.cache) < self.cache_size:
+            self.cache[value] = parsed
+        return parsed
@@ -2,13 +2,25 @@ from django.contrib.admin.sites import site
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ImproperlyConfigured
 
-from django.http import Http404
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.views.decorators.http import require_POST
 
 from django.views.generic.edit import CreateView
 from django.views.generic.base import View, TemplateView
+from mongoengine import ValidationError
 
-from jamsession.models import Schema
+from jamsession.models import Schema, ImportJob
+from jamsession.jobs import cancel_import_job, retry_import_job
 from jamsession.forms.admin import SchemaAdminForm
+from jamsession.cache import cached_estimated_count, cached_rows
+from jamsession.export import iter_csv, iter_json, iter_ndjson, iter_parquet
+
+EXPORT_FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'json': (iter_json, 'application/json'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+    'parquet': (iter_parquet, 'application/vnd.apache.parquet'),
+}
 
 
 class ContextMixin(View):
@@ -40,6 +52,77 @@ class DashboardView(AdminViewMixin, TemplateView):
     extra_context = {'title': "Jamsession Administration"}
 
 
+class ImportJobsView(AdminViewMixin, TemplateView):
+    """
+    Progress of the most recent background imports, see jamsession.jobs.
+    """
+    template_name = 'jamsession/admin/import_jobs.html'
+    num_jobs = 50
+
+    def get(self, request):
+        jobs = ImportJob.objects.order_by('-created').limit(self.num_jobs)
+        self.extra_context = {
+            'title': 'Imports',
+            'klass': ImportJob,
+            'jobs': jobs,
+        }
+        return super(ImportJobsView, self).get(request)
+
+
+IMPORT_JOB_ACTIONS = {
+    'cancel': cancel_import_job,
+    'retry': retry_import_job,
+}
+
+
+@require_POST
+@site.admin_view
+def import_job_action(request, job_id, action):
+    """
+    Cancel or retry an ImportJob and go back to the list of them.
+    """
+    job = ImportJob.objects(id=job_id).first()
+    if not job or action not in IMPORT_JOB_ACTIONS:
+        raise Http404("Can't %s import job %s" % (action, job_id))
+    IMPORT_JOB_ACTIONS[action](job)
+    return HttpResponseRedirect(reverse("jamsession:admin-import-jobs"))
+
+
+class DataObjectChangelistView(AdminViewMixin, TemplateView):
+    """
+    Pages through the rows stored for a Schema, see
+    jamsession.cache.cached_rows.
+    """
+    template_name = 'jamsession/admin/data_object_changelist.html'
+    per_page = 50
+
+    def get(self, request, object_id):
+        datadef = Schema.objects(id=object_id).first()
+        if not datadef:
+            raise Http404("Schema %s not found" % object_id)
+
+        DataObj = datadef.get_data_object()
+        try:
+            page = cached_rows(DataObj, after=request.GET.get('after'),
+                               before=request.GET.get('before'),
+                               per_page=self.per_page)
+        except ValueError, e:
+            raise Http404(str(e))
+
+        columns = datadef.get_columns()
+        self.extra_context = {
+            'title': datadef.name,
+            'klass': Schema,
+            'obj': datadef,
+            'columns': columns,
+            'rows': [[getattr(row, column) for column in columns]
+                     for row in page.object_list],
+            'page': page,
+            'estimated_count': cached_estimated_count(DataObj),
+        }
+        return super(DataObjectChangelistView, self).get(request)
+
+
 class AdminCreateView(AdminViewMixin, CreateView):
     template_name = 'jamsession/admin/create_object.html'
 
@@ -101,6 +184,12 @@ class AdminCreateView(AdminViewMixin, CreateView):
         return self.addanother_url % \
             self._construct_object_dictionary(self.object)
 
+    def form_valid(self, form):
+        try:
+            return super(AdminCreateView, self).form_valid(form)
+        except ValidationError:
+            return self.form_invalid(form)
+
     def dispatch(self, request, object_type):
         klass, form_klass = self.object_types.get(object_type, (None, None))
         if not klass:
@@ -136,3 +225,23 @@ def edit_object(request, object_type, object_id):
 def changelist(request, object_type):
     from django.http import HttpResponse
     return HttpResponse('Hi changelist')
+
+
+@site.admin_view
+def export_rows(request, object_id, format):
+    """
+    Stream every row of a Schema's data object as a download.
+    """
+    datadef = Schema.objects(id=object_id).first()
+    if not datadef or format not in EXPORT_FORMATS:
+        raise Http404("Can't export %s as %s" % (object_id, format))
+
+    exporter, mimetype = EXPORT_FORMATS[format]
+    try:
+        rows = exporter(datadef)
+    except ImportError, e:
+        raise Http404(str(e))
+    response = HttpResponse(rows, mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+        datadef._get_data_object_name(), format)
+    return response